@@ -1,32 +1,181 @@
 import fastapi
 import uvicorn
+import asyncio
 import os
 import zipfile
 import tempfile
 import shutil
 import logging
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+import re
+import hashlib
+import time
+import threading
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
 from typing import Optional, List
 
 try:
-    from main import process_latex_files
+    from main import convert_latex_project, convert_latex_project_to_templates
 except ImportError:
-    logging.error("Error: Could not import 'process_latex_files' from main.py.")
+    logging.error("Error: Could not import the conversion functions from main.py.")
     logging.error("Make sure main.py is in the same directory or accessible.")
-    def process_latex_files(*args, **kwargs):
-        raise RuntimeError("process_latex_files function not loaded.")
+    def convert_latex_project(*args, **kwargs):
+        raise RuntimeError("convert_latex_project function not loaded.")
+    def convert_latex_project_to_templates(*args, **kwargs):
+        raise RuntimeError("convert_latex_project_to_templates function not loaded.")
+
+from function import ingest_zip_with_manifest
+from workspace import Workspace, WORKSPACE_ROOT, cleanup_stale_workspaces
+from jobs import Job, JobManager, JobQueueFull, FAILED
+from result_cache import ResultCache, conversion_cache_key
+from template_cache import template_cache, template_zip_sha256
+from template_reader import TemplateZip
+from template_registry import TEMPLATE_FOLDER, get_template_registry
+from warmup import TemplateWarmup
+from joblog import LEVELS
+from tracing import Trace, Span, span, current_trace, trace_ids_from_headers, add_span_listener
+from metrics import MetricsRegistry, CONTENT_TYPE, SIZE_BUCKETS, directory_usage
+from batch import run_batch, BATCH_WORKERS
+from zipstream import write_zip_folder
 
-TEMPLATE_FOLDER = "./templates"
 os.makedirs(TEMPLATE_FOLDER, exist_ok=True)
+# Main tex, compile method, hash and asset list of every template, kept in templates/registry.json.
+template_registry = get_template_registry(TEMPLATE_FOLDER)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+job_manager = JobManager()
+result_cache = ResultCache()
+template_warmup = TemplateWarmup()
+
+# Prometheus metrics served at /metrics.
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.counter(
+    "latex_converter_http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"])
+HTTP_REQUEST_DURATION = metrics.histogram(
+    "latex_converter_http_request_duration_seconds", "Time until the response headers are sent.", ["method", "route"])
+CONVERSIONS = metrics.counter(
+    "latex_converter_conversions_total", "Finished conversions by kind (convert, fanout, batch), template and outcome.",
+    ["kind", "template", "status", "cache"])
+CONVERSION_DURATION = metrics.histogram(
+    "latex_converter_conversion_duration_seconds", "Time a conversion job spends running on the worker pool.",
+    ["kind", "template"])
+JOB_QUEUE_WAIT = metrics.histogram(
+    "latex_converter_job_queue_wait_seconds", "Time a job waits in the queue before a worker picks it up.", ["kind"])
+STAGE_DURATION = metrics.histogram(
+    "latex_converter_stage_duration_seconds", "Wall time of each traced pipeline stage.", ["stage"])
+UPLOAD_BYTES = metrics.histogram(
+    "latex_converter_upload_bytes", "Size of uploaded files.", ["kind"], buckets=SIZE_BUCKETS)
+add_span_listener(lambda finished: STAGE_DURATION.labels(stage=finished.name).observe(finished.wall))
+
+def _ratio(hits: int, misses: int) -> Optional[float]:
+    return hits / (hits + misses) if hits + misses else None
+
+# Walking the workspace root gets slow with many live jobs, so scrapes within this many seconds share one walk.
+WORKSPACE_USAGE_TTL = 10.0
+_workspace_usage_cache = (0.0, {})
+_workspace_usage_lock = threading.Lock()
+
+def _workspace_usage() -> dict:
+    global _workspace_usage_cache
+    with _workspace_usage_lock:
+        measured_at, usage = _workspace_usage_cache
+        if time.monotonic() - measured_at >= WORKSPACE_USAGE_TTL or not usage:
+            total, files = directory_usage(WORKSPACE_ROOT)
+            usage = {("bytes",): total, ("files",): files}
+            _workspace_usage_cache = (time.monotonic(), usage)
+        return usage
+
+metrics.callback("latex_converter_jobs", "Jobs known to the job manager by state.",
+                 lambda: {(state,): count for state, count in job_manager.counts().items()}, ["state"])
+metrics.callback("latex_converter_job_workers", "Size of the conversion worker pool.", lambda: job_manager.max_workers)
+metrics.callback("latex_converter_job_queue_limit", "Jobs that may wait before requests get 429.",
+                 lambda: job_manager.max_queue)
+metrics.callback("latex_converter_workspace_usage", "Disk used under the workspace root (hard links counted once).",
+                 _workspace_usage, ["unit"])
+metrics.callback("latex_converter_result_cache_requests_total", "Result cache lookups by outcome.",
+                 lambda: {("hit",): result_cache.hits, ("miss",): result_cache.misses}, ["result"], "counter")
+metrics.callback("latex_converter_result_cache_hit_ratio", "Share of result cache lookups that were hits.",
+                 lambda: _ratio(result_cache.hits, result_cache.misses))
+metrics.callback("latex_converter_result_cache_usage", "Entries and bytes held by the result cache.",
+                 lambda: {(key,): value for key, value in result_cache.stats().items() if key in ("entries", "bytes")},
+                 ["unit"])
+metrics.callback("latex_converter_template_cache_requests_total", "Prepared-template cache lookups by outcome.",
+                 lambda: {("hit",): template_cache.hits, ("miss",): template_cache.misses}, ["result"], "counter")
+metrics.callback("latex_converter_template_cache_hit_ratio", "Share of prepared-template cache lookups that were hits.",
+                 lambda: _ratio(template_cache.hits, template_cache.misses))
+metrics.callback("latex_converter_template_cache_usage", "Entries and bytes held by the prepared-template cache.",
+                 lambda: {(key,): value for key, value in template_cache.stats().items() if key in ("entries", "bytes")},
+                 ["unit"])
+metrics.callback("latex_converter_template_warmup_pending", "Templates still being prepared by the warm-up pool.",
+                 lambda: len(template_warmup.status()["pending"]))
+
+def observe_job(job: Job, kind: str, template: str, count: bool = True):
+    """Records the run time and queue wait of a job once it finishes, and its outcome when count is set.
+
+    Fan-out and batch jobs cover several conversions and count each of them themselves.
+    """
+    def done(_):
+        if count:
+            CONVERSIONS.labels(kind=kind, template=template, status=job.status, cache="miss").inc()
+        if job.started_at is not None:
+            JOB_QUEUE_WAIT.labels(kind=kind).observe(job.started_at - job.created_at)
+            CONVERSION_DURATION.labels(kind=kind, template=template).observe(job.finished_at - job.started_at)
+    job.future.add_done_callback(done)
+    return job
+
 app = FastAPI(
     title="LaTeX Template Converter API",
     description="API to convert LaTeX projects using predefined templates.",
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUESTS.labels(method=request.method, route=path, status=str(status)).inc()
+        HTTP_REQUEST_DURATION.labels(method=request.method, route=path).observe(time.perf_counter() - start)
+
+@app.get("/metrics", summary="Prometheus Metrics", include_in_schema=False)
+def get_metrics():
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
+
+@app.on_event("startup")
+def remove_stale_workspaces():
+    """Removes workspaces left behind by a previous process that exited mid-conversion."""
+    removed = cleanup_stale_workspaces()
+    if removed:
+        logging.info(f"Removed {len(removed)} stale workspace(s).")
+
+@app.on_event("startup")
+def warm_up_templates():
+    """Prepares every registered template in the background so first conversions skip that work."""
+    template_warmup.warm(template_registry.zip_path(name) for name in template_registry.zip_names())
+
+@app.on_event("shutdown")
+def stop_job_manager():
+    job_manager.shutdown()
+    template_warmup.shutdown()
+
+
+@app.get(
+    "/api/v1/ready",
+    summary="Readiness",
+    description="Returns 200 once template warm-up has finished and 503 while templates are still being prepared.",
+)
+def readiness(response: Response):
+    status = template_warmup.status()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
 def detect_main_tex(directory):
     for root, _, files in os.walk(directory):
         for f in files:
@@ -43,44 +192,41 @@ def detect_main_tex(directory):
     response_description="A list of available LaTeX template names."
 )
 def get_available_templates() -> List[str]:
-    """Gets available template names (without .zip extension)"""
+    """Gets available template names (without .zip extension) from the template registry."""
     try:
-        return [
-            os.path.splitext(f)[0]
-            for f in os.listdir(TEMPLATE_FOLDER)
-            if f.endswith('.zip') and os.path.isfile(os.path.join(TEMPLATE_FOLDER, f))
-        ]
-    except FileNotFoundError:
-        logging.warning(f"Template folder '{TEMPLATE_FOLDER}' not found.")
-        return []
+        return template_registry.names()
     except Exception as e:
         logging.error(f"Error listing templates: {e}")
         return []
 
-def extract_zip(zip_file_path: str, target_dir: str):
-    """Extracts ZIP file to a target directory, removing __MACOSX."""
+
+@app.get(
+    "/api/v1/templates/{template_name}",
+    summary="Get Template Details",
+    description="Returns the registry entry of a template: main .tex file, recommended compile method, "
+                "content hash and the .tex/.sty/.cls/.bst files it contains.",
+)
+def get_template_details(template_name: str):
+    entry = template_registry.get(f"{template_name}.zip")
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Template '{template_name}' not found.")
+    return {"template_name": template_name, **entry}
+
+def ingest_source_zip(zip_file_path: str, target_dir: str) -> dict:
+    """Extracts the source ZIP into target_dir for in-place conversion and returns its ingestion manifest.
+
+    The manifest lets the result writer copy files the conversion did not touch straight from the source zip.
+    """
     try:
         with zipfile.ZipFile(zip_file_path, "r") as zip_ref:
             for member in zip_ref.namelist():
                 member_path = os.path.abspath(os.path.join(target_dir, member))
                 if not member_path.startswith(os.path.abspath(target_dir)):
                     raise HTTPException(status_code=400, detail="Unsafe file path in zip.")
-            zip_ref.extractall(target_dir)
-
-        macosx_folder = os.path.join(target_dir, '__MACOSX')
-        if os.path.exists(macosx_folder) and os.path.isdir(macosx_folder):
-            logging.info(f"Removing __MACOSX folder from {target_dir}")
-            shutil.rmtree(macosx_folder)
-
-        extracted_items = os.listdir(target_dir)
-        if len(extracted_items) == 1:
-            potential_subdir = os.path.join(target_dir, extracted_items[0])
-            if os.path.isdir(potential_subdir):
-                logging.info(f"Moving contents up from nested folder: {potential_subdir}")
-                for item in os.listdir(potential_subdir):
-                    shutil.move(os.path.join(potential_subdir, item), target_dir)
-                os.rmdir(potential_subdir)
-
+        _, manifest = ingest_zip_with_manifest(zip_file_path, target_dir)
+        return manifest
+    except HTTPException:
+        raise
     except zipfile.BadZipFile:
         logging.error(f"Error: Bad zip file: {zip_file_path}")
         raise HTTPException(status_code=400, detail=f"Invalid or corrupted ZIP file provided: {os.path.basename(zip_file_path)}")
@@ -103,33 +249,13 @@ def get_tex_files_from_dir(directory: str) -> List[str]:
         logging.error(f"Error scanning for .tex files in {directory}: {e}")
         return []
 
-def cleanup_file(path: str):
+def cleanup_workspace(workspace: Workspace):
     try:
-        if path and os.path.exists(path):
-            os.remove(path)
-            logging.info(f"Background task: Successfully removed temporary file: {path}")
-        else:
-            logging.warning(f"Background task: File not found or already removed: {path}")
+        workspace.cleanup()
+        logging.info(f"Removed workspace: {workspace.path}")
     except Exception as e:
-        logging.error(f"Background task: Error removing file {path}: {e}")
-
-# 更新 Mapping 文件
-def add_template_to_mapping(mapping_file, full_template_name, main_tex_name):
-    # 读取现有内容
-    with open(mapping_file, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    # 查找字典的结尾位置
-    for i, line in enumerate(lines):
-        if line.strip() == "}":  # 字典的结尾部分
-            # 在字典结束符号前插入新的映射
-            lines.insert(i, f'    "{full_template_name}": "{main_tex_name}",\n')
-            break
-
-    # 重新写回文件
-    with open(mapping_file, "w", encoding="utf-8") as f:
-        f.writelines(lines)
-        
+        logging.error(f"Error removing workspace {workspace.path}: {e}")
+
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB
 @app.post(
     "/api/v1/upload",
@@ -145,8 +271,7 @@ async def upload_latex_project(
     logging.info(f"Received template upload request: '{template_name}'")
     
     # Check if template name is already used
-    available_templates = get_available_templates()
-    if template_name in available_templates:
+    if f"{template_name}.zip" in template_registry:
         raise HTTPException(status_code=400, detail=f"Template name '{template_name}' already exists. Please choose a different name.")
     
     # Validate the file is a zip
@@ -157,7 +282,6 @@ async def upload_latex_project(
     if main_tex and (os.path.isabs(main_tex) or '..' in main_tex):
         raise HTTPException(400, detail="Main tex path contains invalid characters.")
     
-    temp_dir = None
     template_zip_path = None
     
     try:
@@ -179,11 +303,11 @@ async def upload_latex_project(
                 temp_file.write(chunk)
             temp_file.flush() # 确保数据写入磁盘
             template_zip_path = temp_file.name
+        UPLOAD_BYTES.labels(kind="template").observe(size)
         
-        temp_dir = tempfile.mkdtemp()
-        extract_zip(template_zip_path, temp_dir)
-        
-        tex_files = get_tex_files_from_dir(temp_dir)
+        # Only the central directory is needed to list the .tex files; nothing is extracted.
+        with TemplateZip(template_zip_path) as template_zip:
+            tex_files = template_zip.tex_files()
         if not tex_files:
             raise HTTPException(status_code=400, detail="No .tex files found in the uploaded template.")
         
@@ -197,15 +321,9 @@ async def upload_latex_project(
         template_path = os.path.join(TEMPLATE_FOLDER, full_template_name)
         shutil.copy(template_zip_path, template_path)
         
-        # Update the targetTemplateMainTexMapping.py file
-        mapping_file = "targetTemplateMainTexMapping.py"
-        if os.path.exists(mapping_file):
-            add_template_to_mapping(mapping_file, full_template_name, main_tex)
-            
-        # Update the targetTemplateRecCompileMapping.py file
-        compile_mapping_file = "targetTemplateRecCompileMapping.py"
-        if os.path.exists(compile_mapping_file):
-            add_template_to_mapping(compile_mapping_file, full_template_name, recommended_compile)
+        # Record main tex and compile method in the registry; running workers see it on their next lookup.
+        template_registry.register(full_template_name, os.path.basename(main_tex), recommended_compile)
+        template_warmup.warm([template_path])
             
         return {
             "status": "success",
@@ -221,142 +339,539 @@ async def upload_latex_project(
     
     finally:
         # Clean up temporary files
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            
         if template_zip_path and os.path.exists(template_zip_path):
             os.remove(template_zip_path)
 
 
+def resolve_template(template_name: str):
+    """Returns (zip file name, zip path) of a template, raising 404 if it does not exist."""
+    template_zip_name = f"{template_name}.zip"
+    if template_zip_name not in template_registry:
+        available_templates = get_available_templates()
+        logging.error(f"Template '{template_name}' not found. Available: {available_templates}")
+        raise HTTPException(
+            status_code=404,
+            detail=f"Target template '{template_name}' not found. Available templates: {', '.join(available_templates)}"
+        )
+    template_zip_path = template_registry.zip_path(template_zip_name)
+    if not os.path.exists(template_zip_path):
+        raise HTTPException(404, f"Template {template_name} not found")
+    logging.info(f"Using template file: {template_zip_path}")
+    return template_zip_name, template_zip_path
+
+async def save_upload(upload: UploadFile, path: str, kind: str = "source") -> str:
+    """Streams an uploaded file to disk and returns its sha256."""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = await upload.read(1024 * 1024)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    UPLOAD_BYTES.labels(kind=kind).observe(size)
+    return sha256.hexdigest()
+
+def request_trace(request: Request) -> Trace:
+    """A trace for the conversion started by this request, continuing the caller's trace id when it sends one."""
+    trace_id, parent_id = trace_ids_from_headers(request.headers)
+    return Trace(trace_id, parent_id)
+
+def trace_headers(trace: Optional[Trace]) -> dict:
+    """X-Trace-Id and X-Conversion-Timings (per-stage wall time in ms, Server-Timing syntax) of a traced job."""
+    if trace is None:
+        return {}
+    headers = {"X-Trace-Id": trace.trace_id}
+    timings = trace.timings_header()
+    if timings:
+        headers["X-Conversion-Timings"] = timings
+    return headers
+
+def resolve_main_tex(source_dir: str, main_tex: Optional[str]) -> str:
+    """Returns the main .tex file of an extracted source, auto-detecting it when main_tex is not given."""
+    if not main_tex:
+        logging.info("Main TeX file not specified, attempting auto-detection.")
+        tex_files = get_tex_files_from_dir(source_dir)
+
+        if not tex_files:
+            logging.error("No .tex files found in the uploaded source zip.")
+            raise HTTPException(status_code=400, detail="No .tex files found in the source ZIP.")
+        elif len(tex_files) == 1:
+            main_tex = tex_files[0]
+            logging.info(f"Auto-detected single main TeX file: {main_tex}")
+        else:
+            main_tex = detect_main_tex(source_dir)
+            if main_tex:
+                logging.info(f"Auto-detected main TeX file: {main_tex}")
+            else:
+                logging.error(f"Multiple .tex files found, main_tex needs to be specified: {tex_files}")
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Multiple .tex files found ({', '.join(tex_files)}). Please specify the main file using the 'main_tex' parameter."
+                )
+    else:
+        logging.info(f"Using specified main TeX file: {main_tex}")
+    return main_tex
+
+def run_conversion(workspace: Workspace, source_zip_path: str, template_zip_path: str,
+                   template_zip_name: str, main_tex: Optional[str], cache_key: Optional[str] = None,
+                   stream: bool = False):
+    """Blocking part of a conversion: ingestion, main .tex detection and the conversion itself. Runs on the job pool.
+
+    Returns the path of the result zip, or with stream=True the ConversionResult so the caller can
+    stream the archive without writing it to disk first.
+    """
+    # The source is extracted exactly once, straight into the folder that gets converted in place.
+    with span("ingest"):
+        source_dir = workspace.subdir("converted_result")
+        source_manifest = ingest_source_zip(source_zip_path, source_dir)
+        main_tex = resolve_main_tex(source_dir, main_tex)
+
+    logging.info(f"Calling convert_latex_project with source='{source_zip_path}', template='{template_zip_path}', main='{main_tex}', workspace='{workspace.path}'")
+
+    result = convert_latex_project(
+        source_zip=source_zip_path,
+        template_zip=template_zip_path,
+        main_tex_file=main_tex,
+        selected_template=template_zip_name,
+        workspace=workspace,
+        source_dir=source_dir,
+        source_manifest=source_manifest
+    )
+    if stream:
+        return result
+
+    output_zip_path = result.write_zip()
+
+    if not output_zip_path or not os.path.exists(output_zip_path):
+        logging.error("The conversion result could not be written to a zip file.")
+        raise HTTPException(status_code=500, detail="Conversion process failed to produce an output file.")
+
+    logging.info(f"Conversion successful. Output ZIP: {output_zip_path}")
+
+    if cache_key:
+        try:
+            with span("result_cache_put"):
+                result_cache.put(cache_key, output_zip_path)
+        except Exception as e:
+            logging.warning(f"Could not store result {cache_key} in the result cache: {e}")
+    return output_zip_path
+
+def run_fanout_conversion(workspace: Workspace, source_zip_path: str, templates: List[tuple],
+                          main_tex: Optional[str]):
+    """Blocking part of a fan-out conversion: the source is ingested and prepared once, then every
+    template is applied to its own clone of it in parallel. Returns the FanoutResult.
+    """
+    with span("ingest"):
+        source_dir = workspace.subdir("source")
+        source_manifest = ingest_source_zip(source_zip_path, source_dir)
+        main_tex = resolve_main_tex(source_dir, main_tex)
+
+    logging.info(f"Converting '{source_zip_path}' to {len(templates)} template(s), main='{main_tex}', workspace='{workspace.path}'")
+    result = convert_latex_project_to_templates(
+        source_zip=source_zip_path,
+        template_zips=templates,
+        main_tex_file=main_tex,
+        workspace=workspace,
+        source_dir=source_dir,
+        source_manifest=source_manifest,
+    )
+    summary = result.summary()
+    for template_result in summary["templates"]:
+        CONVERSIONS.labels(kind="fanout", template=template_result["template"], status=template_result["status"],
+                           cache="miss").inc()
+    logging.info(f"Fan-out conversion finished: {summary['succeeded']} succeeded, {summary['failed']} failed.")
+    return result
+
+async def submit_conversion(source: UploadFile, template_name: str, main_tex: Optional[str], stream: bool = False,
+                            trace: Optional[Trace] = None) -> Job:
+    """Validates a conversion request, stores the upload in a fresh workspace and queues the job.
+
+    With stream=True a converted job's result is a ConversionResult instead of a zip on disk (see run_conversion).
+    With a trace, every stage of the conversion is recorded as a span of it.
+    """
+    logging.info(f"Received conversion request for template: '{template_name}'")
+    # 添加路径安全检验
+    if main_tex and (os.path.isabs(main_tex) or '..' in main_tex):
+        raise HTTPException(400, "Main tex path contains invalid characters")
+
+    template_zip_name, template_zip_path = resolve_template(template_name)
+
+    # Every conversion runs in its own workspace so concurrent requests never share files.
+    workspace = Workspace()
+    try:
+        source_zip_path = workspace.file("source_upload.zip")
+        source_sha256 = await save_upload(source, source_zip_path)
+        logging.info(f"Source ZIP saved to workspace: {source_zip_path}")
+
+        download_filename = f"converted_{source.filename.replace('.zip', '')}_using_{template_name}.zip"
+        cache_key = conversion_cache_key(source_sha256, template_zip_sha256(template_zip_path), main_tex)
+        metadata = {"template_name": template_name, "download_filename": download_filename, "cache_key": cache_key}
+
+        # Identical source, template and main_tex: serve the stored result without converting again.
+        cached_path = result_cache.get(cache_key)
+        if cached_path:
+            logging.info(f"Serving cached result {cache_key}")
+            cleanup_workspace(workspace)
+            CONVERSIONS.labels(kind="convert", template=template_name, status="succeeded", cache="hit").inc()
+            return job_manager.add_completed(cached_path, metadata={**metadata, "cache": "hit"})
+
+        job = job_manager.submit(
+            run_conversion, workspace, source_zip_path, template_zip_path, template_zip_name, main_tex, cache_key, stream,
+            workspace=workspace,
+            metadata={**metadata, "cache": "miss", **({"trace_id": trace.trace_id} if trace else {})},
+            trace=trace,
+        )
+        return observe_job(job, "convert", template_name)
+    except JobQueueFull as e:
+        cleanup_workspace(workspace)
+        logging.warning(str(e))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except Exception:
+        cleanup_workspace(workspace)
+        raise
+
+def stream_result(result, cache_key: Optional[str], trace: Optional[Trace] = None):
+    """Yields the result archive chunk by chunk and tees it into a workspace file for the result cache.
+
+    The file is only added to the cache once the whole archive has been produced. With a trace, the
+    archive is recorded as a "stream_zip" span; chunks are produced on different threads, so the span
+    is timed here instead of through the context variables.
+    """
+    stream_span = Span(trace, "stream_zip") if trace is not None else None
+    cpu = 0.0
+    partial_path = result.workspace.file("streamed_result.zip")
+    with open(partial_path, "wb") as partial:
+        chunks = result.iter_zip()
+        while True:
+            cpu_start = time.thread_time()
+            chunk = next(chunks, None)
+            cpu += time.thread_time() - cpu_start
+            if chunk is None:
+                break
+            partial.write(chunk)
+            if stream_span is not None:
+                stream_span.bytes_written += len(chunk)
+            yield chunk
+    if stream_span is not None:
+        stream_span.finish(cpu=cpu)
+    if cache_key:
+        try:
+            result_cache.put(cache_key, partial_path)
+        except Exception as e:
+            logging.warning(f"Could not store result {cache_key} in the result cache: {e}")
+
+def job_result_response(job: Job, request: Request):
+    """Response for a finished job, with the conversion key as ETag and If-None-Match support.
+
+    Results on disk are sent with FileResponse; ConversionResults are streamed as the archive is written.
+    """
+    etag = f'"{job.metadata.get("cache_key", job.id)}"'
+    headers = {"ETag": etag, "X-Cache": job.metadata.get("cache", "miss")}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+
+    download_filename = job.metadata["download_filename"]
+    headers = {
+        "Content-Disposition": f"attachment; filename={download_filename}",
+        "X-Conversion-Status": "success",
+        **headers,
+        **trace_headers(job.trace),
+    }
+    if isinstance(job.result, str):
+        return FileResponse(
+            path=job.result,
+            media_type='application/zip',
+            filename=download_filename,
+            headers=headers
+        )
+    return StreamingResponse(
+        stream_result(job.result, job.metadata.get("cache_key"), job.trace),
+        media_type='application/zip',
+        headers=headers
+    )
+
+
 @app.post(
     "/api/v1/convert",
     summary="Convert LaTeX Source to Target Template",
     description="Upload a source LaTeX project zip, select a target template, "
-                "and optionally specify the main .tex file. Returns the converted project as a zip.",
+                "and optionally specify the main .tex file. Returns the converted project as a zip. "
+                "The conversion runs on the shared worker pool; returns 429 when the queue is full.",
     response_description="A ZIP file containing the converted LaTeX project."
 )
 async def convert_latex_endpoint(
+    request: Request,
     background_tasks: BackgroundTasks,
     source: UploadFile = File(..., description="Source LaTeX project as a ZIP file."),
     template_name: str = Form(..., description="Name of the target template (e.g., 'templateA', without .zip)."),
     main_tex: Optional[str] = Form(None, description="Optional: Name of the main .tex file in the source zip (e.g., 'main.tex', 'document.tex'). If not provided, attempts to auto-detect.")
 ):
-    logging.info(f"Received conversion request for template: '{template_name}'")
-    # 添加路径安全检验
+    # The archive is streamed into the response while it is being written instead of zipping to disk first.
+    job = await submit_conversion(source, template_name, main_tex, stream=True, trace=request_trace(request))
+
+    try:
+        await asyncio.wrap_future(job.future)
+    except HTTPException:
+        job_manager.remove(job.id)
+        raise
+    except Exception as e:
+        logging.exception("An unexpected error occurred during conversion.")
+        job_manager.remove(job.id)
+        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
+
+    # Remove the job and its workspace (including the streamed output) once the response has been sent.
+    background_tasks.add_task(job_manager.remove, job.id)
+    return job_result_response(job, request)
+
+
+@app.post(
+    "/api/v1/convert/fanout",
+    summary="Convert LaTeX Source to Several Templates",
+    description="Upload one source LaTeX project zip and a list of target templates. The source is parsed and "
+                "prepared once and the templates are applied in parallel. Returns one zip with a folder per "
+                "converted template and a summary.json with the status of every template. "
+                "Returns 429 when the queue is full.",
+    response_description="A ZIP file with one folder per template and summary.json."
+)
+async def convert_latex_fanout_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    source: UploadFile = File(..., description="Source LaTeX project as a ZIP file."),
+    template_names: List[str] = Form(..., description="Target templates (without .zip); repeat the field or separate names with commas."),
+    main_tex: Optional[str] = Form(None, description="Optional: Name of the main .tex file in the source zip. If not provided, attempts to auto-detect.")
+):
     if main_tex and (os.path.isabs(main_tex) or '..' in main_tex):
         raise HTTPException(400, "Main tex path contains invalid characters")
-    
-    available_templates = get_available_templates()
-    if template_name not in available_templates:
-        logging.error(f"Template '{template_name}' not found. Available: {available_templates}")
-        raise HTTPException(
-            status_code=404,
-            detail=f"Target template '{template_name}' not found. Available templates: {', '.join(available_templates)}"
-        )
-    template_zip_name = f"{template_name}.zip"
-    template_zip_path = os.path.join(TEMPLATE_FOLDER, template_zip_name)
-    if not os.path.exists(template_zip_path):
-        raise HTTPException(404, f"Template {template_name} not found")
-    logging.info(f"Using template file: {template_zip_path}")
 
-    source_temp_dir = None
-    output_zip_path = None
-    source_zip_temp_file = None
+    names = []
+    for value in template_names:
+        for name in value.split(","):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+    if not names:
+        raise HTTPException(400, "No target templates given")
+    templates = [(name, resolve_template(name)[1]) for name in names]
+
+    workspace = Workspace()
+    trace = request_trace(request)
+    try:
+        source_zip_path = workspace.file("source_upload.zip")
+        await save_upload(source, source_zip_path)
+        job = job_manager.submit(
+            run_fanout_conversion, workspace, source_zip_path, templates, main_tex,
+            workspace=workspace,
+            metadata={"template_names": names, "trace_id": trace.trace_id},
+            trace=trace,
+        )
+        observe_job(job, "fanout", "(multiple)", count=False)
+    except JobQueueFull as e:
+        cleanup_workspace(workspace)
+        logging.warning(str(e))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except Exception:
+        cleanup_workspace(workspace)
+        raise
 
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as temp_file:
-            shutil.copyfileobj(source.file, temp_file)
-            source_zip_temp_file = temp_file.name
-        logging.info(f"Source ZIP saved temporarily to: {source_zip_temp_file}")
-
-        if not main_tex:
-            logging.info("Main TeX file not specified, attempting auto-detection.")
-            source_temp_dir = tempfile.mkdtemp()
-            try: # 添加 try...finally 来确保 source_temp_dir 在出错时也能清理
-                extract_zip(source_zip_temp_file, source_temp_dir)
-                tex_files = get_tex_files_from_dir(source_temp_dir)
-
-                if not tex_files:
-                    logging.error("No .tex files found in the uploaded source zip.")
-                    raise HTTPException(status_code=400, detail="No .tex files found in the source ZIP.")
-                elif len(tex_files) == 1:
-                    main_tex = tex_files[0]
-                    logging.info(f"Auto-detected single main TeX file: {main_tex}")
-                else:
-                    main_tex = detect_main_tex(source_temp_dir)
-                    if main_tex:
-                        logging.info(f"Auto-detected main TeX file: {main_tex}")
-                    else:
-                        logging.error(f"Multiple .tex files found, main_tex needs to be specified: {tex_files}")
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"Multiple .tex files found ({', '.join(tex_files)}). Please specify the main file using the 'main_tex' parameter."
-                        )
-            finally:
-                if source_temp_dir and os.path.exists(source_temp_dir):
-                    logging.info(f"Removing temporary extraction directory: {source_temp_dir}")
-                    shutil.rmtree(source_temp_dir)
-                    source_temp_dir = None # 标记为已清理
-        else:
-             logging.info(f"Using specified main TeX file: {main_tex}")
+        result = await asyncio.wrap_future(job.future)
+    except HTTPException:
+        job_manager.remove(job.id)
+        raise
+    except Exception as e:
+        logging.exception("An unexpected error occurred during fan-out conversion.")
+        job_manager.remove(job.id)
+        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
+    # The workspace holds every converted folder; remove it once the archive has been sent.
+    background_tasks.add_task(job_manager.remove, job.id)
+    summary = result.summary()
+    download_filename = f"converted_{source.filename.replace('.zip', '')}_fanout.zip"
+    return StreamingResponse(
+        result.iter_zip(),
+        media_type='application/zip',
+        headers={
+            "Content-Disposition": f"attachment; filename={download_filename}",
+            "X-Conversion-Status": "success" if not summary["failed"] else "partial",
+            "X-Fanout-Succeeded": str(summary["succeeded"]),
+            "X-Fanout-Failed": str(summary["failed"]),
+            **trace_headers(trace),
+        },
+    )
 
-        logging.info(f"Calling process_latex_files with source='{source_zip_temp_file}', template='{template_zip_path}', main='{main_tex}'")
 
-        output_zip_path = process_latex_files(
-            source_zip=source_zip_temp_file,
-            template_zip=template_zip_path,
-            main_tex_file=main_tex,
-            selected_template=template_zip_name # 注意：这里之前是 template_zip_name，确认是否正确
-        )
+@app.post(
+    "/api/v1/jobs",
+    status_code=202,
+    summary="Submit Conversion Job",
+    description="Queues a conversion and returns immediately with a job id. "
+                "Poll /api/v1/jobs/{job_id} and download from /api/v1/jobs/{job_id}/result. "
+                "Returns 429 when the queue is full.",
+)
+async def submit_conversion_job(
+    request: Request,
+    source: UploadFile = File(..., description="Source LaTeX project as a ZIP file."),
+    template_name: str = Form(..., description="Name of the target template (e.g., 'templateA', without .zip)."),
+    main_tex: Optional[str] = Form(None, description="Optional: Name of the main .tex file in the source zip. If not provided, attempts to auto-detect.")
+):
+    job = await submit_conversion(source, template_name, main_tex, trace=request_trace(request))
+    return job.to_dict()
 
-        if not output_zip_path or not os.path.exists(output_zip_path):
-             logging.error("process_latex_files did not return a valid output path.")
-             raise HTTPException(status_code=500, detail="Conversion process failed to produce an output file.")
 
-        logging.info(f"Conversion successful. Output ZIP: {output_zip_path}")
+def run_batch_conversion(workspace: Workspace, sources_zip_path: str, template_zip_path: str, template_name: str,
+                         main_tex: Optional[str], progress: dict) -> str:
+    """Blocking part of a batch conversion. Converts every source project in the uploaded zip on a process
+    pool, keeping `progress` (the job's metadata entry) up to date, and returns the zip of all results
+    together with batch_manifest.json.
+    """
+    output_dir = workspace.subdir("batch_result")
 
-        download_filename = f"converted_{source.filename.replace('.zip', '')}_using_{template_name}.zip"
+    def report(done: int, total: int, record: dict):
+        progress.update(done=done, total=total, failed=progress["failed"] + (record["status"] != "succeeded"))
+        CONVERSIONS.labels(kind="batch", template=template_name, status=record["status"], cache="miss").inc()
+        logging.info(f"Batch conversion to {template_name}: {done}/{total} ({record['name']}: {record['status']})")
 
-        # 添加后台任务来删除 output_zip_path
-        background_tasks.add_task(cleanup_file, output_zip_path)
+    trace = current_trace()
+    manifest = run_batch(sources_zip_path, template_zip_path, output_dir, template_name, main_tex,
+                         BATCH_WORKERS, report, trace.trace_id if trace else None)
+    progress.update(succeeded=manifest["succeeded"], total=manifest["total"])
+    output_zip_path = workspace.file("batch_result.zip")
+    write_zip_folder(output_dir, output_zip_path)
+    return output_zip_path
 
-        return FileResponse(
-            path=output_zip_path,
-            media_type='application/zip',
-            filename=download_filename,
-            headers={
-                "Content-Disposition": f"attachment; filename={download_filename}",
-                "X-Conversion-Status": "success"
-            }
-            # 注意：FileResponse 自身也有 background 参数，但使用注入的 background_tasks 更灵活
-            # background=BackgroundTask(cleanup_file, path=output_zip_path) # 另一种方式
+
+@app.post(
+    "/api/v1/batch",
+    status_code=202,
+    summary="Submit Batch Conversion Job",
+    description="Upload a zip that contains many source projects (one .zip or folder each) and convert all of them "
+                "to one template on a process pool. Returns a job id; /api/v1/jobs/{job_id} reports progress and "
+                "/api/v1/jobs/{job_id}/result returns a zip with every converted project and batch_manifest.json "
+                "listing successes and failures. Returns 429 when the queue is full.",
+)
+async def submit_batch_job(
+    request: Request,
+    sources: UploadFile = File(..., description="ZIP file containing the source projects."),
+    template_name: str = Form(..., description="Name of the target template (without .zip)."),
+    main_tex: Optional[str] = Form(None, description="Optional: Name of the main .tex file, if it is the same in every project. If not provided, it is detected per project.")
+):
+    if main_tex and (os.path.isabs(main_tex) or '..' in main_tex):
+        raise HTTPException(400, "Main tex path contains invalid characters")
+    _, template_zip_path = resolve_template(template_name)
+
+    workspace = Workspace()
+    try:
+        sources_zip_path = workspace.file("batch_sources.zip")
+        await save_upload(sources, sources_zip_path, kind="batch")
+        if not zipfile.is_zipfile(sources_zip_path):
+            raise HTTPException(400, "Uploaded sources file is not a ZIP file")
+        progress = {"done": 0, "total": None, "succeeded": None, "failed": 0}
+        trace = request_trace(request)
+        job = job_manager.submit(
+            run_batch_conversion, workspace, sources_zip_path, template_zip_path, template_name, main_tex, progress,
+            workspace=workspace,
+            metadata={
+                "template_name": template_name,
+                "download_filename": f"batch_{sources.filename.replace('.zip', '')}_using_{template_name}.zip",
+                "progress": progress,
+                "trace_id": trace.trace_id,
+            },
+            trace=trace,
         )
+        observe_job(job, "batch", template_name, count=False)
+    except JobQueueFull as e:
+        cleanup_workspace(workspace)
+        logging.warning(str(e))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except Exception:
+        cleanup_workspace(workspace)
+        raise
+    return job.to_dict()
 
-    except HTTPException as e:
-        # 如果 output_zip_path 在异常发生前已生成，也需要清理
-        if output_zip_path and os.path.exists(output_zip_path):
-             cleanup_file(output_zip_path) # 直接清理，因为不会返回 FileResponse
-        raise e
-    except Exception as e:
-        logging.exception("An unexpected error occurred during conversion.")
-        # 如果 output_zip_path 在异常发生前已生成，也需要清理
-        if output_zip_path and os.path.exists(output_zip_path):
-             cleanup_file(output_zip_path) # 直接清理
-        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
-    finally:
-        logging.info("Starting final cleanup (source files)...")
-        # 清理临时的源 zip 文件
-        if source_zip_temp_file and os.path.exists(source_zip_temp_file):
-            logging.info(f"Removing temporary source zip: {source_zip_temp_file}")
-            os.remove(source_zip_temp_file)
-        # 确保临时的解压目录也被清理 (如果之前没有清理)
-        if source_temp_dir and os.path.exists(source_temp_dir):
-             logging.info(f"Removing temporary extraction directory (final check): {source_temp_dir}")
-             shutil.rmtree(source_temp_dir)
-        # 注意：output_zip_path 的清理现在由后台任务处理，不再需要在 finally 中处理
-
-        logging.info("Final cleanup finished.")
+
+def get_job_or_404(job_id: str) -> Job:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found.")
+    return job
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}",
+    summary="Get Conversion Job Status",
+)
+def get_conversion_job(job_id: str):
+    return get_job_or_404(job_id).to_dict()
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}/result",
+    summary="Download Conversion Job Result",
+    description="Returns the converted ZIP once the job has succeeded, 409 while it is still queued or running.",
+)
+def get_conversion_job_result(job_id: str, request: Request):
+    job = get_job_or_404(job_id)
+    if not job.done:
+        raise HTTPException(status_code=409, detail=f"Job '{job_id}' is {job.status}.")
+    if job.status == FAILED:
+        raise HTTPException(status_code=job.status_code or 500, detail=job.error)
+    return job_result_response(job, request)
+
+
+@app.get(
+    "/api/v1/jobs/{job_id}/log",
+    summary="Get Conversion Job Log",
+    description="Returns the structured events emitted by a job (stage, file, lines removed/inserted, duration). "
+                "Pass `since` (the `next` value of the previous response) to fetch only new events.",
+)
+def get_conversion_job_log(job_id: str, level: str = "info", since: int = 0):
+    job = get_job_or_404(job_id)
+    if level not in LEVELS:
+        raise HTTPException(status_code=400, detail=f"Unknown level '{level}'. Use one of: {', '.join(LEVELS)}")
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "next": len(job.log),
+        "events": job.log.to_list(level, max(since, 0)),
+    }
+
+
+@app.delete(
+    "/api/v1/jobs/{job_id}",
+    summary="Delete Conversion Job",
+    description="Removes a finished job and its files.",
+)
+def delete_conversion_job(job_id: str):
+    job = get_job_or_404(job_id)
+    if not job.done:
+        raise HTTPException(status_code=409, detail=f"Job '{job_id}' is {job.status}.")
+    job_manager.remove(job_id)
+    return {"status": "deleted", "job_id": job_id}
+
+
+@app.get(
+    "/api/v1/cache",
+    summary="Inspect Result Cache",
+    description="Returns result cache statistics and the stored entries.",
+)
+def get_result_cache():
+    return {**result_cache.stats(), "items": result_cache.entries()}
+
+
+@app.delete(
+    "/api/v1/cache",
+    summary="Purge Result Cache",
+    description="Removes one cached result (by key) or the whole result cache.",
+)
+def purge_result_cache(key: Optional[str] = None):
+    if key and not re.fullmatch(r"[0-9a-f]{64}", key):
+        raise HTTPException(status_code=400, detail="Invalid cache key.")
+    removed = result_cache.purge(key)
+    return {"status": "purged", "removed": removed}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+# 这个文件用来把很多个源文件批量转换成同一个模板
+# 例如研讨会收到几百个终稿 zip，都要转换成 "ACM Conference Proceedings Standard Template"：
+# 目标模板只准备一次（写成模板包，见 template_cache.py），每个工作进程直接 mmap 使用；
+# 源文件在进程池中同时转换，同时运行的数量有上限，每完成一个报告一次进度，最后写一份成功/失败的清单
+#
+# 命令行用法：
+#   python batch.py 源文件夹或源文件.zip "ACM Conference Proceedings Standard Template" -o 输出文件夹 -j 4
+
+# 导入包
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import zipfile
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from function import ingest_zip_with_manifest, get_tex_files
+from joblog import JobLog, job_log_context, log
+from tracing import Trace, trace_context
+from main import convert_latex_project
+from template_cache import get_prepared_template
+from template_registry import get_template_registry, TEMPLATE_FOLDER
+from workspace import Workspace
+from zipstream import write_zip_folder
+
+
+# 同时转换的进程数，可以用环境变量 BATCH_WORKERS 修改
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(os.cpu_count() or 1)))
+MANIFEST_FILE_NAME = 'batch_manifest.json'
+
+
+# 收集要转换的源文件，返回 [(名称, 源 zip 路径)...]
+# sources 可以是一个文件夹（里面的每个 .zip 和每个子文件夹都是一个源文件），也可以是一个装着多个源文件的 zip；
+# 文件夹形式的源文件和 zip 中的源文件会先放到 workspace 中
+def collect_sources(sources, workspace):
+    if os.path.isfile(sources):
+        if not zipfile.is_zipfile(sources):
+            raise ValueError(f"{sources} 不是 zip 文件")
+        sources_dir = workspace.subdir('sources')
+        ingest_zip_with_manifest(sources, sources_dir)
+        sources = sources_dir
+    if not os.path.isdir(sources):
+        raise ValueError(f"找不到源文件: {sources}")
+
+    collected = []
+    for entry in sorted(os.listdir(sources)):
+        path = os.path.join(sources, entry)
+        if entry.startswith('.') or entry == '__MACOSX':
+            continue
+        if os.path.isdir(path):
+            # 文件夹形式的源文件先打包成 zip，和上传的源文件走同一条路
+            source_zip = os.path.join(workspace.subdir('packed_sources'), entry + '.zip')
+            write_zip_folder(path, source_zip)
+            collected.append((entry, source_zip))
+        elif entry.endswith('.zip'):
+            collected.append((os.path.splitext(entry)[0], path))
+    return collected
+
+# 找到源文件夹中的主tex文件：指定了文件名时使用它；只有一个 tex 文件时自动选择；
+# 有多个时选第一个包含 \documentclass 的文件
+def find_main_tex(folder, main_tex_file=None):
+    tex_files = get_tex_files(folder)
+    if main_tex_file or len(tex_files) <= 1:
+        return main_tex_file
+    for tex_file in sorted(tex_files):
+        with open(tex_file, 'r', encoding='utf-8', errors='ignore') as file:
+            if '\\documentclass' in file.read():
+                return tex_file
+    return None
+
+# 转换一个源文件，在工作进程中运行
+# 转换过程的日志写到 logs/名称.log（每行一条消息）和 logs/名称.jsonl（每行一个事件）；
+# 结果 zip 放到 output_dir 中，工作区用完就删除
+# trace_id 不为 None 时，每个阶段都作为这个 trace 的 span 记录下来（见 tracing.py），各阶段的耗时记在清单中
+def convert_source(name, source_zip, template_zip, template_name, output_dir, main_tex_file=None, trace_id=None):
+    start = time.time()
+    record = {'name': name, 'source': source_zip, 'status': 'succeeded', 'output': None, 'error': None}
+    log_path = os.path.join(output_dir, 'logs', f'{name}.log')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    job_log = JobLog(name)
+    trace = Trace(trace_id) if trace_id else None
+    with job_log_context(job_log), trace_context(trace), Workspace(prefix='batch-') as workspace:
+        try:
+            source_dir, manifest = ingest_zip_with_manifest(source_zip, os.path.join(workspace.path, 'converted_result'))
+            main_tex = find_main_tex(source_dir, main_tex_file)
+            result = convert_latex_project(source_zip, template_zip, main_tex, template_name, workspace,
+                                           source_dir, manifest)
+            output_path = os.path.join(output_dir, f'{name}.zip')
+            shutil.move(result.write_zip(), output_path)
+            record['output'] = os.path.relpath(output_path, output_dir)
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = str(e) or type(e).__name__
+            log(traceback.format_exc(), 'error')
+    with open(log_path, 'w', encoding='utf-8') as file:
+        file.write(job_log.text())
+    with open(os.path.splitext(log_path)[0] + '.jsonl', 'w', encoding='utf-8') as file:
+        for event in job_log.to_list():
+            file.write(json.dumps(event, ensure_ascii=False) + '\n')
+    record['log'] = os.path.relpath(log_path, output_dir)
+    record['seconds'] = round(time.time() - start, 3)
+    if trace is not None:
+        record['timings'] = {name: round(duration, 1) for name, duration in trace.timings().items()}
+    return record
+
+# 打印进度的默认方式
+def print_progress(done, total, record):
+    if record['status'] == 'succeeded':
+        log(f"[{done}/{total}] {record['name']} 成功")
+    else:
+        log(f"[{done}/{total}] {record['name']} 失败: {record['error']}", 'error')
+
+# 把 sources 中的所有源文件转换成 template_zip 模板，结果和清单 batch_manifest.json 写到 output_dir
+# progress 在每个源文件完成后被调用一次：progress(已完成数量, 总数, 这个源文件的记录)
+# 传入 trace_id 时，每个源文件的各阶段都记在这个 trace 中
+# 返回清单（dict）
+def run_batch(sources, template_zip, output_dir, template_name=None, main_tex_file=None,
+              max_workers=BATCH_WORKERS, progress=print_progress, trace_id=None):
+    template_name = template_name or os.path.splitext(os.path.basename(template_zip))[0]
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    started_at = time.time()
+
+    with Workspace(prefix='batch-') as workspace:
+        source_zips = collect_sources(sources, workspace)
+        # 目标模板只准备一次并写成模板包，工作进程中的 get_prepared_template 直接加载这个包
+        get_prepared_template(template_zip)
+
+        records = []
+        if source_zips:
+            # 用 spawn 启动工作进程：API 进程中有多个线程，fork 不安全
+            with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(source_zips))),
+                                     mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {
+                    executor.submit(convert_source, name, source_zip, template_zip, template_name, output_dir,
+                                    main_tex_file, trace_id): name
+                    for name, source_zip in source_zips
+                }
+                for future in as_completed(futures):
+                    try:
+                        record = future.result()
+                    except Exception as e:  # 工作进程异常退出
+                        record = {'name': futures[future], 'status': 'failed', 'output': None,
+                                  'error': str(e) or type(e).__name__}
+                    records.append(record)
+                    if progress is not None:
+                        progress(len(records), len(source_zips), record)
+
+    records.sort(key=lambda record: record['name'])
+    for record in records:
+        record.pop('source', None)  # 工作区中的路径，已经删除了
+    manifest = {
+        'template': template_name,
+        'started_at': started_at,
+        'finished_at': time.time(),
+        'total': len(records),
+        'succeeded': sum(1 for record in records if record['status'] == 'succeeded'),
+        'failed': sum(1 for record in records if record['status'] == 'failed'),
+        'sources': records,
+    }
+    with open(os.path.join(output_dir, MANIFEST_FILE_NAME), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# 命令行入口
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='把多个 LaTeX 源文件批量转换成同一个模板')
+    parser.add_argument('sources', help='源文件夹（每个 .zip 或子文件夹是一个源文件）或装着多个源文件的 zip')
+    parser.add_argument('template', help='目标模板名称（templates 文件夹中的 zip，不带 .zip）')
+    parser.add_argument('-o', '--output', default='./batch_result', help='结果文件夹，默认 ./batch_result')
+    parser.add_argument('-j', '--jobs', type=int, default=BATCH_WORKERS, help=f'同时转换的进程数，默认 {BATCH_WORKERS}')
+    parser.add_argument('--main-tex', default=None, help='源文件的主 tex 文件名（所有源文件相同时使用）')
+    parser.add_argument('--templates', default=TEMPLATE_FOLDER, help=f'模板文件夹，默认 {TEMPLATE_FOLDER}')
+    parser.add_argument('--trace', action='store_true',
+                        help='记录每个阶段的耗时到清单中（设置 LATEX_CONVERTER_TRACE_FILE 时同时导出到这个文件）')
+    args = parser.parse_args(argv)
+
+    registry = get_template_registry(args.templates)
+    template_zip_name = f'{args.template}.zip'
+    if template_zip_name not in registry:
+        parser.error(f"找不到模板 {args.template}，可用的模板: {', '.join(registry.names())}")
+
+    manifest = run_batch(args.sources, registry.zip_path(template_zip_name), args.output, args.template,
+                         args.main_tex, args.jobs, trace_id=uuid.uuid4().hex if args.trace else None)
+    print(f"完成：{manifest['succeeded']} 个成功，{manifest['failed']} 个失败，清单见 "
+          f"{os.path.join(os.path.abspath(args.output), MANIFEST_FILE_NAME)}")
+    return 0 if not manifest['failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# 这个文件用来放编译结果的缓存
+# 以前每次点击 "显示 PDF Preview" 都从头编译，上一次编译留下的 .aux、.bbl、.toc 也不会被复用
+# 现在按转换结果的内容哈希（加上编译方式和主 tex 文件）保存 PDF 和辅助文件：
+#   1. 项目没有变化时直接返回缓存的 PDF，不运行任何命令
+#   2. 项目有变化时，先把同一个项目（project）上一次编译的辅助文件放回去再编译，
+#      compile_engine.py 发现 .aux 没有变化、引用也没有变化时只需要一遍 LaTeX
+
+# 导入包
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from joblog import log
+from compile_engine import AUX_EXTENSIONS, CompileResult, compile_project, run_command, state_path
+
+
+# 缓存文件夹，以及最多占用多少字节、保存多久，可以用环境变量修改
+COMPILE_CACHE_DIR = os.environ.get('COMPILE_CACHE_DIR', './compile_cache')
+COMPILE_CACHE_MAX_BYTES = int(os.environ.get('COMPILE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+COMPILE_CACHE_TTL = int(os.environ.get('COMPILE_CACHE_TTL', str(7 * 24 * 3600)))
+
+# 编译产生的文件（jobname 加这些后缀），不计入项目的内容哈希；除了 PDF 和 .log 都会在下一次编译时放回去
+OUTPUT_EXTENSIONS = AUX_EXTENSIONS + ('.bbl', '.blg', '.log', '.pdf', '.synctex.gz', '.fls', '.xdv', '.fdb_latexmk')
+META_FILE_NAME = 'meta.json'
+
+
+# 编译产生的文件（相对于项目文件夹的路径）
+def is_build_output(relative_path, jobname):
+    name = os.path.basename(relative_path)
+    if name.endswith('.aux') or name == os.path.basename(state_path('', jobname)):
+        return True
+    return os.path.dirname(relative_path) == '' and any(name == jobname + extension for extension in OUTPUT_EXTENSIONS)
+
+# 项目文件夹中的源文件（排除编译产生的文件），按相对路径排序
+def source_files(folder, jobname):
+    files = []
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        for name in names:
+            relative_path = os.path.relpath(os.path.join(root, name), folder)
+            if not is_build_output(relative_path, jobname):
+                files.append(relative_path)
+    return sorted(files)
+
+# 项目的内容哈希：所有源文件的路径和内容，加上编译方式和主 tex 文件
+def compile_cache_key(method, main_tex_file, folder):
+    jobname = os.path.splitext(os.path.basename(main_tex_file))[0]
+    sha256 = hashlib.sha256(f'{method}\0{main_tex_file}\0'.encode('utf-8'))
+    for relative_path in source_files(folder, jobname):
+        sha256.update(relative_path.replace(os.sep, '/').encode('utf-8') + b'\0')
+        with open(os.path.join(folder, relative_path), 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        sha256.update(b'\0')
+    return sha256.hexdigest()
+
+# 复制 source 中 relative_paths 这些文件到 target
+def _copy_files(source, target, relative_paths):
+    for relative_path in relative_paths:
+        target_path = os.path.join(target, relative_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.copyfile(os.path.join(source, relative_path), target_path)
+
+
+# 编译缓存
+# entries/键/ 中是一次编译产生的文件和 meta.json（编译结果、大小），projects/项目哈希.json 记录这个项目最后一次编译的键
+# meta.json 的修改时间是创建时间（用于过期），访问时间是最后一次使用的时间（用于 LRU），和 result_cache.py 一样
+class CompileCache:
+    def __init__(self, directory=COMPILE_CACHE_DIR, max_bytes=COMPILE_CACHE_MAX_BYTES, ttl=COMPILE_CACHE_TTL):
+        self.directory = os.path.abspath(directory)
+        self.entries_dir = os.path.join(self.directory, 'entries')
+        self.projects_dir = os.path.join(self.directory, 'projects')
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.projects_dir, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.entries_dir, key)
+
+    def _project(self, project):
+        return os.path.join(self.projects_dir, hashlib.sha256(project.encode('utf-8')).hexdigest() + '.json')
+
+    def _load_meta(self, entry):
+        try:
+            with open(os.path.join(entry, META_FILE_NAME), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    # 读取缓存项的 meta.json，不存在或过期时返回 None；touch 为 True 时记录这次使用
+    def _lookup(self, key, touch=True):
+        entry = self._entry(key)
+        meta_path = os.path.join(entry, META_FILE_NAME)
+        try:
+            stat = os.stat(meta_path)
+        except FileNotFoundError:
+            return None
+        if time.time() - stat.st_mtime > self.ttl:
+            self._remove(entry)
+            return None
+        meta = self._load_meta(entry)
+        if meta is not None and touch:
+            os.utime(meta_path, (time.time(), stat.st_mtime))
+        return meta
+
+    # 缓存命中时把 PDF 和辅助文件复制到 folder，返回缓存的编译结果（dict）；没有命中时返回 None
+    def get(self, key, folder):
+        with self.lock:
+            meta = self._lookup(key)
+            if meta is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        _copy_files(self._entry(key), folder, meta['files'])
+        return meta['result']
+
+    # 把 project 上一次编译的辅助文件（不包括 PDF 和 .log）放到 folder 中，返回放回去的文件
+    # folder 中已经有 .aux 时（同一个文件夹编译过）不覆盖
+    def restore_previous(self, project, folder, jobname):
+        if os.path.exists(os.path.join(folder, jobname + '.aux')):
+            return []
+        try:
+            with open(self._project(project), 'r', encoding='utf-8') as file:
+                key = json.load(file)['key']
+        except (OSError, ValueError, KeyError):
+            return []
+        with self.lock:
+            meta = self._lookup(key, touch=False)
+        if meta is None:
+            return []
+        skipped = {jobname + '.pdf', jobname + '.log'}
+        files = [relative_path for relative_path in meta['files'] if relative_path not in skipped]
+        try:
+            _copy_files(self._entry(key), folder, files)
+        except FileNotFoundError:  # 复制时缓存项被清理了
+            return []
+        return files
+
+    # 保存 folder 中编译产生的文件；project 不为 None 时记为这个项目最后一次编译
+    def put(self, key, folder, result, project=None):
+        files = self._output_files(folder, result.jobname)
+        temp_dir = tempfile.mkdtemp(dir=self.entries_dir, suffix='.tmp')
+        try:
+            _copy_files(folder, temp_dir, files)
+            size = sum(os.path.getsize(os.path.join(temp_dir, relative_path)) for relative_path in files)
+            with open(os.path.join(temp_dir, META_FILE_NAME), 'w', encoding='utf-8') as file:
+                json.dump({'files': files, 'size': size, 'result': result.to_dict()}, file, ensure_ascii=False)
+            entry = self._entry(key)
+            with self.lock:
+                if os.path.exists(entry):
+                    self._remove(entry)
+                os.replace(temp_dir, entry)
+        finally:
+            if os.path.exists(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if project is not None:
+            fd, temp_path = tempfile.mkstemp(dir=self.projects_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump({'key': key}, file)
+            os.replace(temp_path, self._project(project))
+        self.evict()
+
+    # folder 中编译产生的文件（相对路径）
+    def _output_files(self, folder, jobname):
+        files = []
+        for root, _, names in os.walk(folder):
+            for name in names:
+                relative_path = os.path.relpath(os.path.join(root, name), folder)
+                if is_build_output(relative_path, jobname):
+                    files.append(relative_path)
+        return sorted(files)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.entries_dir):
+            if name.endswith('.tmp'):
+                continue
+            entry = self._entry(name)
+            try:
+                stat = os.stat(os.path.join(entry, META_FILE_NAME))
+            except FileNotFoundError:
+                continue
+            meta = self._load_meta(entry) or {}
+            entries.append({'key': name, 'size': meta.get('size', 0), 'created_at': stat.st_mtime,
+                            'last_used_at': stat.st_atime})
+        return entries
+
+    # 先删除过期的缓存项，再按最近最少使用删除，直到总大小不超过 max_bytes
+    def evict(self):
+        with self.lock:
+            now = time.time()
+            entries = self.entries()
+            for entry in entries:
+                if now - entry['created_at'] > self.ttl:
+                    self._remove(self._entry(entry['key']))
+            entries = sorted((e for e in entries if now - e['created_at'] <= self.ttl), key=lambda e: e['last_used_at'])
+            total = sum(entry['size'] for entry in entries)
+            while entries and total > self.max_bytes:
+                entry = entries.pop(0)
+                self._remove(self._entry(entry['key']))
+                total -= entry['size']
+
+    def stats(self):
+        entries = self.entries()
+        with self.lock:
+            return {
+                'directory': self.directory,
+                'entries': len(entries),
+                'bytes': sum(entry['size'] for entry in entries),
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _remove(self, entry):
+        if not os.path.exists(entry):
+            return False
+        shutil.rmtree(entry, ignore_errors=True)
+        return True
+
+
+_compile_cache = None
+_compile_cache_lock = threading.Lock()
+
+
+# 进程中共用的编译缓存
+def get_compile_cache():
+    global _compile_cache
+    with _compile_cache_lock:
+        if _compile_cache is None:
+            _compile_cache = CompileCache()
+        return _compile_cache
+
+# 带缓存的 compile_project
+# project 是这个项目的标识（例如 源文件名 + 目标模板 + 主 tex 文件），项目内容变化后用它找到上一次编译的辅助文件
+def compile_with_cache(method, main_tex_file, folder_path, project=None, cache=None, max_passes=None,
+                       runner=run_command):
+    cache = cache or get_compile_cache()
+    folder = os.path.abspath(folder_path)
+    jobname = os.path.splitext(os.path.basename(main_tex_file))[0]
+    if not os.path.exists(os.path.join(folder, main_tex_file)):
+        return compile_project(method, main_tex_file, folder, max_passes, runner)
+
+    key = compile_cache_key(method, main_tex_file, folder)
+    cached = cache.get(key, folder)
+    if cached is not None:
+        log("项目没有变化，使用缓存的编译结果")
+        result = CompileResult(folder, jobname)
+        result.cached = True
+        result.error = cached.get('error')
+        return result
+
+    if project is not None:
+        restored = cache.restore_previous(project, folder, jobname)
+        if restored:
+            log(f"使用上一次编译的辅助文件: {', '.join(restored)}")
+
+    result = compile_project(method, main_tex_file, folder, max_passes, runner)
+    if result.pdf() is not None:
+        cache.put(key, folder, result, project)
+    return result
@@ -0,0 +1,271 @@
+# 这个文件用来放按依赖决定运行哪些步骤的 LaTeX 编译
+# 以前 compile_latex 按编译方式运行固定的命令列表："xelatex -> bibtex -> xelatex*2" 每次都运行 4 个进程，
+# 即使 .aux 和 .bbl 根本没有变化；而且不管主 tex 文件叫什么，都运行 bibtex main
+# 现在：
+#   1. jobname 从主 tex 文件名得到（paper.tex -> paper.aux、paper.pdf、bibtex paper）
+#   2. 只有引用（.aux 中的 \citation、\bibdata、\bibstyle）或 .bib/.bst 文件变化时才运行 bibtex，
+#      上一次运行 bibtex 时的依赖哈希记在 .jobname.compile.json 中
+#   3. 每一遍之后比较 .aux/.toc/.out 等辅助文件的哈希，没有变化就不再重新运行 LaTeX，最多运行 max_passes 遍
+#   4. 返回实际运行的每一遍（命令、原因、耗时、返回码）
+#   5. 主 tex 文件以某个目标模板的导言区开头时，使用这个导言区的预编译格式（见 template_format.py）
+
+# 导入包
+import os
+import re
+import json
+import time
+import hashlib
+import subprocess
+
+from joblog import log
+from function import replace_file
+from tracing import span
+from template_format import format_failed, prepare_format_compile
+
+
+# 编译方式：(LaTeX 引擎, 是否处理参考文献, 最多运行几遍 LaTeX)
+# 不带 bibtex 的编译方式保留原来的遍数作为上限；None 表示使用 COMPILE_MAX_PASSES
+COMPILE_METHODS = {
+    'pdflatex': ('pdflatex', False, 1),
+    'xelatex': ('xelatex', False, 1),
+    'xelatex*2': ('xelatex', False, 2),
+    'xelatex -> bibtex -> xelatex*2': ('xelatex', True, None),
+}
+# 辅助文件没有稳定下来时最多运行几遍 LaTeX，可以用环境变量 COMPILE_MAX_PASSES 修改
+COMPILE_MAX_PASSES = int(os.environ.get('COMPILE_MAX_PASSES', '4'))
+# 决定是否需要再运行一遍 LaTeX 的辅助文件（jobname 加这些后缀），\include 的文件各自的 .aux 也算在内
+AUX_EXTENSIONS = ('.aux', '.toc', '.out', '.lof', '.lot', '.nav', '.snm')
+
+BIB_LINE_PATTERN = re.compile(r'^\\(?:citation|bibdata|bibstyle)\{.*\}\s*$', re.MULTILINE)
+BIBDATA_PATTERN = re.compile(r'^\\bibdata\{([^}]*)\}', re.MULTILINE)
+BIBSTYLE_PATTERN = re.compile(r'^\\bibstyle\{([^}]*)\}', re.MULTILINE)
+
+
+# 一遍编译（一条命令）
+class CompilePass:
+    __slots__ = ('command', 'reason', 'returncode', 'seconds', 'output')
+
+    def __init__(self, command, reason, returncode=None, seconds=None, output=''):
+        self.command = command
+        self.reason = reason  # 为什么运行这一遍
+        self.returncode = returncode
+        self.seconds = seconds
+        self.output = output  # 命令的输出（stdout 和 stderr）
+
+    @property
+    def program(self):
+        return self.command[0]
+
+    def to_dict(self):
+        return {'command': ' '.join(self.command), 'reason': self.reason, 'returncode': self.returncode,
+                'seconds': round(self.seconds, 3) if self.seconds is not None else None}
+
+
+# 一次编译的结果
+class CompileResult:
+    def __init__(self, folder, jobname):
+        self.folder = folder
+        self.jobname = jobname
+        self.passes = []
+        self.cached = False  # 为 True 时结果直接来自编译缓存（见 compile_cache.py），没有运行任何命令
+        self.usage = None  # 在编译任务池中运行时用掉的资源（见 compile_pool.py）
+        self.error = None  # 出错时的说明，和以前 compile_latex 返回的 "Error ..." 字符串一样
+
+    @property
+    def pdf_path(self):
+        return os.path.join(self.folder, self.jobname + '.pdf')
+
+    # 生成了 PDF 时返回 PDF 路径，否则返回 None（LaTeX 报错但仍生成 PDF 时也返回路径）
+    def pdf(self):
+        return self.pdf_path if os.path.exists(self.pdf_path) else None
+
+    @property
+    def latex_passes(self):
+        return sum(1 for compile_pass in self.passes if compile_pass.program != 'bibtex')
+
+    def summary(self):
+        if self.cached:
+            return '项目没有变化，使用缓存的编译结果'
+        return ', '.join(f'{compile_pass.program}（{compile_pass.reason}）' for compile_pass in self.passes) or '无需编译'
+
+    def to_dict(self):
+        return {'jobname': self.jobname, 'pdf': self.pdf(), 'error': self.error, 'cached': self.cached,
+                'usage': self.usage, 'passes': [compile_pass.to_dict() for compile_pass in self.passes]}
+
+
+# 运行一条命令，返回 (返回码, 输出)
+def run_command(command, cwd):
+    result = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, errors='replace')
+    return result.returncode, result.stdout
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _read_bytes(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+# 主 .aux 文件以及 \include 的文件各自的 .aux 文件
+def aux_files(folder, jobname):
+    paths = [os.path.join(folder, jobname + '.aux')]
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith('.aux') and path not in paths:
+                paths.append(path)
+    return paths
+
+# 辅助文件的哈希 {文件路径: 哈希}，不存在的文件不在其中
+def aux_hashes(folder, jobname):
+    paths = aux_files(folder, jobname)
+    paths += [os.path.join(folder, jobname + extension) for extension in AUX_EXTENSIONS if extension != '.aux']
+    hashes = {}
+    for path in paths:
+        data = _read_bytes(path)
+        if data is not None:
+            hashes[os.path.relpath(path, folder)] = _sha256(data)
+    return hashes
+
+# 决定是否需要运行 bibtex 的依赖哈希：所有 .aux 中的 \citation/\bibdata/\bibstyle 行，加上项目中的 .bib 和 .bst 文件
+# .aux 中没有 \bibdata 时（文档没有参考文献）返回 None
+def bibliography_key(folder, jobname):
+    lines = []
+    databases = []
+    styles = []
+    for path in aux_files(folder, jobname):
+        data = _read_bytes(path)
+        if data is None:
+            continue
+        text = data.decode('utf-8', errors='replace')
+        lines.extend(BIB_LINE_PATTERN.findall(text))
+        for match in BIBDATA_PATTERN.findall(text):
+            databases.extend(name.strip() for name in match.split(',') if name.strip())
+        styles.extend(name.strip() for name in BIBSTYLE_PATTERN.findall(text))
+    if not databases:
+        return None
+
+    sha256 = hashlib.sha256('\n'.join(lines).encode('utf-8'))
+    for name, extension in [(name, '.bib') for name in databases] + [(name, '.bst') for name in styles]:
+        file_name = name if name.endswith(extension) else name + extension
+        # 项目中没有的 .bib/.bst（TeX 发行版中的文件）不会变化，只按名称计入
+        data = _read_bytes(os.path.join(folder, file_name))
+        sha256.update(f'\0{file_name}\0'.encode('utf-8'))
+        sha256.update(_sha256(data).encode('ascii') if data is not None else b'-')
+    return sha256.hexdigest()
+
+# 记录上一次编译状态的文件（上一次运行 bibtex 时的依赖哈希）
+def state_path(folder, jobname):
+    return os.path.join(folder, f'.{jobname}.compile.json')
+
+def load_state(folder, jobname):
+    data = _read_bytes(state_path(folder, jobname))
+    if data is None:
+        return {}
+    try:
+        return json.loads(data)
+    except ValueError:
+        return {}
+
+# 先写临时文件再替换，编译中途被终止时不会留下写了一半的状态文件
+def save_state(folder, jobname, state):
+    with replace_file(state_path(folder, jobname), encoding='utf-8') as file:
+        json.dump(state, file)
+
+# 变化了的辅助文件，用于说明为什么再运行一遍
+def _changed(before, after):
+    names = sorted(set(before) | set(after))
+    return [name for name in names if before.get(name) != after.get(name)]
+
+
+# 在 folder 中编译 main_tex_file（相对于 folder 的路径），返回 CompileResult
+# max_passes 为 None 时使用编译方式的上限；runner(command, cwd) 运行一条命令并返回 (返回码, 输出)
+# use_format 为 True 时尽量使用目标模板导言区的预编译格式，格式本身不可用时自动改用原来的方式
+def compile_project(method, main_tex_file, folder_path, max_passes=None, runner=run_command, use_format=True):
+    folder = os.path.abspath(folder_path)
+    jobname = os.path.splitext(os.path.basename(main_tex_file))[0]
+    result = CompileResult(folder, jobname)
+
+    if not os.path.exists(os.path.join(folder, main_tex_file)):
+        result.error = f"Error: {os.path.join(folder, main_tex_file)} not found."
+        return result
+    if method not in COMPILE_METHODS:
+        result.error = "Invalid method"
+        return result
+
+    engine, use_bibtex, method_max_passes = COMPILE_METHODS[method]
+    max_passes = max_passes or method_max_passes or COMPILE_MAX_PASSES
+    plain_command = [engine, '-interaction=nonstopmode', main_tex_file]
+    latex_command = plain_command
+    state = load_state(folder, jobname)
+
+    format_compile = prepare_format_compile(engine, main_tex_file, folder, jobname) if use_format else None
+    format_files = []
+    driver = None
+    if format_compile is not None:
+        format_name, driver, format_files = format_compile
+        # -jobname 保持输出文件名不变（jobname.aux、jobname.pdf）
+        latex_command = [engine, '-interaction=nonstopmode', f'-fmt={format_name}', f'-jobname={jobname}', driver]
+
+    def run(command, reason):
+        compile_pass = CompilePass(command, reason)
+        result.passes.append(compile_pass)
+        log(f"运行 {' '.join(command)}：{reason}")
+        start = time.perf_counter()
+        with span(command[0], reason=reason):
+            compile_pass.returncode, compile_pass.output = runner(command, folder)
+        compile_pass.seconds = time.perf_counter() - start
+        if compile_pass.returncode != 0:
+            result.error = f"Error in {command[0]}: {compile_pass.output[-2000:]}"
+            log(f"{command[0]} 返回 {compile_pass.returncode}", 'warning')
+        return compile_pass.returncode == 0
+
+    reason = '第一遍'
+    bbl_path = os.path.join(folder, jobname + '.bbl')
+    try:
+        while True:
+            before = aux_hashes(folder, jobname)
+            bbl_before = _read_bytes(bbl_path)
+            if not run(latex_command, reason):
+                if latex_command is not plain_command and format_failed(result.passes[-1].output, driver):
+                    # 格式文件和当前的 TeX 不兼容，或者在格式中的导言区就出错了
+                    log("预编译格式不可用，改用原来的方式编译", 'warning')
+                    latex_command, result.error = plain_command, None
+                    reason = '预编译格式不可用'
+                    max_passes += 1  # 出错的这一遍不算在上限内
+                    continue
+                break  # LaTeX 出错时再运行也是同样的错误
+            after = aux_hashes(folder, jobname)
+            bbl_changed = False
+
+            if use_bibtex:
+                key = bibliography_key(folder, jobname)
+                if key is not None and (key != state.get('bibliography') or not os.path.exists(bbl_path)):
+                    if not run(['bibtex', jobname], '引用或 .bib 文件有变化'):
+                        break
+                    state['bibliography'] = key
+                    save_state(folder, jobname, state)
+                    bbl_changed = _read_bytes(bbl_path) != bbl_before
+
+            changed = _changed(before, after)
+            if not changed and not bbl_changed:
+                break
+            if result.latex_passes >= max_passes:
+                if use_bibtex or max_passes > 1:
+                    log(f"辅助文件在 {max_passes} 遍后仍有变化，停止编译", 'warning')
+                break
+            reason = '.bbl 有变化' if bbl_changed and not changed else f"{', '.join(changed)} 有变化"
+    finally:
+        for path in format_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+    pdf = result.pdf()
+    if pdf is None and result.error is None:
+        result.error = "Error: PDF not generated."
+    log(f"编译完成：运行了 {result.latex_passes} 遍 {engine}，共 {len(result.passes)} 条命令")
+    return result
@@ -0,0 +1,314 @@
+# 这个文件用来放隔离运行的编译任务池
+# 以前 compile_latex 直接用 subprocess.run 在共用的 ./converted_result 中运行 xelatex/pdflatex，没有超时也没有资源限制：
+# 一个失控的文档（无限 \loop、很大的 TikZ 图）会一直占着一个 CPU，Streamlit 会话也一直卡住
+# 现在编译任务提交到一个固定大小的任务池（COMPILE_WORKERS 个同时运行）：
+#   1. 每个任务把项目复制到自己的工作区中编译，编译产生的文件（PDF、.aux 等）最后再复制回项目文件夹
+#   2. 每条命令在自己的进程组中运行，带 CPU 时间、内存、输出文件大小的 rlimit；整个任务有墙钟时间上限
+#   3. 超时或取消时杀掉整个进程组（包括 LaTeX 启动的子进程）
+#   4. 每个任务报告用掉的资源（墙钟时间、用户/系统 CPU 时间、内存峰值）
+
+# 导入包
+import os
+import time
+import uuid
+import shutil
+import sys
+import signal
+import threading
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 和进程组，只限制墙钟时间
+    resource = None
+
+from function import reflink_file, copy_file
+from joblog import log
+from compile_engine import compile_project
+from compile_cache import compile_with_cache, is_build_output
+from workspace import Workspace
+
+
+# 同时运行的编译任务数，以及每个任务的限制，可以用环境变量修改
+COMPILE_WORKERS = int(os.environ.get('COMPILE_WORKERS', '2'))
+COMPILE_TIMEOUT = float(os.environ.get('COMPILE_TIMEOUT', '120'))  # 整个任务的墙钟时间（秒）
+COMPILE_CPU_LIMIT = int(os.environ.get('COMPILE_CPU_LIMIT', '120'))  # 每条命令的 CPU 时间（秒）
+COMPILE_MEMORY_LIMIT = int(os.environ.get('COMPILE_MEMORY_LIMIT', str(4 * 1024 * 1024 * 1024)))  # 每条命令的地址空间（字节）
+COMPILE_FILE_SIZE_LIMIT = int(os.environ.get('COMPILE_FILE_SIZE_LIMIT', str(1024 * 1024 * 1024)))  # 每个输出文件的大小（字节）
+
+# 在新进程中设置 rlimit 后 exec 真正的命令：参数依次是 CPU 秒数、地址空间、输出文件大小（0 表示不限制），然后是命令
+# 不用 preexec_fn：进程中有多个线程时，fork 之后、exec 之前运行 Python 代码可能死锁
+SETRLIMIT_SHIM = (
+    "import os, sys, resource\n"
+    "cpu, memory, file_size = (int(value) for value in sys.argv[1:4])\n"
+    "if cpu: resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))\n"
+    "if memory: resource.setrlimit(resource.RLIMIT_AS, (memory, memory))\n"
+    "if file_size: resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))\n"
+    "resource.setrlimit(resource.RLIMIT_CORE, (0, 0))\n"
+    "os.execvp(sys.argv[4], sys.argv[4:])\n"
+)
+
+# 命令被杀掉时的返回码
+KILLED_RETURNCODE = -signal.SIGKILL if hasattr(signal, 'SIGKILL') else -9
+
+
+# 一个任务的资源限制，0 表示不限制
+class CompileLimits:
+    def __init__(self, timeout=COMPILE_TIMEOUT, cpu_seconds=COMPILE_CPU_LIMIT, memory_bytes=COMPILE_MEMORY_LIMIT,
+                 file_size_bytes=COMPILE_FILE_SIZE_LIMIT):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.file_size_bytes = file_size_bytes
+
+    # 带上 rlimit 的命令：通过 SETRLIMIT_SHIM 设置限制后 exec 原来的命令
+    # CPU 超过软限制时收到 SIGXCPU，再多 1 秒收到 SIGKILL
+    def wrap(self, command):
+        if resource is None:
+            return command
+        return [sys.executable, '-c', SETRLIMIT_SHIM, str(int(self.cpu_seconds or 0)), str(int(self.memory_bytes or 0)),
+                str(int(self.file_size_bytes or 0))] + list(command)
+
+
+# 一个任务用掉的资源，所有命令加在一起
+class CompileUsage:
+    def __init__(self):
+        self.commands = 0
+        self.wall = 0.0  # 整个任务的墙钟时间（秒），包括复制文件
+        self.user_cpu = 0.0
+        self.system_cpu = 0.0
+        self.max_rss_kb = 0  # 单条命令的内存峰值中最大的一个
+
+    def add(self, rusage):
+        self.commands += 1
+        if rusage is not None:
+            self.user_cpu += rusage.ru_utime
+            self.system_cpu += rusage.ru_stime
+            self.max_rss_kb = max(self.max_rss_kb, rusage.ru_maxrss)
+
+    def to_dict(self):
+        return {'commands': self.commands, 'wall': round(self.wall, 3), 'user_cpu': round(self.user_cpu, 3),
+                'system_cpu': round(self.system_cpu, 3), 'max_rss_kb': self.max_rss_kb}
+
+
+# 杀掉进程组中的所有进程
+def kill_process_group(process):
+    try:
+        if resource is not None:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+# 把项目复制到任务自己的文件夹：能 reflink 时用 reflink（写时复制），否则完整复制
+# 不用硬链接，LaTeX 写文件时会直接改写已有的文件，硬链接会把修改带回原项目
+def copy_project(source_folder, target_folder):
+    for root, _, files in os.walk(source_folder):
+        target_root = os.path.join(target_folder, os.path.relpath(root, source_folder))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            source_path, target_path = os.path.join(root, file), os.path.join(target_root, file)
+            if not reflink_file(source_path, target_path):
+                shutil.copy2(source_path, target_path)
+
+# 把编译产生的文件复制回项目文件夹
+def copy_build_outputs(job_folder, folder, jobname):
+    copied = []
+    for root, _, files in os.walk(job_folder):
+        for file in files:
+            relative_path = os.path.relpath(os.path.join(root, file), job_folder)
+            if is_build_output(relative_path, jobname):
+                target_path = os.path.join(folder, relative_path)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                copy_file(os.path.join(job_folder, relative_path), target_path)
+                copied.append(relative_path)
+    return copied
+
+
+# 一个编译任务
+class CompileJob:
+    def __init__(self, method, main_tex_file, folder, project=None, use_cache=True, limits=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.main_tex_file = main_tex_file
+        self.folder = os.path.abspath(folder)
+        self.project = project
+        self.use_cache = use_cache
+        self.limits = limits or CompileLimits()
+        self.usage = CompileUsage()
+        self.workspace = None
+        self.future = None
+        self.deadline = None  # 开始运行后才计时，排队的时间不算
+        self.timed_out = False
+        self.cancelled = threading.Event()
+        self.process = None  # 正在运行的命令
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        if not self.limits.timeout or self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    # 取消任务：还在排队时不再运行，正在运行时杀掉当前命令的整个进程组
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+        self._kill()
+
+    def _kill(self):
+        with self.lock:
+            process = self.process
+        if process is not None:
+            kill_process_group(process)
+
+    def _timeout(self):
+        self.timed_out = True
+        self._kill()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    # compile_project 的 runner：在进程组中运行一条命令，带 rlimit 和剩余的墙钟时间
+    def run_command(self, command, cwd):
+        remaining = self.remaining()
+        if self.cancelled.is_set():
+            return KILLED_RETURNCODE, '编译已取消'
+        if remaining is not None and remaining <= 0:
+            self.timed_out = True
+            return KILLED_RETURNCODE, f'编译超过 {self.limits.timeout:g} 秒'
+
+        output_path = self.workspace.file(f'output-{self.usage.commands}.txt')
+        with open(output_path, 'wb') as output:
+            process = subprocess.Popen(
+                self.limits.wrap(command), cwd=cwd, stdin=subprocess.DEVNULL, stdout=output,
+                stderr=subprocess.STDOUT, start_new_session=resource is not None,
+            )
+        with self.lock:
+            self.process = process
+        # 取消可能发生在启动命令的同时
+        if self.cancelled.is_set():
+            kill_process_group(process)
+        timer = threading.Timer(remaining, self._timeout) if remaining is not None else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+        try:
+            if hasattr(os, 'wait4'):
+                _, status, rusage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+            else:
+                process.wait()
+                rusage = None
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self.lock:
+                self.process = None
+            # 命令结束后还留在进程组中的子进程
+            kill_process_group(process)
+        self.usage.add(rusage)
+
+        with open(output_path, 'r', encoding='utf-8', errors='replace') as output:
+            text = output.read()
+        if self.timed_out:
+            text += f'\n编译超过 {self.limits.timeout:g} 秒，已终止'
+        elif self.cancelled.is_set():
+            text += '\n编译已取消'
+        return process.returncode, text
+
+
+# 编译任务池
+class CompilePool:
+    def __init__(self, max_workers=COMPILE_WORKERS, limits=None):
+        self.max_workers = max_workers
+        self.limits = limits or CompileLimits()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='compile')
+        self.lock = threading.Lock()
+        self.jobs = {}  # 还没有结束的任务 {任务 id: CompileJob}
+
+    # 提交一个编译任务，返回 CompileJob；job.result() 返回 CompileResult，其中的 usage 是用掉的资源
+    # project 和 use_cache 见 compile_cache.py
+    def submit(self, method, main_tex_file, folder, project=None, use_cache=True, limits=None):
+        job = CompileJob(method, main_tex_file, folder, project, use_cache, limits or self.limits)
+        with self.lock:
+            self.jobs[job.id] = job
+        # 线程池中的线程不会继承 contextvars，任务在调用者上下文的副本中运行（例如当前任务的日志，见 joblog.py）
+        job.future = self.executor.submit(contextvars.copy_context().run, self._run, job)
+        job.future.add_done_callback(lambda _: self._finished(job))
+        return job
+
+    def _finished(self, job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def _run(self, job):
+        start = time.monotonic()
+        if job.limits.timeout:
+            job.deadline = start + job.limits.timeout
+        jobname = os.path.splitext(os.path.basename(job.main_tex_file))[0]
+        if not os.path.exists(os.path.join(job.folder, job.main_tex_file)):
+            return compile_project(job.method, job.main_tex_file, job.folder)  # 只返回找不到文件的错误
+        with Workspace(prefix='compile-') as workspace:
+            job.workspace = workspace
+            job_folder = workspace.subdir('project')
+            copy_project(job.folder, job_folder)
+            if job.use_cache:
+                result = compile_with_cache(job.method, job.main_tex_file, job_folder, job.project,
+                                            runner=job.run_command)
+            else:
+                result = compile_project(job.method, job.main_tex_file, job_folder, runner=job.run_command)
+            copy_build_outputs(job_folder, job.folder, jobname)
+        result.folder = job.folder
+        job.usage.wall = time.monotonic() - start
+        result.usage = job.usage.to_dict()
+
+        if job.timed_out:
+            result.error = f"Error: 编译超过 {job.limits.timeout:g} 秒，已终止"
+        elif job.cancelled.is_set():
+            result.error = "Error: 编译已取消"
+        usage = result.usage
+        log(f"编译任务 {job.id} 用时 {usage['wall']:.2f}s，CPU {usage['user_cpu'] + usage['system_cpu']:.2f}s，"
+            f"内存峰值 {usage['max_rss_kb'] // 1024} MB，共 {usage['commands']} 条命令")
+        return result
+
+    def status(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        running = [job for job in jobs if job.deadline is not None]
+        return {'workers': self.max_workers, 'running': len(running), 'queued': len(jobs) - len(running)}
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            with self.lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                job.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=cancel)
+
+
+_compile_pool = None
+_compile_pool_lock = threading.Lock()
+
+
+# 进程中共用的编译任务池
+def get_compile_pool():
+    global _compile_pool
+    with _compile_pool_lock:
+        if _compile_pool is None:
+            _compile_pool = CompilePool()
+        return _compile_pool
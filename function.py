@@ -4,18 +4,205 @@
 import os
 import shutil
 import re
+import time
+import hashlib
+import uuid
+import zipfile
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只能用硬链接或复制
+    fcntl = None
+
+from texindex import BraceIndex, AnchorIndex, PackageIndex, PROVIDES_PACKAGE_PATTERN
+from joblog import log, log_transform, count_changed_lines
+from tracing import traced, count_read, count_written
 
 
 # 对文件、文件夹操作的一些基本函数
 
 # 创建文件夹副本
-def create_copy_folder(folder_path, copy_folder_path):
+# mode 为 'copy' 时完整复制；为 'clone' 时用 clone_tree 克隆（reflink 或硬链接，只有写入时才真正复制）
+@traced
+def create_copy_folder(folder_path, copy_folder_path, mode='copy'):
     # 检查备份文件夹是否已经存在，若存在则删除
     if os.path.exists(copy_folder_path):
         shutil.rmtree(copy_folder_path)
-    # 复制整个文件夹
-    shutil.copytree(folder_path, copy_folder_path)
-    print(f"备份已成功创建: {copy_folder_path}")
+    if mode == 'clone':
+        clone_tree(folder_path, copy_folder_path)
+    else:
+        # 复制整个文件夹
+        shutil.copytree(folder_path, copy_folder_path)
+    log(f"备份已成功创建: {copy_folder_path}")
+
+# Linux 上 reflink 用的 ioctl 编号（btrfs、xfs 等支持写时复制的文件系统）
+FICLONE = 0x40049409
+
+# 用 reflink 克隆一个文件，文件系统不支持时返回 False
+def reflink_file(source_path, target_path):
+    if fcntl is None:
+        return False
+    with open(source_path, 'rb') as source:
+        with open(target_path, 'xb') as target:
+            try:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            except OSError:
+                reflinked = False
+            else:
+                reflinked = True
+    if not reflinked:
+        os.remove(target_path)
+        return False
+    shutil.copystat(source_path, target_path)
+    return True
+
+# 克隆一个文件：先试 reflink（真正的写时复制），再试硬链接，都不行时才复制
+# 返回实际使用的方式：'reflink'、'hardlink' 或 'copy'
+def clone_file(source_path, target_path):
+    if reflink_file(source_path, target_path):
+        return 'reflink'
+    try:
+        os.link(source_path, target_path)
+        return 'hardlink'
+    except OSError:
+        shutil.copy2(source_path, target_path)
+        return 'copy'
+
+# 克隆整个文件夹，耗时只和文件个数有关，和文件大小无关
+# 硬链接和原文件共用同一份数据，所以克隆出来的文件只能用 replace_file 写入（写到新文件再替换），不能原地修改；
+# 转换流程中所有写文件的地方（write_file、install_template_assets 等）都是这样做的
+# 返回每种方式克隆的文件个数
+@traced
+def clone_tree(source_folder, target_folder):
+    counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+    for root, dirs, files in os.walk(source_folder):
+        target_root = os.path.join(target_folder, os.path.relpath(root, source_folder))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            counts[clone_file(os.path.join(root, file), os.path.join(target_root, file))] += 1
+    return counts
+
+# 写文件时先写到同一文件夹下的临时文件，写完后替换原文件
+# 替换会得到一个新文件，不会改动和它共用数据的硬链接（原文件、其他克隆），这就是克隆的写时复制；
+# 同时写到一半出错也不会留下不完整的文件
+@contextmanager
+def replace_file(file_path, mode='w', encoding=None):
+    directory = os.path.dirname(file_path) or '.'
+    temp_path = os.path.join(directory, f'.{os.path.basename(file_path)}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(temp_path, 'x' + mode.replace('w', ''), encoding=encoding) as file:
+            yield file
+        count_written(os.path.getsize(temp_path))
+        # 保留原文件的权限
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# 复制一个文件，如果目标文件已经存在（可能是硬链接）就替换它，而不是往里面写
+def copy_file(source_path, target_path):
+    with open(source_path, 'rb') as source, replace_file(target_path, 'wb') as target:
+        shutil.copyfileobj(source, target)
+
+# 计算文件内容的 sha256
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# 解压zip文件并删除 macOS 特有的 __MACOSX 文件夹
+# temp_dir 为 None 时新建一个临时目录来解压
+@traced
+def extract_zip(uploaded_zip, temp_dir=None):
+    # 创建临时目录
+    if temp_dir is None:
+        temp_dir = tempfile.mkdtemp()
+
+    # 解压 ZIP 文件
+    with zipfile.ZipFile(uploaded_zip, "r") as zip_ref:
+        zip_ref.extractall(temp_dir)
+
+    # 删除 macOS 特有的 __MACOSX 文件夹（如果存在）
+    macosx_folder = os.path.join(temp_dir, '__MACOSX')
+    if os.path.exists(macosx_folder):
+        shutil.rmtree(macosx_folder)  # 递归删除 __MACOSX 文件夹及其中的内容
+
+    # 检查解压后的文件夹结构，如果最外层文件夹包含多个文件夹，返回原目录
+    extracted_folders = os.listdir(temp_dir)
+
+    # 如果解压后的内容是多个文件或文件夹，并且需要保留原结构
+    if len(extracted_folders) == 1 and os.path.isdir(os.path.join(temp_dir, extracted_folders[0])):
+        # 如果只有一个文件夹，返回该文件夹路径
+        temp_dir = os.path.join(temp_dir, extracted_folders[0])
+
+    return temp_dir  # 返回解压后的文件夹路径
+
+# 把zip文件直接解压到 target_dir 作为工作目录，并删除 macOS 特有的 __MACOSX 文件夹
+# 和 extract_zip 不同：如果最外层只有一个文件夹，会把里面的内容移到 target_dir 下（只是重命名，不复制），
+# 这样解压一次就可以直接在 target_dir 上修改，不需要再复制一份
+def ingest_zip(uploaded_zip, target_dir):
+    return ingest_zip_with_manifest(uploaded_zip, target_dir)[0]
+
+# 和 ingest_zip 一样解压，同时返回解压清单 {相对路径: {'member': 源zip中的成员名, 'ino':, 'size':, 'mtime_ns':}}
+# 打包结果时用这个清单判断哪些文件在转换中没有被修改过，这些文件可以直接从源 zip 复制压缩后的数据（见 zipstream.py）
+@traced
+def ingest_zip_with_manifest(uploaded_zip, target_dir):
+    os.makedirs(target_dir, exist_ok=True)
+
+    # 解压 ZIP 文件
+    with zipfile.ZipFile(uploaded_zip, "r") as zip_ref:
+        zip_ref.extractall(target_dir)
+        members = [info for info in zip_ref.infolist() if not info.is_dir()]
+    count_read(sum(info.compress_size for info in members))
+    count_written(sum(info.file_size for info in members))
+
+    # 删除 macOS 特有的 __MACOSX 文件夹（如果存在）
+    macosx_folder = os.path.join(target_dir, '__MACOSX')
+    if os.path.exists(macosx_folder):
+        shutil.rmtree(macosx_folder)
+
+    # 如果只有一个文件夹，把它里面的内容移到 target_dir 下
+    nested_name = None
+    extracted_items = os.listdir(target_dir)
+    if len(extracted_items) == 1 and os.path.isdir(os.path.join(target_dir, extracted_items[0])):
+        nested_name = extracted_items[0]
+        nested_dir = os.path.join(target_dir, nested_name)
+        temp_name = os.path.join(target_dir, '.ingest-' + uuid.uuid4().hex)
+        os.rename(nested_dir, temp_name)  # 先改名，避免里面有和外层文件夹同名的文件
+        for item in os.listdir(temp_name):
+            os.rename(os.path.join(temp_name, item), os.path.join(target_dir, item))
+        os.rmdir(temp_name)
+
+    # 记录每个解压出来的文件，修改时间设成 zip 中记录的时间，之后任何写入都会改变修改时间
+    manifest = {}
+    for info in members:
+        # 和 zipfile 解压时一样去掉路径中的 ''、'.'、'..'
+        parts = [part for part in info.filename.split('/') if part not in ('', '.', '..')]
+        if not parts or parts[0] == '__MACOSX':
+            continue
+        if nested_name is not None and parts[0] == nested_name:
+            parts = parts[1:]
+        file_path = os.path.join(target_dir, *parts)
+        if not parts or not os.path.isfile(file_path):
+            continue
+        mtime_ns = int(time.mktime(info.date_time + (0, 0, -1))) * 1_000_000_000
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+        stat = os.stat(file_path)
+        manifest['/'.join(parts)] = {
+            'member': info.filename,
+            'ino': stat.st_ino,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+
+    return target_dir, manifest
 
 # 获取文件列表
 def get_tex_files(folder):
@@ -28,40 +215,139 @@ def get_tex_files(folder):
 
 # 让用户选择主文件
 def choose_main_tex_file(tex_files):
-    print("文件夹中有多个.tex文件，请选择你的主文件：")
+    log("文件夹中有多个.tex文件，请选择你的主文件：")
     for idx, file in enumerate(tex_files, 1):
-        print(f"{idx}. {file}")
+        log(f"{idx}. {file}")
     choice = int(input("请输入对应的数字选择主文件: "))
     return tex_files[choice - 1]
 
 # 读取文件内容
 def read_file(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
-        return file.readlines()
+        lines = file.readlines()
+    count_read(sum(len(line) for line in lines))
+    return lines
 
-# 写入文件内容
+# 写入文件内容（替换原文件，见 replace_file）
 def write_file(file_path, lines):
-    with open(file_path, 'w', encoding='utf-8') as file:
+    with replace_file(file_path, 'w', encoding='utf-8') as file:
         file.writelines(lines)
 
+# 按 '\n' 把字符串切成行（保留换行符），和 readlines() 的结果一致
+def split_lines(content):
+    lines = content.split('\n')
+    result = [line + '\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+# 内存中的 tex 文档
+# 只在创建时读一次文件，之后所有修改都在内存中进行，最后调用 flush() 统一写回一次
+class TexDocument:
+    def __init__(self, file_path=None, lines=None):
+        self.file_path = file_path
+        if lines is None:
+            lines = read_file(file_path) if file_path else []
+        self._lines = list(lines)
+        self._content = None
+        self._anchors = None
+        self.dirty = False
+        # 到目前为止删除、插入的行数，修改时顺便统计（见 joblog.py 中的 log_transform）
+        self.removed_lines = 0
+        self.inserted_lines = 0
+
+    def _count_changes(self, new_lines):
+        removed, inserted = count_changed_lines(self._lines, new_lines)
+        self.removed_lines += removed
+        self.inserted_lines += inserted
+
+    # 按行访问文档内容
+    @property
+    def lines(self):
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        lines = list(lines)
+        self._count_changes(lines)
+        self._lines = lines
+        self._content = None
+        self._anchors = None
+        self.dirty = True
+
+    # 按整个字符串访问文档内容
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = ''.join(self._lines)
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        lines = split_lines(content)
+        self._count_changes(lines)
+        self._lines = lines
+        self._content = content
+        self._anchors = None
+        self.dirty = True
+
+    # 结构性标记（\begin{document}、\maketitle 等）的锚点索引，第一次用到时扫描一遍建立
+    @property
+    def anchors(self):
+        if self._anchors is None:
+            self._anchors = AnchorIndex(self._lines)
+        return self._anchors
+
+    # 标记第一次出现的行号（从 0 开始），没有找到返回 None
+    def find_anchor(self, marker):
+        return self.anchors.find(marker)
+
+    # 在第 at 行之前插入 new_lines，锚点索引只增量更新，不重新扫描
+    def insert_lines(self, at, new_lines):
+        new_lines = list(new_lines)
+        self._lines[at:at] = new_lines
+        self.inserted_lines += len(new_lines)
+        self._content = None
+        if self._anchors is not None:
+            self._anchors.insert_lines(at, new_lines)
+        self.dirty = True
+
+    # 把修改后的内容写回文件（没有修改就不写）
+    def flush(self):
+        if self.dirty and self.file_path:
+            write_file(self.file_path, self._lines)
+        self.dirty = False
+
+# 让函数既可以接收文件路径，也可以接收 TexDocument
+# 返回 (文档, 是否由本函数打开)；如果是本函数打开的，函数结束时要调用 flush() 写回
+def open_document(file_or_doc):
+    if isinstance(file_or_doc, TexDocument):
+        return file_or_doc, False
+    return TexDocument(file_or_doc), True
+
+# 如果文档是由函数自己打开的，就写回文件
+def close_document(doc, owned):
+    if owned:
+        doc.flush()
+
 # 修改tex内容用到的一些函数
 
 # 找maketitle在第几行
 def find_maketitle_line(file_path):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    
-    for i, line in enumerate(lines, 1):  # 从第1行开始
-        if '\\maketitle' in line:
-            return i  # 返回找到的行号
+    doc, _ = open_document(file_path)
+
+    maketitle_index = doc.find_anchor('\\maketitle')
+    if maketitle_index is not None:
+        return maketitle_index + 1  # 返回找到的行号（从第1行开始）
     
     return -1  # 如果没有找到\maketitle，返回-1
 
 # 删除 \maketitle 上方的所有注释
+@log_transform
 def remove_comments_before_maketitle(file_path):
     # 打开文件并读取所有行
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
+    doc, owned = open_document(file_path)
+    lines = doc.lines
     
     # 查找\maketitle所在的行号
     maketitle_line = -1
@@ -71,7 +357,7 @@ def remove_comments_before_maketitle(file_path):
             break
     
     if maketitle_line == -1:
-        print("没有找到\\maketitle")
+        log("没有找到\\maketitle", 'warning')
         return
 
     # 删除开头到\maketitle之间的注释
@@ -84,16 +370,17 @@ def remove_comments_before_maketitle(file_path):
     # 添加从\maketitle开始的其余内容
     new_lines.extend(lines[maketitle_line:])
 
-    # 保存修改后的内容回文件
-    with open(file_path, 'w') as f:
-        f.writelines(new_lines)
+    # 保存修改后的内容
+    doc.lines = new_lines
+    close_document(doc, owned)
     
 
 # 把\begin{document}放到\maketitle的上面
+@log_transform
 def move_begindocument_before_maketitle(file_path):
     # 读取文件内容
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
+    doc, owned = open_document(file_path)
+    content = doc.content
 
     # 定位到 \begin{document}
     begindocument_pattern = r'\\begin\{document\}'
@@ -116,156 +403,162 @@ def move_begindocument_before_maketitle(file_path):
             # 在 \maketitle 上面一行插入 \begin{document}
             content = content[:maketitle_start] + '\n' + r'\begin{document}' + '\n' + content[maketitle_start:]
 
-    # 将修改后的内容写回文件
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(content)
+        # 保存修改后的内容
+        doc.content = content
 
+    close_document(doc, owned)
 
-# 修改\title{...},\author{...}, \institution{...}的位置到\maketitle上面
 
-# 因为可能有跨行等情况，所以先定义一个辅助的函数
-# 定义一个函数来解析 LaTeX 命令，并确保匹配整个内容，包括换行符、嵌套的 {}
+# 修改\title{...},\author{...}, \institution{...}的位置到\maketitle上面
 
-def modify_command_position(file_path, command):
+# 因为可能有跨行、嵌套 {} 等情况，所以先用 BraceIndex 一遍扫描建好括号配对索引，
+# 之后每个命令的提取都是直接查索引，多个命令也只需要扫描一次
+
+# 一次提取多个 \command{...}，返回 ([(命令名, 命令内容)...], 删除这些命令后的内容, 删除后 \maketitle 的位置)
+def extract_latex_commands(content, commands):
+    index = BraceIndex(content)
+
+    # 按 commands 的顺序找每个命令的范围，被别的待提取命令包含在里面的不再单独提取
+    spans = []
+    for command in commands:
+        span = index.command_span(command)
+        if span is None:
+            continue
+        if any(start <= span[0] and span[1] <= end for _, start, end in spans):
+            continue
+        spans = [item for item in spans if not (span[0] <= item[1] and item[2] <= span[1])]
+        spans.append((command, span[0], span[1]))
+
+    extracted = [(command, content[start:end]) for command, start, end in spans]
+
+    # 按位置从前往后删掉这些命令
+    pieces = []
+    last = 0
+    for _, start, end in sorted(spans, key=lambda item: item[1]):
+        pieces.append(content[last:start])
+        last = end
+    pieces.append(content[last:])
+    remaining = ''.join(pieces)
+
+    # 找删除后第一个 \maketitle 的位置（位于被删除命令内部的不算）
+    maketitle_position = None
+    for position in index.commands.get('maketitle', []):
+        if any(start <= position < end for _, start, end in spans):
+            continue
+        removed = sum(end - start for _, start, end in spans if end <= position)
+        maketitle_position = position - removed
+        break
+
+    return extracted, remaining, maketitle_position
+
+# 把多个 \command{...} 按给定顺序移动到 \maketitle 的上面
+@log_transform
+def modify_commands_position(file_path, commands):
     # 读取文件内容
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    # 定义一个函数来解析 LaTeX 命令，并确保匹配整个内容，包括换行符、嵌套的 {}
-    def extract_latex_command(content, command):
-        # 匹配类似 \command{...} 的结构
-        pattern = rf'\\{command}\{{'
-        match = re.search(pattern, content)
-        
-        if not match:
-            return None, content
-        
-        # 找到命令开始的索引
-        start_idx = match.start()
-        end_idx = start_idx + len(match.group(0))
-        
-        # 计数括号，处理嵌套的 {}
-        open_braces = 1  # 计数开括号
-        for i in range(end_idx, len(content)):
-            if content[i] == '{':
-                open_braces += 1
-            elif content[i] == '}':
-                open_braces -= 1
-            
-            # 当括号平衡时，表示整个命令已结束
-            if open_braces == 0:
-                end_idx = i + 1
-                break
-        
-        # 返回提取的命令内容
-        return content[start_idx:end_idx], content[:start_idx] + content[end_idx:]
-    
+    doc, owned = open_document(file_path)
 
     # 提取指定命令的内容
-    command_content, content = extract_latex_command(content, command)
+    extracted, content, maketitle_position = extract_latex_commands(doc.content, commands)
+    found = dict(extracted)
 
-    if command_content:
-        print(f"找到了\\{command}，命令内容: {command_content}")
-        # 这里可以执行后续的修改操作，比如替换命令等
-    else:
-        print(f"没有找到 \\{command} 命令")
+    for command in commands:
+        if command in found:
+            log(f"找到了\\{command}，命令内容: {found[command]}")
+        else:
+            log(f"没有找到 \\{command} 命令", 'warning')
 
+    # 没有 \maketitle 时不能把命令放回去，保持文件不变
+    if extracted and maketitle_position is not None:
+        # 在 \maketitle 之前依次插入整个命令
+        inserted = ''.join('\n' + command_content + '\n' for _, command_content in extracted)
+        content = content[:maketitle_position] + inserted + content[maketitle_position:]
+        for command, _ in extracted:
+            log(f"成功插入 \\{command} 命令")
 
-    if command_content:
-        # 找到 \maketitle
-        maketitle_pattern = r'\\maketitle'
-        maketitle_match = re.search(maketitle_pattern, content)
+        # 保存修改后的内容
+        doc.content = content
 
-        if maketitle_match:
-            # 在 \maketitle 之前插入整个命令
-            content = content[:maketitle_match.start()] + '\n' + command_content + '\n' + content[maketitle_match.start():]
-            print(f"成功插入 \\{command} 命令")
+    close_document(doc, owned)
 
-    # 将修改后的内容写回文件
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.write(content)
+# 只移动一个命令
+def modify_command_position(file_path, command):
+    modify_commands_position(file_path, [command])
 
 
 # 删除\documentclass行
+@log_transform
 def remove_documentclass(file_path):
     # 读取文件内容
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.readlines()
+    doc, owned = open_document(file_path)
+    content = doc.lines
 
     # 查找包含 \documentclass 的行并删除
     documentclass_lines = [line for line in content if line.strip().startswith(r'\documentclass')]
     
     # 打印删除的 \documentclass 行
     if documentclass_lines:
-        print("删除了 \documentclass 行:")
+        log("删除了 \documentclass 行:")
         for line in documentclass_lines:
-            print(line.strip())
+            log(line.strip())
 
     # 保留其他行
-    content = [line for line in content if not line.strip().startswith(r'\documentclass')]
+    if documentclass_lines:
+        doc.lines = [line for line in content if not line.strip().startswith(r'\documentclass')]
 
-    # 将修改后的内容写回文件
-    with open(file_path, 'w', encoding='utf-8') as file:
-        file.writelines(content)
+    close_document(doc, owned)
 
 # 获取旧模板文件夹中的所有 .sty 文件
 def get_sty_files(old_template_folder):
     return [f for f in os.listdir(old_template_folder) if f.endswith('.sty')]
 
-# 删除含有 sty 文件名的 \usepackage 语句的函数
-def remove_userpackage_sty_lines(old_template_folder, tex_file_path):
-    # 获取 .sty 文件名（不包括 .sty 后缀）
-    sty_files = get_sty_files(old_template_folder)
-
-    # 打开 .tex 文件并读取内容
-    with open(tex_file_path, 'r', encoding='utf-8') as file:
-        content = file.readlines()
+# 获取旧模板文件夹中 sty 文件对应的包名（小写包名 -> sty 文件名）
+# 包括 sty 文件名本身，以及 sty 文件里 \ProvidesPackage{...} 声明的包名，这样文件名和包名大小写不同时也能删除
+def get_sty_package_names(old_template_folder):
+    package_names = {}
+    for sty_file in get_sty_files(old_template_folder):
+        package_names.setdefault(sty_file[:-len('.sty')].lower(), sty_file)
+        with open(os.path.join(old_template_folder, sty_file), 'r', encoding='utf-8', errors='ignore') as file:
+            for match in PROVIDES_PACKAGE_PATTERN.finditer(file.read()):
+                package_names.setdefault(match.group(1).lower(), sty_file)
+    return package_names
 
-    # 遍历所有 .sty 文件并查找对应的 \usepackage{...sty_file_name} 语句
-    for sty_file in sty_files:
-        sty_file_name = sty_file.replace('.sty', '')  # 获取文件名（不包含 .sty 后缀）
-        
-        # 打印正在处理的 sty 文件
-        print(f"正在处理的 sty 文件: {sty_file_name}.sty")
-        
-        # 定义匹配模式，查找带选项和不带选项的 \usepackage{...sty_file_name} 语句
-        # 更新正则表达式：支持 \usepackage{sty_file_name} 或 \usepackage[...]{sty_file_name}
-        package_pattern = rf'\\usepackage(?:\[[^\]]*\])?\s?\{{\s*{re.escape(sty_file_name)}\s*\}}'
-
-        # 找到所有符合条件的行（使用 re.IGNORECASE 使匹配不区分大小写）
-        matching_lines = [line for line in content if re.search(package_pattern, line, re.IGNORECASE)]
-
-
-        # 打印找到的匹配行
-        if matching_lines:
-            print("找到的匹配行：")
-            for line in matching_lines:
-                print(line.strip())
-        
-        # 删除这些行并打印删除的内容
-        if matching_lines:
-            print(f"删除的 sty 包内容：")
-            for line in matching_lines:
-                print(line.strip())
-            
-            # 保留未匹配的行
-            content = [line for line in content if not re.search(package_pattern, line, re.IGNORECASE)]
-        
-        
-        else:
-            print(f"没有找到匹配的 {sty_file_name} 包")
-
-    # 将修改后的内容写回 .tex 文件
-    with open(tex_file_path, 'w', encoding='utf-8') as file:
-        file.writelines(content)
+# 删除含有 sty 文件名的 \usepackage 语句的函数
+# package_names 可以传入事先用 get_sty_package_names 得到的包名（文件夹中的 sty 文件之后可能会被替换）
+@log_transform(doc_arg=1)
+def remove_userpackage_sty_lines(old_template_folder, tex_file_path, package_names=None):
+    # 获取 sty 文件对应的包名（不区分大小写）
+    if package_names is None:
+        package_names = get_sty_package_names(old_template_folder)
+    log(f"正在处理的 sty 文件: {', '.join(sorted(set(package_names.values())))}")
+
+    # 打开 .tex 文件，每个 \usepackage 只解析一次，再按包名集合一次性删除
+    doc, owned = open_document(tex_file_path)
+    index = PackageIndex(doc.lines)
+    new_lines, removed = index.remove_packages(package_names)
+
+    # 打印删除的内容
+    if removed:
+        log(f"删除的 sty 包内容：")
+        for line, names in removed:
+            log(f"{line.strip()}  （删除的包: {', '.join(names)}）")
+        doc.lines = new_lines
+
+    # 打印没有找到的包
+    for sty_file in sorted(set(package_names.values())):
+        names = [name for name, file in package_names.items() if file == sty_file]
+        if not any(index.has_package(name) for name in names):
+            log(f"没有找到匹配的 {sty_file[:-len('.sty')]} 包")
+
+    close_document(doc, owned)
 
 
 # 在 tex 文件中删除包含 mm 的 \usepackage{...} 语句，改成了以下
 # 在 tex 文件中删除包含 mm 或 cm 的 \usepackage{...} 语句
+@log_transform
 def remove_userpackage_mm_cm_lines(tex_file_path):
     # 打开 .tex 文件并读取内容
-    with open(tex_file_path, 'r', encoding='utf-8') as file:
-        content = file.readlines()
+    doc, owned = open_document(tex_file_path)
+    content = doc.lines
 
     # 定义匹配模式，查找带有 mm 或 cm 的 \usepackage{...} 语句
     # 例如：\usepackage[width=122mm,...]{geometry} 或 \usepackage[width=12cm,...]{geometry}
@@ -276,33 +569,28 @@ def remove_userpackage_mm_cm_lines(tex_file_path):
 
     # 删除这些行并打印删除的内容
     if matching_lines:
-        print(f"删除包含mm或cm的包的内容：")
+        log(f"删除包含mm或cm的包的内容：")
         for line in matching_lines:
-            print(line.strip())
+            log(line.strip())
 
         # 保留未匹配的行
-        content = [line for line in content if not re.search(package_pattern, line)]
+        doc.lines = [line for line in content if not re.search(package_pattern, line)]
     else:
-        print("没有删除包含mm或cm的包")
+        log("没有删除包含mm或cm的包")
 
-    # 将修改后的内容写回 .tex 文件
-    with open(tex_file_path, 'w', encoding='utf-8') as file:
-        file.writelines(content)
+    close_document(doc, owned)
 
 # 删除 \begin{document} 之前的所有行，保留 \usepackage和\def开头的行
+@log_transform
 def remove_lines_before_document(tex_file_path):
-    with open(tex_file_path, 'r', encoding='utf-8') as file:
-        content = file.readlines()
+    doc, owned = open_document(tex_file_path)
+    content = doc.lines
 
     # 查找 \begin{document} 的位置
-    begin_document_index = None
-    for i, line in enumerate(content):
-        if '\\begin{document}' in line:
-            begin_document_index = i
-            break
+    begin_document_index = doc.find_anchor('\\begin{document}')
 
     if begin_document_index is None:
-        print("未找到 \\begin{document}")
+        log("未找到 \\begin{document}", 'warning')
         return
 
     # 保留以 \usepackage 或 \def 开头的行，并删除 \begin{document} 之前的其他行
@@ -316,9 +604,9 @@ def remove_lines_before_document(tex_file_path):
     # 保留从 \begin{document} 开始的所有行
     new_content.extend(content[begin_document_index:])
 
-    # 将修改后的内容写回文件
-    with open(tex_file_path, 'w', encoding='utf-8') as file:
-        file.writelines(new_content)
+    # 保存修改后的内容
+    doc.lines = new_content
+    close_document(doc, owned)
 
 def manage_sty_files(target_folder, modified_folder):
     """删除被修改文件夹中的所有 .sty 文件，并复制目标模板文件夹中的所有 .sty 文件到被修改文件夹中"""
@@ -328,7 +616,7 @@ def manage_sty_files(target_folder, modified_folder):
             if file.endswith('.sty'):
                 file_path = os.path.join(root, file)
                 os.remove(file_path)
-                print(f"已删除文件: {file_path}")
+                log(f"已删除文件: {file_path}")
 
     # 获取目标模板文件夹中的所有 .sty 文件
     sty_files = [f for f in os.listdir(target_folder) if f.endswith('.sty')]
@@ -339,8 +627,8 @@ def manage_sty_files(target_folder, modified_folder):
         destination_path = os.path.join(modified_folder, sty_file)
 
         # 复制文件
-        shutil.copy(source_path, destination_path)
-        print(f"已复制文件: {sty_file}")
+        copy_file(source_path, destination_path)
+        log(f"已复制文件: {sty_file}")
 
 # 复制 new_template_folder 中的所有 .cls 文件到 old_template_folder 中
 def copy_cls_files(new_template_folder, old_template_folder):
@@ -353,41 +641,36 @@ def copy_cls_files(new_template_folder, old_template_folder):
         destination_path = os.path.join(old_template_folder, cls_file)
 
         # 复制文件
-        shutil.copy(source_path, destination_path)
-        print(f"已复制文件: {cls_file}")
+        copy_file(source_path, destination_path)
+        log(f"已复制文件: {cls_file}")
 
 # 把new_main_tex的begindocument的前面的部分全部复制到old_main_tex中
+@log_transform(doc_arg=1)
 def copy_pre_document_to_first_line(new_main_tex, old_main_tex):
     # 读取 new_main_tex 文件
-    with open(new_main_tex, 'r', encoding='utf-8') as file:
-        content_new = file.readlines()
+    new_doc, _ = open_document(new_main_tex)
+    content_new = new_doc.lines
 
     # 查找 \begin{document} 的位置
-    begin_document_index = None
-    for i, line in enumerate(content_new):
-        if '\\begin{document}' in line:
-            begin_document_index = i
-            break
+    begin_document_index = new_doc.find_anchor('\\begin{document}')
 
     if begin_document_index is None:
-        print("未找到 \\begin{document}")
+        log("未找到 \\begin{document}", 'warning')
         return
 
     # 提取 \begin{document} 之前的部分
     pre_document_content = content_new[:begin_document_index]
 
     # 读取 old_main_tex 文件
-    with open(old_main_tex, 'r', encoding='utf-8') as file:
-        content_old = file.readlines()
+    old_doc, owned = open_document(old_main_tex)
 
     # 将 pre_document_content 插入到 old_main_tex 文件的第一行之前
-    new_content = pre_document_content + content_old
+    old_doc.insert_lines(0, pre_document_content)
+    close_document(old_doc, owned)
 
-    # 将修改后的内容写回 old_main_tex 文件
-    with open(old_main_tex, 'w', encoding='utf-8') as file:
-        file.writelines(new_content)
-
-    print(f"已将 {new_main_tex} 中 \\begindocument 前的部分复制到 {old_main_tex} 的第一行之前。")
+    # 内存中准备好的模板没有文件路径
+    source = new_doc.file_path or '目标模板'
+    log(f"已将 {source} 中 \\begindocument 前的部分复制到 {old_doc.file_path} 的第一行之前。")
 
 # 获取目标模板文件夹下的所有.bst文件并复制到被修改文件夹
 def copy_bst_files(target_folder, modified_folder):
@@ -406,122 +689,113 @@ def copy_bst_files(target_folder, modified_folder):
             target_path = os.path.join(modified_folder, bst_filename)
             
             # 复制文件
-            shutil.copy(bst_file, target_path)
-            print(f"已复制 {bst_filename} 到 {modified_folder}")
+            copy_file(bst_file, target_path)
+            log(f"已复制 {bst_filename} 到 {modified_folder}")
     else:
-        print("目标模板文件夹没有找到 .bst 文件")
+        log("目标模板文件夹没有找到 .bst 文件", 'warning')
 
 # 找tex文件的\bibliographystyle{...}
 def find_bibliographystyle(tex_file_path):
     """查找文件中的 \bibliographystyle{...}"""
-    with open(tex_file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    for line in lines:
-        if '\\bibliographystyle{' in line:
-            # 返回找到的 bibliographystyle 的内容
-            start = line.find('{') + 1
-            end = line.find('}')
-            return line[start:end]
+    doc, _ = open_document(tex_file_path)
+
+    bibliographystyle_index = doc.find_anchor('\\bibliographystyle{')
+    if bibliographystyle_index is not None:
+        # 返回找到的 bibliographystyle 的内容
+        line = doc.lines[bibliographystyle_index]
+        start = line.find('{') + 1
+        end = line.find('}')
+        return line[start:end]
     return None  # 如果没有找到 \bibliographystyle{...}
 
 
 # 修改bib内容
+@log_transform
 def modify_bibliography(tex_file_path, target_bibliographystyle):
     """修改被修改的 tex 文件中的 bibliographystyle"""
-    with open(tex_file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    bibliographystyle_line = None
-    end_document_line = None
+    doc, owned = open_document(tex_file_path)
+    lines = doc.lines
 
-    # 查找 \bibliographystyle{...} 和 \end{document} 的行号
-    for i, line in enumerate(lines, 1):
-        if '\\bibliographystyle{' in line:
-            bibliographystyle_line = i
-        elif '\\end{document}' in line:
-            end_document_line = i
+    # 查找最后一个 \bibliographystyle{...} 和最后一个 \end{document} 的行号（从第1行开始）
+    bibliographystyle_lines = {line for line, _ in doc.anchors.find_all('\\bibliographystyle{')}
+    end_document_lines = [line for line, _ in doc.anchors.find_all('\\end{document}') if line not in bibliographystyle_lines]
+    bibliographystyle_line = max(bibliographystyle_lines) + 1 if bibliographystyle_lines else None
+    end_document_line = end_document_lines[-1] + 1 if end_document_lines else None
 
     # 如果没有找到 \bibliographystyle{...}，就需要插入
     if bibliographystyle_line is None and end_document_line:
         # 在 \end{document} 之前插入 \bibliographystyle 和 \bibliography
-        lines.insert(end_document_line - 1, f"\\bibliographystyle{{{target_bibliographystyle}}}\n")
-        lines.insert(end_document_line, "\\bibliography{yourbib}\n")
+        doc.insert_lines(end_document_line - 1, [
+            f"\\bibliographystyle{{{target_bibliographystyle}}}\n",
+            "\\bibliography{yourbib}\n",
+        ])
         # 创建一个空的 yourbib.bib 文件
-        with open(os.path.join(os.path.dirname(tex_file_path), 'yourbib.bib'), 'w', encoding='utf-8') as bib_file:
+        with replace_file(os.path.join(os.path.dirname(doc.file_path), 'yourbib.bib'), 'w', encoding='utf-8') as bib_file:
             bib_file.write("% Please add references to yourbib.bib file\n")
-        print(f"已在 \\end{{document}} 之前插入 \\bibliographystyle{{{target_bibliographystyle}}} 和 \\bibliography{{yourbib}}")
-        print("已创建了一个空的yourbib.bib文件，请放入你的引用文献")
+        log(f"已在 \\end{{document}} 之前插入 \\bibliographystyle{{{target_bibliographystyle}}} 和 \\bibliography{{yourbib}}")
+        log("已创建了一个空的yourbib.bib文件，请放入你的引用文献")
     
     # 如果找到 \bibliographystyle{...}，进行修改
     elif bibliographystyle_line is not None:
         old_bibliographystyle = lines[bibliographystyle_line - 1].strip().split('{')[1].split('}')[0]
         if old_bibliographystyle != target_bibliographystyle:
+            lines = list(lines)
             lines[bibliographystyle_line - 1] = f"\\bibliographystyle{{{target_bibliographystyle}}}\n"
-            print(f"已将 \\bibliographystyle{{{old_bibliographystyle}}} 修改为 \\bibliographystyle{{{target_bibliographystyle}}}")
+            doc.lines = lines
+            log(f"已将 \\bibliographystyle{{{old_bibliographystyle}}} 修改为 \\bibliographystyle{{{target_bibliographystyle}}}")
         else:
-            print("bibliographystyle 已经是目标的格式，无需修改")
+            log("bibliographystyle 已经是目标的格式，无需修改")
     
-    # 将修改后的内容写回文件
-    with open(tex_file_path, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
+    close_document(doc, owned)
 
+@log_transform
 def process_tex_files(modified_tex_path, target_tex_path):
     # 查找被修改文件和目标模板文件中的 \bibliographystyle{...}
     modified_bibliographystyle = find_bibliographystyle(modified_tex_path)
     target_bibliographystyle = find_bibliographystyle(target_tex_path)
 
     if target_bibliographystyle:
-        print(f"在目标模板文件中找到了 bibliographystyle 为：{target_bibliographystyle}")
+        log(f"在目标模板文件中找到了 bibliographystyle 为：{target_bibliographystyle}")
         
         if modified_bibliographystyle:
-            print(f"在被修改文件中找到了 bibliographystyle 为：{modified_bibliographystyle}")
+            log(f"在被修改文件中找到了 bibliographystyle 为：{modified_bibliographystyle}")
             modify_bibliography(modified_tex_path, target_bibliographystyle)
         else:
-            print("在被修改文件中没有找到 bibliographystyle")
+            log("在被修改文件中没有找到 bibliographystyle")
             modify_bibliography(modified_tex_path, target_bibliographystyle)
     else:
-        print("目标模板没有 \\bibliographystyle{...}，请根据目标模板官方文档手动修改 bib")
+        log("目标模板没有 \\bibliographystyle{...}，请根据目标模板官方文档手动修改 bib", 'warning')
 
 # -------------------
 # 改bug
 
 # \begin{document}前加入\usepackage[OT1]{fontenc} 
+@log_transform
 def add_fontenc_package(tex_file_path):
     """在 \\begin{document} 之前插入 \\usepackage[OT1]{fontenc}"""
-    with open(tex_file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    begindocument_line = None
+    doc, owned = open_document(tex_file_path)
 
     # 查找 \\begin{document} 的行号，转义反斜杠
-    for i, line in enumerate(lines, 1):
-        if '\\begin{document}' in line:  # 使用双反斜杠
-            begindocument_line = i
-            break
+    begindocument_index = doc.find_anchor('\\begin{document}')  # 使用双反斜杠
 
     # 如果找到 \\begin{document}，就插入 \\usepackage[OT1]{fontenc}
-    if begindocument_line:
-        lines.insert(begindocument_line - 1, "\\usepackage[OT1]{fontenc}\n")  # 转义反斜杠
-        print("已在 \\begin{document} 之前插入 \\usepackage[OT1]{fontenc}")
+    if begindocument_index is not None:
+        doc.insert_lines(begindocument_index, ["\\usepackage[OT1]{fontenc}\n"])  # 转义反斜杠
+        log("已在 \\begin{document} 之前插入 \\usepackage[OT1]{fontenc}")
     else:
-        print("没有找到 \\begin{document}，无法插入 \\usepackage[OT1]{fontenc}")
+        log("没有找到 \\begin{document}，无法插入 \\usepackage[OT1]{fontenc}", 'warning')
 
-    # 将修改后的内容写回文件
-    with open(tex_file_path, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
+    close_document(doc, owned)
 
 # 在\begin{document}之前插入\usepackage{subcaption}
+@log_transform
 def add_subcaption_package_before_document(file_path):
     # 读取文件内容
-    lines = read_file(file_path)
+    doc, owned = open_document(file_path)
+    lines = doc.lines
     
     # 查找 \begin{document} 的位置
-    begin_document_line = None
-    for i, line in enumerate(lines):
-        if '\\begin{document}' in line:
-            begin_document_line = i
-            break
+    begin_document_line = doc.find_anchor('\\begin{document}')
     
     if begin_document_line is not None:
         # 要插入的包
@@ -529,23 +803,23 @@ def add_subcaption_package_before_document(file_path):
         
         # 检查是否已经存在 \usepackage{subcaption}
         if any('\\usepackage{subcaption}' in line for line in lines):
-            print("文件中已包含 \\usepackage{subcaption}，无需重复添加。")
+            log("文件中已包含 \\usepackage{subcaption}，无需重复添加。")
         else:
             # 在 \begin{document} 前插入 \usepackage{subcaption}
-            lines = lines[:begin_document_line] + [package_to_insert] + lines[begin_document_line:]
-            
-            # 写回修改后的文件
-            write_file(file_path, lines)
-            print("已在 \\begin{document} 前添加 \\usepackage{subcaption}。")
+            doc.insert_lines(begin_document_line, [package_to_insert])
+            close_document(doc, owned)
+            log("已在 \\begin{document} 前添加 \\usepackage{subcaption}。")
     else:
-        print("未找到 \\begin{document}，无法插入 \\usepackage{subcaption}。")
+        log("未找到 \\begin{document}，无法插入 \\usepackage{subcaption}。", 'warning')
 
 
 
 
 # 删除第二个hyperref包
+@log_transform
 def remove_second_hyperref(file_path):
-    lines = read_file(file_path)  # 读取文件内容
+    doc, owned = open_document(file_path)  # 读取文件内容
+    lines = doc.lines
     new_lines = []
     hyperref_count = 0  # 用于计数遇到的 \usepackage{hyperref} 次数
 
@@ -558,21 +832,19 @@ def remove_second_hyperref(file_path):
                 continue  # 跳过第二次出现的 \usepackage{hyperref}，相当于删除该行
         new_lines.append(line)  # 保留其他行
 
-    # 写回修改后的内容
-    write_file(file_path, new_lines)
-    print("已删除第二个 \\usepackage{hyperref}")
+    # 保存修改后的内容
+    doc.lines = new_lines
+    close_document(doc, owned)
+    log("已删除第二个 \\usepackage{hyperref}")
 
 # 添加//的定义，防止\author换行无法识别
+@log_transform
 def add_pdfstringdef_before_document(file_path):
     # 读取文件内容
-    lines = read_file(file_path)
+    doc, owned = open_document(file_path)
     
     # 查找 \begin{document} 的位置
-    begin_document_line = None
-    for i, line in enumerate(lines):
-        if '\\begin{document}' in line:
-            begin_document_line = i
-            break
+    begin_document_line = doc.find_anchor('\\begin{document}')
     
     if begin_document_line is not None:
         # 在 \begin{document} 前插入 \pdfstringdefDisableCommands
@@ -582,25 +854,20 @@ def add_pdfstringdef_before_document(file_path):
             '  \\def\\texttt#1{<#1>}%\n',
             '}%\n'
         ]
-        lines = lines[:begin_document_line] + pdfstringdef_lines + lines[begin_document_line:]
-        
-        # 写回修改后的文件
-        write_file(file_path, lines)
-        print("已在 \\begin{document} 前添加 \\pdfstringdefDisableCommands。")
+        doc.insert_lines(begin_document_line, pdfstringdef_lines)
+        close_document(doc, owned)
+        log("已在 \\begin{document} 前添加 \\pdfstringdefDisableCommands。")
     else:
-        print("未找到 \\begin{document}，无法插入 \\pdfstringdefDisableCommands。")
+        log("未找到 \\begin{document}，无法插入 \\pdfstringdefDisableCommands。", 'warning')
 
 # 添加\eg等符号的定义
+@log_transform
 def add_custom_macros_before_document(file_path):
     # 读取文件内容
-    lines = read_file(file_path)
+    doc, owned = open_document(file_path)
     
     # 查找 \begin{document} 的位置
-    begin_document_line = None
-    for i, line in enumerate(lines):
-        if '\\begin{document}' in line:
-            begin_document_line = i
-            break
+    begin_document_line = doc.find_anchor('\\begin{document}')
     
     if begin_document_line is not None:
         # 定义缩写命令和 \onedot 的宏
@@ -623,10 +890,8 @@ def add_custom_macros_before_document(file_path):
         ]
         
         # 在 \begin{document} 前插入宏定义
-        lines = lines[:begin_document_line] + custom_macros + lines[begin_document_line:]
-        
-        # 写回修改后的文件
-        write_file(file_path, lines)
-        print("已在 \\begin{document} 前添加自定义宏定义。")
+        doc.insert_lines(begin_document_line, custom_macros)
+        close_document(doc, owned)
+        log("已在 \\begin{document} 前添加自定义宏定义。")
     else:
-        print("未找到 \\begin{document}，无法插入自定义宏定义。")
+        log("未找到 \\begin{document}，无法插入自定义宏定义。", 'warning')
@@ -0,0 +1,160 @@
+# 这个文件用来放每个任务的结构化日志
+# 以前每个函数都用 print() 报告进度，streamlit.py 再把全局的 sys.stdout 换成缓冲区来收集输出：
+# 两个会话同时转换时输出会混在一起（甚至还原到错误的 stdout），API 中这些输出也没有人看
+# 现在转换过程中的每条消息都是一个事件（级别、阶段、文件、删除/插入的行数、耗时），写到当前任务自己的 JobLog 中；
+# 当前任务的 JobLog 放在 contextvars 中，同时运行的任务（线程）互不影响，不需要重定向全局的 stdout
+# 没有任务日志时（例如直接运行 main.py），消息和以前一样打印到终端
+
+# 导入包
+import time
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+from tracing import span, current_trace
+
+
+# 事件的级别，从低到高
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+# 一条日志事件
+class LogEvent:
+    __slots__ = ('seq', 'time', 'level', 'message', 'stage', 'file', 'removed', 'inserted', 'duration')
+
+    def __init__(self, seq, level, message, stage=None, file=None, removed=None, inserted=None, duration=None):
+        self.seq = seq  # 在这个任务中的序号，从 0 开始，用来增量获取事件
+        self.time = time.time()
+        self.level = level
+        self.message = message
+        self.stage = stage  # 产生这条消息的步骤（函数名，例如 remove_documentclass）
+        self.file = file  # 被修改的文件
+        self.removed = removed  # 这一步删除的行数
+        self.inserted = inserted  # 这一步插入的行数
+        self.duration = duration  # 这一步的耗时（秒）
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return self.message
+
+
+# 一个任务的日志
+class JobLog:
+    def __init__(self, job_id=None, echo=False):
+        self.job_id = job_id
+        self.echo = echo  # 为 True 时同时打印到终端
+        self.events = []
+        self.lock = threading.Lock()
+
+    def emit(self, message, level='info', **fields):
+        if level not in LEVELS:
+            raise ValueError(f"未知的日志级别: {level}")
+        with self.lock:
+            event = LogEvent(len(self.events), level, message, **fields)
+            self.events.append(event)
+        if self.echo:
+            print(message)
+        return event
+
+    # 级别不低于 level、序号不小于 since 的事件
+    def select(self, level='debug', since=0):
+        minimum = LEVELS.index(level)
+        with self.lock:
+            events = self.events[since:]
+        return [event for event in events if LEVELS.index(event.level) >= minimum]
+
+    def to_list(self, level='debug', since=0):
+        return [event.to_dict() for event in self.select(level, since)]
+
+    # 和以前 print() 的输出一样的文本，每条消息一行
+    def text(self, level='info'):
+        return ''.join(f'{event.message}\n' for event in self.select(level))
+
+    def __len__(self):
+        return len(self.events)
+
+
+_current_log = contextvars.ContextVar('job_log', default=None)
+_current_stage = contextvars.ContextVar('job_log_stage', default=None)
+
+
+# 当前任务的日志，没有时返回 None
+def current_job_log():
+    return _current_log.get()
+
+# 在 with 中把 job_log 设为当前任务的日志
+@contextmanager
+def job_log_context(job_log):
+    token = _current_log.set(job_log)
+    try:
+        yield job_log
+    finally:
+        _current_log.reset(token)
+
+# 记录一条消息；没有当前任务的日志时打印到终端
+def log(message, level='info', **fields):
+    job_log = _current_log.get()
+    if job_log is None:
+        print(message)
+        return None
+    stage = _current_stage.get()
+    if stage is not None:
+        fields.setdefault('stage', stage[0])
+        fields.setdefault('file', stage[1])
+    return job_log.emit(message, level, **fields)
+
+# 删除和插入的行数：去掉前后相同的行，中间改动的范围在 before 中的行数算删除，在 after 中的行数算插入
+# 只做一次比较，不复制也不统计整个文档
+def count_changed_lines(before, after):
+    end = min(len(before), len(after))
+    start = 0
+    while start < end and before[start] == after[start]:
+        start += 1
+    end -= start
+    suffix = 0
+    while suffix < end and before[-1 - suffix] == after[-1 - suffix]:
+        suffix += 1
+    return len(before) - start - suffix, len(after) - start - suffix
+
+# 修改 tex 文件的函数的装饰器：第 doc_arg 个参数是被修改的 TexDocument 或文件路径
+# 函数中的消息都记在这个函数名下；结束时记录一条事件，带上文件、删除/插入的行数和耗时
+# 行数来自 TexDocument 修改时统计的计数（见 function.py），不需要在前后复制和比较整个文档
+# 有当前的 trace 时，这个函数同时是一个阶段（见 tracing.py）
+def log_transform(func=None, *, doc_arg=0):
+    if func is None:
+        return functools.partial(log_transform, doc_arg=doc_arg)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job_log = _current_log.get()
+        if len(args) <= doc_arg or (job_log is None and current_trace() is None):
+            return func(*args, **kwargs)
+        if job_log is None:
+            with span(func.__name__):
+                return func(*args, **kwargs)
+
+        file_or_doc = args[doc_arg]
+        counted = hasattr(file_or_doc, 'removed_lines')
+        if counted:
+            removed_before, inserted_before = file_or_doc.removed_lines, file_or_doc.inserted_lines
+        file = getattr(file_or_doc, 'file_path', file_or_doc)
+        token = _current_stage.set((func.__name__, file))
+        start = time.perf_counter()
+        try:
+            with span(func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            _current_stage.reset(token)
+            removed = inserted = None
+            message = f"{func.__name__} 完成，耗时 {duration:.3f}s"
+            if counted:
+                removed = file_or_doc.removed_lines - removed_before
+                inserted = file_or_doc.inserted_lines - inserted_before
+                message = f"{func.__name__} 完成：删除 {removed} 行，插入 {inserted} 行，耗时 {duration:.3f}s"
+            job_log.emit(message, 'debug', stage=func.__name__, file=file, removed=removed, inserted=inserted,
+                         duration=duration)
+    return wrapper
@@ -0,0 +1,155 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from joblog import JobLog, job_log_context
+from tracing import trace_context
+
+# Number of conversions that run at the same time, and how many more may wait for a worker.
+CONVERTER_WORKERS = int(os.environ.get("CONVERTER_WORKERS", str(os.cpu_count() or 2)))
+CONVERTER_MAX_QUEUE = int(os.environ.get("CONVERTER_MAX_QUEUE", "16"))
+# Finished jobs (and their workspaces) are kept this many seconds for the result to be fetched.
+CONVERTER_JOB_TTL = int(os.environ.get("CONVERTER_JOB_TTL", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is already at its maximum depth."""
+
+
+class Job:
+    """A unit of work submitted to the JobManager."""
+
+    def __init__(self, job_id: str, workspace=None, metadata: Optional[Dict[str, Any]] = None, trace=None):
+        self.id = job_id
+        self.workspace = workspace
+        self.metadata = metadata or {}
+        self.status = QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.status_code: Optional[int] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.future = None
+        # Structured events emitted by the conversion while this job runs (see joblog.py).
+        self.log = JobLog(job_id)
+        # Per-stage spans of this job when the caller traces it (see tracing.py).
+        self.trace = trace
+
+    @property
+    def done(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            **self.metadata,
+        }
+
+
+class JobManager:
+    """Runs jobs on a bounded thread pool and keeps their status until they expire."""
+
+    def __init__(self, max_workers: int = CONVERTER_WORKERS, max_queue: int = CONVERTER_MAX_QUEUE,
+                 ttl: int = CONVERTER_JOB_TTL):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="converter")
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+
+    def counts(self) -> Dict[str, int]:
+        """Returns the number of jobs in each state."""
+        with self.lock:
+            counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def submit(self, func: Callable, *args, workspace=None, metadata: Optional[Dict[str, Any]] = None, trace=None,
+               **kwargs) -> Job:
+        """Queues func(*args, **kwargs); raises JobQueueFull when max_queue jobs are already waiting."""
+        self.expire()
+        with self.lock:
+            queued = sum(1 for job in self.jobs.values() if job.status == QUEUED)
+            if queued >= self.max_queue:
+                raise JobQueueFull(f"Conversion queue is full ({self.max_queue} jobs waiting).")
+            job = Job(uuid.uuid4().hex, workspace=workspace, metadata=metadata, trace=trace)
+            self.jobs[job.id] = job
+            job.future = self.executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def add_completed(self, result: Any, metadata: Optional[Dict[str, Any]] = None) -> Job:
+        """Registers a job whose result is already available (e.g. served from a cache)."""
+        job = Job(uuid.uuid4().hex, metadata=metadata)
+        job.status = SUCCEEDED
+        job.result = result
+        job.started_at = job.finished_at = job.created_at
+        job.future = Future()
+        job.future.set_result(result)
+        with self.lock:
+            self.jobs[job.id] = job
+        return job
+
+    def _run(self, job: Job, func: Callable, args, kwargs):
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            with job_log_context(job.log), trace_context(job.trace):
+                job.result = func(*args, **kwargs)
+            job.status = SUCCEEDED
+            return job.result
+        except Exception as e:
+            job.error = getattr(e, "detail", None) or str(e)
+            job.status_code = getattr(e, "status_code", 500)
+            job.status = FAILED
+            job.log.emit(f"Job failed: {job.error}", "error")
+            logging.exception(f"Job {job.id} failed.")
+            raise
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def remove(self, job_id: str) -> Optional[Job]:
+        """Forgets a finished job and deletes its workspace."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or not job.done:
+                return None
+            del self.jobs[job_id]
+        if job.workspace is not None:
+            job.workspace.cleanup()
+        return job
+
+    def expire(self):
+        """Removes finished jobs older than the TTL, together with their workspaces."""
+        now = time.time()
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job.done and job.finished_at is not None and now - job.finished_at > self.ttl]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            if job.workspace is not None:
+                job.workspace.cleanup()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
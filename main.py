@@ -1,15 +1,20 @@
 # 这个程序的目的是快速进行latex模板的修改
 # 引入包
 import os
-import zipfile
-import tempfile
+import json
+import time
 from shutil import rmtree
-import subprocess
 
 
 # 引入函数
 from function import *
-from targetTemplateMainTexMapping import target_template_main_tex_mapping  # 导入字典
+from template_cache import get_prepared_template, install_template_assets
+from workspace import Workspace
+from zipstream import iter_zip_folder, iter_zip_folders, write_zip_folder
+from taskgraph import TaskGraph
+from joblog import log
+from tracing import traced
+from compile_pool import get_compile_pool
 
 # 在总文件夹中，有很多个从外部下载下来的期刊latex模板作为例子
 # 你可以新建一个文件夹来放你需要被修改的latex文件，例如可以给这个文件夹起名叫做your_work_to_be_converted
@@ -26,90 +31,74 @@ from targetTemplateMainTexMapping import target_template_main_tex_mapping  # 导
 # target_template_folder = './'
 
 
-# 解压zip文件并删除 macOS 特有的 __MACOSX 文件夹
-def extract_zip(uploaded_zip):
-    # 创建临时目录
-    temp_dir = tempfile.mkdtemp()
-
-    # 解压 ZIP 文件
-    with zipfile.ZipFile(uploaded_zip, "r") as zip_ref:
-        zip_ref.extractall(temp_dir)
-
-    # 删除 macOS 特有的 __MACOSX 文件夹（如果存在）
-    macosx_folder = os.path.join(temp_dir, '__MACOSX')
-    if os.path.exists(macosx_folder):
-        rmtree(macosx_folder)  # 递归删除 __MACOSX 文件夹及其中的内容
-
-    # 检查解压后的文件夹结构，如果最外层文件夹包含多个文件夹，返回原目录
-    extracted_folders = os.listdir(temp_dir)
-
-    # 如果解压后的内容是多个文件或文件夹，并且需要保留原结构
-    if len(extracted_folders) == 1 and os.path.isdir(os.path.join(temp_dir, extracted_folders[0])):
-        # 如果只有一个文件夹，返回该文件夹路径
-        temp_dir = os.path.join(temp_dir, extracted_folders[0])
-
-    return temp_dir  # 返回解压后的文件夹路径
-
 # 压缩文件夹为.zip
-def zip_folder(folder_path, output_zip_path):
-    with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(folder_path):  # 不需要 dirs，所以用 `_` 占位
-            for file in files:
-                file_path = os.path.join(root, file)
-                zipf.write(file_path, os.path.relpath(file_path, folder_path))
+# pdf、png、jpg 等已经压缩过的文件直接存储；提供 source_zip 和解压清单时，没改过的文件直接从源 zip 复制（见 zipstream.py）
+@traced
+def zip_folder(folder_path, output_zip_path, source_zip=None, manifest=None):
+    return write_zip_folder(folder_path, output_zip_path, source_zip, manifest)
 
 # 删除原本的'./converted_result'文件夹并创建一个新的文件夹
 def reset_converted_result_folder(folder_path='./converted_result'):
     # 删除已存在的文件夹及其内容
     if os.path.exists(folder_path):
         shutil.rmtree(folder_path)
-        print(f"已删除文件夹: {folder_path}")
+        log(f"已删除文件夹: {folder_path}")
 
     # 创建新的空文件夹
     os.makedirs(folder_path)
-    print(f"已创建新的文件夹: {folder_path}")
+    log(f"已创建新的文件夹: {folder_path}")
 
 # 删除原本的'./converted_result.zip'文件（如果存在）
 def delete_existing_zip(zip_path='./converted_result.zip'):
     if os.path.exists(zip_path):
         os.remove(zip_path)
-        print(f"已删除文件: {zip_path}")
+        log(f"已删除文件: {zip_path}")
     else:
-        print(f"没有找到文件: {zip_path}")
+        log(f"没有找到文件: {zip_path}")
+
+# 一次转换的结果：转换好的文件夹，以及打包成 zip 需要的信息
+class ConversionResult:
+    def __init__(self, folder, zip_name, workspace, source_zip=None, manifest=None):
+        self.folder = folder  # 转换好的文件夹（工作区中的 converted_result）
+        self.zip_name = zip_name  # 打包后的 zip 文件名
+        self.workspace = workspace
+        self.source_zip = source_zip  # 源 zip（路径或文件对象），打包时从这里复制没改过的文件
+        self.manifest = manifest  # 解压清单（见 function.ingest_zip_with_manifest）
+
+    # 打包成工作区中的 zip 文件，返回路径
+    def write_zip(self):
+        zip_output_path = self.workspace.file(self.zip_name)
+        zip_folder(self.folder, zip_output_path, self.source_zip, self.manifest)
+        return zip_output_path
+
+    # 按块生成 zip 数据，不写到磁盘上，可以直接作为 HTTP 响应体
+    def iter_zip(self):
+        return iter_zip_folder(self.folder, self.source_zip, self.manifest)
+
+# 源文件的准备：源文件直接解压到这次任务自己工作区里的 converted_result 文件夹，之后的操作都在这个文件夹上进行，
+# 不会影响原始的 zip，也不会和同时进行的其他转换冲突；解压只做一次，不再额外复制一份副本
+# 返回 (源文件夹, 解压清单, 主tex文件路径)
+@traced
+def prepare_source(source_zip, main_tex_file, workspace, source_dir=None, source_manifest=None):
+    manifest = source_manifest
+    if source_dir is None:
+        converted_result_folder, manifest = ingest_zip_with_manifest(source_zip, os.path.join(workspace.path, 'converted_result'))
+    else:
+        converted_result_folder = source_dir
 
-# 把整个python文件封装成一个函数以便调用
-def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_template=None):
-    # 解压源文件和目标模板的.zip文件
-    your_work_folder = extract_zip(source_zip)
-    target_template_folder = extract_zip(template_zip)
-
-    # 为了不影响原始的文件，我们新建两个副本文件夹来放要被修改的文件和目标模板
-    # 之后的操作我们都在这两个副本文件夹上操作，最终的结果会储存在converted_result_folder文件夹中
-    
-    # 先删除原有的'./converted_result'文件夹并重新创建
-    reset_converted_result_folder('./converted_result')
-    # 删除原本的'./converted_result.zip'文件（如果存在）
-    delete_existing_zip('./converted_result.zip')
-
-    converted_result_folder = './converted_result'
-    target_template_folder_copy = './target_template_copy'
-
-    create_copy_folder(your_work_folder,converted_result_folder)
-    create_copy_folder(target_template_folder,target_template_folder_copy)
-
-    # 获取需修改文件和目标模板的tex文件
+    # 获取需修改文件的tex文件
     yourwork_tex_files = get_tex_files(converted_result_folder)
-    target_tex_files = get_tex_files(target_template_folder_copy)
+    yourwork_main_tex = None
 
     # 在实际操作中，发现一个完整的latex文件夹中可能出现多个tex文件，所以在这种情况时需要让用户手动选择以下哪个tex文件是论文主体的tex文件
 
     # 检查需修改的latex文件夹中是否有.tex文件
     if not yourwork_tex_files:
-        print("需修改的文件夹中没有 .tex 文件！")
+        log("需修改的文件夹中没有 .tex 文件！", 'error')
     # 如果只有一个 .tex 文件，自动选择
     elif len(yourwork_tex_files) == 1:
         yourwork_main_tex = yourwork_tex_files[0]
-        print(f"需修改的文件夹中只有一个.tex文件，自动选择: {yourwork_main_tex}\n")
+        log(f"需修改的文件夹中只有一个.tex文件，自动选择: {yourwork_main_tex}\n")
     # 如果有多个 .tex 文件
     elif len(yourwork_tex_files) > 1:
         # 如果提供了 main_tex_file，尝试找到匹配的文件
@@ -119,42 +108,27 @@ def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_t
 
             if matching_tex_files:
                 yourwork_main_tex = matching_tex_files[0]
-                print(f"用户选择的主文件: {yourwork_main_tex}\n")
+                log(f"用户选择的主文件: {yourwork_main_tex}\n")
             else:
-                print(f"错误：找不到名为 {main_tex_filename} 的 .tex 文件，请检查文件名是否正确。\n")
+                log(f"错误：找不到名为 {main_tex_filename} 的 .tex 文件，请检查文件名是否正确。\n", 'error')
         # 如果没有提供 main_tex_file，且有多个文件，报错
         else:
-            print("错误：需修改的文件夹中有多个 .tex 文件，请手动指定主文件。\n")
+            log("错误：需修改的文件夹中有多个 .tex 文件，请手动指定主文件。\n", 'error')
 
+    if yourwork_main_tex is None:
+        raise ValueError("没有找到需修改的主 .tex 文件")
+    return converted_result_folder, manifest, yourwork_main_tex
 
-    # 检查目标模板是否有 .tex 文件
-    if not target_tex_files:
-        print("目标模板文件夹中没有 .tex 文件！")
-    else:
-        # 如果目标模板文件夹中有多个 .tex 文件
-        if len(target_tex_files) > 1:
-            print(f"目标模板文件夹中有 {len(target_tex_files)} 个 .tex 文件：")
-
-            # 从字典中查找目标模板名称对应的主 .tex 文件
-            template_name = os.path.basename(template_zip)  # 获取模板名称（去掉路径部分）
-            if template_name in target_template_main_tex_mapping:
-                # 获取字典中对应的主tex文件名
-                target_main_tex = target_template_main_tex_mapping[template_name]
-                
-                # 检查目标模板文件夹中是否包含这个文件
-                matching_tex_files = [file for file in target_tex_files if os.path.basename(file) == target_main_tex]
-                if matching_tex_files:
-                    target_main_tex = matching_tex_files[0]
-                    print(f"自动选择的目标模板主文件: {target_main_tex}\n")
-                else:
-                    print(f"错误: 字典中指定的主文件 {target_main_tex} 未在目标模板文件夹中找到。\n")
-            else:
-                print(f"错误: 字典中找不到与模板 {template_name} 对应的主 .tex 文件。\n")
-        # 如果目标模板文件夹只有一个 .tex 文件
-        else:
-            target_main_tex = target_tex_files[0]
-            print(f"目标模板文件夹中只有一个 .tex 文件，自动选择: {target_main_tex}\n")
+# 源文件夹中原有的 sty 文件对应的包名，复制模板文件时这些 sty 文件会被删除，所以要先读取
+@traced
+def read_source_sty_names(source):
+    your_work_folder = source[0]
+    return get_sty_package_names(your_work_folder)
 
+# 修改源文件的主tex文件（只在内存中修改，不写回），和目标模板无关，转换到多个模板时只需要做一次
+@traced
+def prepare_source_doc(source, sty_package_names):
+    your_work_folder, _, yourwork_main_tex = source
 
     # 至此，我们已经新建了副本文件夹作为工作区，并找到了需修改和目标模板文件夹中的tex文件，下面我们需要对工作区中的tex文件内容进行一些修改
     # 做以下修改顺序的操作是为了分开\maketitle的部分和论文最开头定义排版格式的部分
@@ -168,79 +142,76 @@ def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_t
     # \institution{...}
     # \maketitle
 
+    # 被修改的主tex文件只读一次，之后所有修改都在内存中的 TexDocument 上进行，最后统一写回
+    yourwork_doc = TexDocument(yourwork_main_tex)
+
     # 对于被修改的文件夹中的论文主体tex文件：
 
     # （调试部分可删去）先来看一下最开始\maketitle在什么位置
-    origin_maketitle_line = find_maketitle_line(yourwork_main_tex)
-    print(f"最初\\maketitle 在第{origin_maketitle_line}行")
+    origin_maketitle_line = find_maketitle_line(yourwork_doc)
+    log(f"最初\\maketitle 在第{origin_maketitle_line}行")
 
     # 为了防止注释对后续操作进行影响，我们先将\maketitle上方的注释给删掉
-    remove_comments_before_maketitle(yourwork_main_tex)
+    remove_comments_before_maketitle(yourwork_doc)
 
     # （调试部分可删去）看一下删除注释后的\maketitle在什么位置
-    afterdeletecomment_maketitle_line = find_maketitle_line(yourwork_main_tex)
-    print(f"删除注释后新的\\maketitle 在第{afterdeletecomment_maketitle_line}行")
+    afterdeletecomment_maketitle_line = find_maketitle_line(yourwork_doc)
+    log(f"删除注释后新的\\maketitle 在第{afterdeletecomment_maketitle_line}行")
 
     # 将\begin{document}放到\maketitle的上面
-    move_begindocument_before_maketitle(yourwork_main_tex)
+    move_begindocument_before_maketitle(yourwork_doc)
 
     # 将\title{...},\author{...}, \institution{...}依次放到\maketitle的上面
-    modify_command_position(yourwork_main_tex, 'title')
-    modify_command_position(yourwork_main_tex, 'author')
-    modify_command_position(yourwork_main_tex, 'institute')
+    modify_commands_position(yourwork_doc, ['title', 'author', 'institute'])
 
     # 除此之外，对于目标模板文件夹，我们也做一样的操作
     # 做该操作的目的相同，是为了分开\maketitle的部分和论文最开头定义排版格式的部分
-    remove_comments_before_maketitle(target_main_tex)
-    move_begindocument_before_maketitle(target_main_tex)
-    modify_command_position(target_main_tex, 'title')
-    modify_command_position(target_main_tex, 'author')
-    modify_command_position(target_main_tex, 'institute')
+    # 这一步已经在 get_prepared_template 中完成（见 template_cache.py）
 
     # 我们已经做好了准备工作，下面正式来修改格式
 
     # 对于被修改的文件夹中的论文主体tex文件：
     # 删除被修改tex文件的\documentclass， \userpackage{sty_file_name}, 包含 mm 的 \usepackage{...} 语句
-    remove_documentclass(yourwork_main_tex)
-    remove_userpackage_sty_lines(your_work_folder, yourwork_main_tex)
-    remove_userpackage_mm_cm_lines(yourwork_main_tex)
+    remove_documentclass(yourwork_doc)
+    remove_userpackage_sty_lines(your_work_folder, yourwork_doc, sty_package_names)
+    remove_userpackage_mm_cm_lines(yourwork_doc)
 
     # 删掉\begin{document}上面除了\userpackage和\def之外的行
-    remove_lines_before_document(yourwork_main_tex)
+    remove_lines_before_document(yourwork_doc)
+    return yourwork_doc
 
-    # 识别新模板的sty和cls文件复制到旧模板里
-    manage_sty_files(target_template_folder_copy, converted_result_folder)
-    copy_cls_files(target_template_folder_copy, converted_result_folder)
+# 把准备好的目标模板应用到修改好的源文件主tex文件上，最后写回
+@traced
+def apply_target_template(prepared_template, yourwork_doc):
+    # 目标模板的主tex文件使用缓存中已经准备好的内容
+    target_doc = prepared_template.document()
 
     # 把目标模板的tex文件中的\begin{document}的前面的部分全部复制到old_main_tex中，即把目标模板的格式代码复制到被修改的tex文件最前面
-    copy_pre_document_to_first_line(target_main_tex, yourwork_main_tex)
+    copy_pre_document_to_first_line(target_doc, yourwork_doc)
 
     # ------------------------------
-    # 将目标文件夹下的.bst文件复制到被修改文件夹
-    copy_bst_files(target_template_folder_copy, converted_result_folder)
-
     # 将bibstyle改成目标模板的格式
-    process_tex_files(yourwork_main_tex, target_main_tex)
+    process_tex_files(yourwork_doc, target_doc)
 
     # ------------------------------
     # 以下是针对模板CVPR2022，ECCV2016，NeurIPS2024模板做出的补丁
     # 如果你没有使用这些模板，也可以不加载下面的内容
 
-    print("以下是针对模板CVPR2022，ECCV2016，NeurIPS2024模板做出的补丁修改")
+    log("以下是针对模板CVPR2022，ECCV2016，NeurIPS2024模板做出的补丁修改")
 
     # bug 1:
     # \begin{document}前加入\usepackage[OT1]{fontenc} 
-    add_fontenc_package(yourwork_main_tex)
+    add_fontenc_package(yourwork_doc)
 
     # bug 2:
     # 使用subfigure时会报错
     # 在\begin{document}之前插入\usepackage{subcaption}
-    add_subcaption_package_before_document(yourwork_main_tex)
+    add_subcaption_package_before_document(yourwork_doc)
 
     # bug 3:
     # 当一个文档出现两次hyperref包时会报错
     # 出现两次\userpackage{hyperref}，删掉后一个\userpackage{hyperref}
-    # remove_second_hyperref(yourwork_main_tex)
+    # remove_second_hyperref(yourwork_doc)
     # 更新：
     # 因为有些hyperref是自带在sty中的，所以这个方法并不合理
     # 手动注释掉报错的hyperref就可以了
@@ -253,7 +224,7 @@ def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_t
     #   \def\\{}%
     #   \def\texttt#1{<#1>}%
     # }
-    add_pdfstringdef_before_document(yourwork_main_tex)
+    add_pdfstringdef_before_document(yourwork_doc)
 
     # bug 5:
     # 当出现\eg等在原sty文件中的定义时出现bug，加入：
@@ -272,7 +243,7 @@ def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_t
     # \def\iid{i.i.d\onedot} 
     # \def\wolog{w.l.o.g\onedot}
     # \def\etal{\emph{et al}\onedot}
-    add_custom_macros_before_document(yourwork_main_tex)
+    add_custom_macros_before_document(yourwork_doc)
 
     # bug 6:
     # sty包受到大小写影响，比如emnlp2023.sty，要删掉\usepackage[review]{EMNLP2023}，因为大写所以没删成功
@@ -298,24 +269,69 @@ def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_t
 
     # return zip_output_path  # 返回处理好的zip文件路径
 
+    # 所有修改完成，把被修改的主tex文件写回一次
+    yourwork_doc.flush()
+
+# 把整个python文件封装成一个函数以便调用
+# 所有中间文件都放在 workspace 中（不传时新建一个），调用者用完结果后负责调用 workspace.cleanup() 删除
+# 如果调用者已经把源文件解压到了工作区（source_dir），就直接在这个文件夹上修改，不再解压和复制；
+# source_manifest 是解压时得到的清单，有它时打包可以直接复制没改过的文件
+# 返回 ConversionResult，需要 zip 文件时用 process_latex_files
+@traced
+def convert_latex_project(source_zip, template_zip, main_tex_file=None, selected_template=None, workspace=None,
+                          source_dir=None, source_manifest=None):
+    if workspace is None:
+        workspace = Workspace()
+
+    # 在 copy_pre_document_to_first_line 之前，源文件的准备、目标模板的准备和复制模板文件互不依赖，
+    # 所以把它们登记成任务依赖图（见 taskgraph.py），依赖都完成的任务同时运行：
+    #   target      目标模板的准备
+    #   source      解压源文件、找到主tex文件
+    #   sty_names   源文件夹中 sty 文件对应的包名（要在复制模板的 sty 文件之前读取）
+    #   source_doc  修改源文件的主tex文件（依赖 source、sty_names）
+    #   assets      把模板的 sty、cls、bst 文件复制过来（依赖 target、source、sty_names）
+
+    # 目标模板的准备工作（找主tex文件、删除注释、移动\begin{document}和\title等）对同一个模板每次都一样，
+    # 所以直接使用按模板内容哈希缓存好的结果，不需要再解压和复制整个目标模板文件夹
+    @traced(name='prepare_target')
+    def prepare_target():
+        return get_prepared_template(template_zip)
+
+    # 识别新模板的sty、cls和bst文件复制到旧模板里
+    @traced(name='install_template_assets')
+    def copy_template_assets(prepared_template, source, sty_package_names):
+        install_template_assets(prepared_template, source[0])
+
+    graph = TaskGraph()
+    graph.add('target', prepare_target)
+    graph.add('source', lambda: prepare_source(source_zip, main_tex_file, workspace, source_dir, source_manifest))
+    graph.add('sty_names', read_source_sty_names, ['source'])
+    graph.add('source_doc', prepare_source_doc, ['source', 'sty_names'])
+    graph.add('assets', copy_template_assets, ['target', 'source', 'sty_names'])
+    results = graph.run()
+
+    prepared_template = results['target']
+    converted_result_folder, source_manifest, _ = results['source']
+    yourwork_doc = results['source_doc']
+
+    # 之后的修改依赖前面所有的结果，按顺序进行
+    apply_target_template(prepared_template, yourwork_doc)
+
     # 获取文件的名称
     source_zip_name = source_zip.name if hasattr(source_zip, 'name') else 'source_zip'  # 获取源文件的文件名
     template_zip_name = selected_template  # 获取模板文件的文件名
 
-    print(selected_template)
-    print(template_zip_name)
+    log(selected_template, 'debug')
+    log(template_zip_name, 'debug')
 
     # 获取文件名的前五个字符
     source_prefix = source_zip_name[:5]
     template_prefix = template_zip_name[:5]  # 直接使用 selected_template
 
     # 构建新的压缩文件名
-    zip_output_path = f'./{source_prefix} To {template_prefix} result.zip'
+    zip_name = f'{source_prefix} To {template_prefix} result.zip'
 
-    # 调用压缩函数
-    zip_folder(converted_result_folder, zip_output_path)
-
-    return zip_output_path  # 返回处理好的zip文件路径
+    return ConversionResult(converted_result_folder, zip_name, workspace, source_zip, source_manifest)
 
 
 
@@ -398,45 +414,107 @@ def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_t
     # 如果没有自动生成pdf文件，请使用你的模糊编译latex文件的插件再次对tex文件进行编译
     # 如果有红色错误，请把红色的部分给注释掉，再跑就能成功跑起来了
 
+# 转换并打包成 zip，返回工作区中 zip 文件的路径
+def process_latex_files(source_zip, template_zip, main_tex_file=None, selected_template=None, workspace=None,
+                        source_dir=None, source_manifest=None):
+    result = convert_latex_project(source_zip, template_zip, main_tex_file, selected_template, workspace,
+                                   source_dir, source_manifest)
+    return result.write_zip()  # 返回处理好的zip文件路径
+
+# 一个源文件转换到多个模板的结果：每个模板一个转换好的文件夹，以及每个模板的状态
+class FanoutResult:
+    def __init__(self, results, workspace, source_zip=None, manifest=None):
+        self.results = results  # [{'template':, 'status': 'succeeded'/'failed', 'folder':, 'error':, 'seconds':}...]，按传入的模板顺序
+        self.workspace = workspace
+        self.source_zip = source_zip
+        self.manifest = manifest
+
+    # 每个模板的状态（不包含工作区中的路径），会作为 summary.json 放进 zip
+    def summary(self):
+        return {
+            'succeeded': sum(1 for result in self.results if result['status'] == 'succeeded'),
+            'failed': sum(1 for result in self.results if result['status'] == 'failed'),
+            'templates': [{key: value for key, value in result.items() if key != 'folder'} for result in self.results],
+        }
+
+    # 按块生成 zip 数据：每个转换成功的模板一个文件夹，最外层再加一个 summary.json
+    # 所有文件夹都是从同一个源文件夹克隆出来的，没改过的文件直接从源 zip 复制
+    def iter_zip(self):
+        folders = [(result['template'], result['folder']) for result in self.results if result['status'] == 'succeeded']
+        summary = json.dumps(self.summary(), ensure_ascii=False, indent=2).encode('utf-8')
+        return iter_zip_folders(folders, self.source_zip, self.manifest, [('summary.json', summary)])
+
+# 把一个源文件同时转换成多个模板
+# 源文件只解压、修改一次（prepare_source、prepare_source_doc），之后每个模板把源文件夹克隆一份（见 clone_tree），
+# 在克隆上复制模板文件并应用模板；各个模板的准备和转换同时进行，一个模板出错不影响其他模板
+# template_zips 是 [(模板名称, 模板 zip 路径)...]；返回 FanoutResult
+@traced
+def convert_latex_project_to_templates(source_zip, template_zips, main_tex_file=None, workspace=None,
+                                       source_dir=None, source_manifest=None, max_workers=None):
+    if workspace is None:
+        workspace = Workspace()
+
+    # 准备一个模板，出错时返回错误，由转换任务记录下来
+    @traced(name='prepare_target')
+    def prepare_target(template_zip):
+        try:
+            return get_prepared_template(template_zip)
+        except Exception as e:
+            return e
+
+    # 在源文件夹的克隆上应用一个模板
+    @traced
+    def convert_to_template(template_name, prepared_template, source, sty_package_names, source_doc):
+        start = time.time()
+        result = {'template': template_name, 'status': 'succeeded', 'folder': None, 'error': None}
+        folder = os.path.join(workspace.path, 'results', template_name)
+        try:
+            if isinstance(prepared_template, Exception):
+                raise prepared_template
+            your_work_folder, _, yourwork_main_tex = source
+            clone_tree(your_work_folder, folder)
+            install_template_assets(prepared_template, folder)
+            # 修改好的主tex文件内容复制一份，写到克隆的文件夹中
+            yourwork_doc = TexDocument(os.path.join(folder, os.path.relpath(yourwork_main_tex, your_work_folder)),
+                                       source_doc.lines)
+            yourwork_doc.dirty = True
+            apply_target_template(prepared_template, yourwork_doc)
+            result['folder'] = folder
+        except Exception as e:
+            log(f"转换到模板 {template_name} 时出错: {e}", 'error')
+            rmtree(folder, ignore_errors=True)
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    graph = TaskGraph()
+    graph.add('source', lambda: prepare_source(source_zip, main_tex_file, workspace, source_dir, source_manifest))
+    graph.add('sty_names', read_source_sty_names, ['source'])
+    graph.add('source_doc', prepare_source_doc, ['source', 'sty_names'])
+    for index, (template_name, template_zip) in enumerate(template_zips):
+        graph.add(f'target:{index}', lambda template_zip=template_zip: prepare_target(template_zip))
+        graph.add(f'convert:{index}', lambda *args, template_name=template_name: convert_to_template(template_name, *args),
+                  [f'target:{index}', 'source', 'sty_names', 'source_doc'])
+    results = graph.run(max_workers or min(len(graph.tasks), (os.cpu_count() or 1) + 4))
+
+    # 源文件夹只用来克隆，本身没有被修改，所以解压清单对所有克隆都适用
+    _, source_manifest, _ = results['source']
+    template_results = [results[f'convert:{index}'] for index in range(len(template_zips))]
+    return FanoutResult(template_results, workspace, source_zip, source_manifest)
+
 # -----------------------
 # 从这里开始是pdf preview的内容
 
-# import subprocess 上面已经调用过了
 # import os
 
-def compile_latex(method, main_tex_file):  # 添加 main_tex_file 参数
-    folder_path = os.path.abspath('./converted_result')  # 使用绝对路径
-    tex_filename = main_tex_file  # 直接使用传入的 main_tex_file
-
-    tex_path = os.path.join(folder_path, tex_filename)
-
-    if not os.path.exists(tex_path):
-        return f"Error: {tex_path} not found."
-
-    commands = []
-
-    if method == "pdflatex":
-        commands.append(["pdflatex", "-interaction=nonstopmode", tex_filename])
-    elif method == "xelatex":
-        commands.append(["xelatex", "-interaction=nonstopmode", tex_filename])
-    elif method == "xelatex*2":
-        commands.append(["xelatex", "-interaction=nonstopmode", tex_filename])
-        commands.append(["xelatex", "-interaction=nonstopmode", tex_filename])
-    elif method == "xelatex -> bibtex -> xelatex*2":
-        commands.append(["xelatex", "-interaction=nonstopmode", tex_filename])
-        commands.append(["bibtex", "main"])  # bibtex 只需要 .aux 文件的前缀
-        commands.append(["xelatex", "-interaction=nonstopmode", tex_filename])
-        commands.append(["xelatex", "-interaction=nonstopmode", tex_filename])
-    else:
-        return "Invalid method"
-
-    for cmd in commands:
-        result = subprocess.run(cmd, cwd=folder_path, capture_output=True, text=True)
-        if result.returncode != 0:
-            return f"Error in {cmd[0]}: {result.stderr}"
-
-    pdf_path = os.path.join(folder_path, "main.pdf")
-    return pdf_path if os.path.exists(pdf_path) else "Error: PDF not generated."
+# folder_path 是转换结果所在的文件夹（process_latex_files 的工作区中的 converted_result）
+# 实际运行哪些命令由 compile_engine.py 按 .aux/.bbl 的变化决定，成功时返回 PDF 路径，出错时返回 "Error ..." 字符串
+# 编译在编译任务池中隔离运行，有超时和资源限制（见 compile_pool.py）
+@traced
+def compile_latex(method, main_tex_file, folder_path='./converted_result'):  # 添加 main_tex_file 参数
+    result = get_compile_pool().submit(method, main_tex_file, folder_path, use_cache=False).result()
+    return result.error if result.error is not None else result.pdf_path
 
 
 
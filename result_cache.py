@@ -0,0 +1,134 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+# Where converted result zips are kept, and how much / how long to keep them.
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "./result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", str(24 * 3600)))
+
+
+def conversion_cache_key(source_sha256: str, template_sha256: str, main_tex: Optional[str]) -> str:
+    """Content address of a conversion: the same source, template and main_tex always give the same result."""
+    return hashlib.sha256(f"{source_sha256}:{template_sha256}:{main_tex or ''}".encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Directory of result zips named by their conversion key, evicted by TTL and then least recently used."""
+
+    def __init__(self, directory: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES,
+                 ttl: int = RESULT_CACHE_TTL):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.zip")
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the path of the cached result, or None if it is missing or expired."""
+        path = self._path(key)
+        with self.lock:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            if time.time() - stat.st_mtime > self.ttl:
+                self._remove(path)
+                self.misses += 1
+                return None
+            # mtime is the creation time (TTL) and atime the last use (LRU); atime is set explicitly
+            # because filesystems are often mounted with noatime.
+            os.utime(path, (time.time(), stat.st_mtime))
+            self.hits += 1
+            return path
+
+    def put(self, key: str, result_path: str) -> str:
+        """Stores a copy of result_path under key and evicts old entries if the cache is over budget."""
+        path = self._path(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copyfile(result_path, temp_path)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+        return path
+
+    def entries(self) -> List[Dict[str, Any]]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".zip"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append({
+                "key": name[:-len(".zip")],
+                "size": stat.st_size,
+                "created_at": stat.st_mtime,
+                "last_used_at": stat.st_atime,
+            })
+        return entries
+
+    def evict(self):
+        """Drops expired entries, then the least recently used ones until the cache fits in max_bytes."""
+        with self.lock:
+            now = time.time()
+            entries = self.entries()
+            for entry in entries:
+                if now - entry["created_at"] > self.ttl:
+                    self._remove(self._path(entry["key"]))
+            entries = sorted((e for e in entries if now - e["created_at"] <= self.ttl), key=lambda e: e["last_used_at"])
+            total = sum(entry["size"] for entry in entries)
+            while entries and total > self.max_bytes:
+                entry = entries.pop(0)
+                self._remove(self._path(entry["key"]))
+                total -= entry["size"]
+
+    def purge(self, key: Optional[str] = None) -> int:
+        """Removes one entry, or every entry when key is None. Returns the number of files removed."""
+        with self.lock:
+            keys = [key] if key else [entry["key"] for entry in self.entries()]
+            removed = 0
+            for k in keys:
+                if self._remove(self._path(k)):
+                    removed += 1
+            return removed
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self.entries()
+        with self.lock:
+            return {
+                "directory": self.directory,
+                "entries": len(entries),
+                "bytes": sum(entry["size"] for entry in entries),
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logging.warning(f"Could not remove cached result {path}: {e}")
+            return False
@@ -6,21 +6,24 @@ import os
 import zipfile
 import tempfile
 import shutil
-import sys
-import io
-import time
 from main import process_latex_files
-from main import compile_latex
+from compile_pool import get_compile_pool
+from workspace import Workspace
 from streamlit_pdf_viewer import pdf_viewer
-from targetTemplateRecCompileMapping import target_template_rec_compile_mapping
+from template_registry import get_template_registry
+from joblog import JobLog, job_log_context
 
 # 预设模板文件夹
 TEMPLATE_FOLDER = "./templates"
+# 模板注册表（templates/registry.json），记录每个模板的主 tex 文件和推荐编译方式
+template_registry = get_template_registry(TEMPLATE_FOLDER)
+# 所有会话共用的编译任务池，同时运行的编译数量有上限
+compile_pool = get_compile_pool()
 
 
 def get_available_templates():
-    """获取 `./templates` 目录下所有的 .zip 模板文件"""
-    return [f for f in os.listdir(TEMPLATE_FOLDER) if f.endswith('.zip')]  # 保留完整的文件名，包括.zip后缀
+    """获取模板注册表中所有的 .zip 模板文件"""
+    return template_registry.zip_names()  # 保留完整的文件名，包括.zip后缀
 
 
 def extract_zip(uploaded_zip):
@@ -57,33 +60,6 @@ def get_tex_files_from_zip(uploaded_zip):
 
     return tex_files, temp_dir  # 返回所有 .tex 文件名和解压路径
 
-# 捕获 print() 输出
-def capture_output(func, *args, **kwargs):
-    """捕获函数执行过程中所有 print() 输出"""
-    buffer = io.StringIO()
-    sys.stdout = buffer  # 重定向标准输出
-    try:
-        return func(*args, **kwargs), buffer.getvalue()  # 执行函数并捕获输出
-    finally:
-        sys.stdout = sys.__stdout__  # 还原标准输出
-
-# 更新 Mapping 文件
-def add_template_to_mapping(mapping_file, full_template_name, main_tex_name):
-    # 读取现有内容
-    with open(mapping_file, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
-    # 查找字典的结尾位置
-    for i, line in enumerate(lines):
-        if line.strip() == "}":  # 字典的结尾部分
-            # 在字典结束符号前插入新的映射
-            lines.insert(i, f'    "{full_template_name}": "{main_tex_name}",\n')
-            break
-
-    # 重新写回文件
-    with open(mapping_file, "w", encoding="utf-8") as f:
-        f.writelines(lines)
-
 def main():
     st.title("LaTeX模板转换工具")
     
@@ -92,6 +68,12 @@ def main():
         st.session_state.main_tex_file = None
     if "show_tex_selector" not in st.session_state:
         st.session_state.show_tex_selector = False
+    # 每个会话有自己的工作区，多个会话同时转换、编译时互不影响
+    if "workspace" not in st.session_state:
+        st.session_state.workspace = None
+    # 编译缓存中这个项目的标识（源文件 + 目标模板 + 主 tex 文件），重新转换后用它找到上一次编译的辅助文件
+    if "compile_project" not in st.session_state:
+        st.session_state.compile_project = None
 
     # 上传源文件的压缩包
     uploaded_source_zip = st.file_uploader("选择包含 LaTeX 文件的压缩包 (ZIP)", type="zip")
@@ -127,11 +109,22 @@ def main():
                 # 目标模板的压缩包路径
                 template_zip_path = os.path.join(TEMPLATE_FOLDER, selected_template)
 
-                # 调用封装后的函数进行处理
-                # 捕获 process_latex_files() 的输出，并获取生成的 zip 文件路径
-                zip_output_path, output_text = capture_output(
-                    process_latex_files, uploaded_source_zip, template_zip_path, st.session_state.main_tex_file, selected_template
+                # 重新转换时删除这个会话上一次的工作区，再新建一个
+                if st.session_state.workspace is not None:
+                    st.session_state.workspace.cleanup()
+                st.session_state.workspace = Workspace()
+                st.session_state.compile_project = (
+                    f"{uploaded_source_zip.name}|{selected_template}|{st.session_state.main_tex_file}"
                 )
+
+                # 调用封装后的函数进行处理
+                # 转换过程中的消息记录到这次转换自己的日志中（见 joblog.py），不再重定向全局的 stdout，多个会话同时转换也不会混在一起
+                job_log = JobLog(st.session_state.workspace.id)
+                with job_log_context(job_log):
+                    zip_output_path = process_latex_files(
+                        uploaded_source_zip, template_zip_path, st.session_state.main_tex_file, selected_template,
+                        workspace=st.session_state.workspace
+                    )
                 
                 # 显示下载按钮
                 with open(zip_output_path, 'rb') as f:
@@ -142,7 +135,10 @@ def main():
                         mime="application/zip"
                     )
                 # 在页面底部显示日志
-                st.text_area("程序运行日志:", output_text, height=300)
+                st.text_area("程序运行日志:", job_log.text(), height=300)
+                # 每一步的详细事件（步骤、文件、删除/插入的行数、耗时）
+                with st.expander("详细日志事件"):
+                    st.dataframe(job_log.to_list())
 
             except Exception as e:
                 st.error(f"处理过程中发生错误: {e}")
@@ -166,8 +162,8 @@ def main():
     )
 
     # 给出推荐的编译方式
-    if selected_template in target_template_rec_compile_mapping:
-        rec_compile_method = target_template_rec_compile_mapping[selected_template]
+    rec_compile_method = template_registry.compile_method(selected_template)
+    if rec_compile_method is not None:
         st.write(f"该模板推荐的编译方式为：{rec_compile_method}")
 
     # 只有在 main_tex_file 存在时才允许 PDF 预览
@@ -177,21 +173,33 @@ def main():
         if "pdf_binary_data" in st.session_state:
             del st.session_state.pdf_binary_data
 
-        if st.session_state.main_tex_file:
-            pdf_path = compile_latex(method, st.session_state.main_tex_file)
+        if st.session_state.main_tex_file and st.session_state.workspace is None:
+            st.error("请先完成转换，再预览 PDF。")
+        elif st.session_state.main_tex_file:
+            # 在这个会话自己的工作区中编译
+            folder_path = os.path.join(st.session_state.workspace.path, "converted_result")
+            with st.spinner("正在编译..."):
+                # 项目没有变化时直接使用缓存的 PDF；有变化时从上一次编译的辅助文件开始（见 compile_cache.py）
+                # 编译在任务池中隔离运行，有时间和资源限制，失控的文档不会一直卡住这个会话（见 compile_pool.py）
+                compile_job = compile_pool.submit(method, st.session_state.main_tex_file, folder_path,
+                                                  project=st.session_state.compile_project)
+                compile_result = compile_job.result()
+            # 编译是同步完成的，不需要再等待；显示实际运行了哪些命令
+            st.caption(f"运行了 {len(compile_result.passes)} 条命令：{compile_result.summary()}")
+            if compile_result.usage is not None:
+                st.caption(f"用时 {compile_result.usage['wall']:.1f}s，CPU "
+                           f"{compile_result.usage['user_cpu'] + compile_result.usage['system_cpu']:.1f}s，"
+                           f"内存峰值 {compile_result.usage['max_rss_kb'] // 1024} MB")
+            pdf_path = compile_result.error if compile_result.error is not None else compile_result.pdf_path
 
             # 调试输出 PDF 生成路径
             # st.write(f"生成的 PDF 路径: {pdf_path}")
 
-            st.text("正在加载...")
-            time.sleep(5)  # 暂停5秒，也可以改成暂停更久的情况，这是为了以防还没编译出来就直接报错说没pdf的情况
-
             # 如果 pdf_path 存在，则直接使用它
             if pdf_path and os.path.exists(pdf_path):
                 st.success("编译成功！")
             else:
                 # 可能存在部分错误，尝试寻找与 main_tex_file 同名的 PDF
-                folder_path = "./converted_result"  # 确保文件夹路径指向 './converted_result'
                 fallback_pdf_path = os.path.join(folder_path, os.path.splitext(st.session_state.main_tex_file)[0] + ".pdf")
                 # st.write(f"找到 PDF 路径: {fallback_pdf_path}")
                 
@@ -256,11 +264,8 @@ def main():
                 with open(template_path, "wb") as f:
                     f.write(uploaded_template.getbuffer())
 
-                # 更新 targetTemplateMainTexMapping.py 文件
-                add_template_to_mapping("targetTemplateMainTexMapping.py", full_template_name, main_tex_name)
-
-                # 更新 targetTemplateRecCompileMapping 文件
-                add_template_to_mapping("targetTemplateRecCompileMapping.py", full_template_name, method_name)
+                # 在模板注册表中登记主 .tex 文件和推荐编译方式
+                template_registry.register(full_template_name, main_tex_name, method_name)
 
                 st.success(f"模板 {full_template_name} 上传成功，主 .tex 文件设为 {main_tex_name}，推荐编译方式设为 {method_name}！")
                 st.info("请刷新页面，在下拉菜单中查看新模板。")
@@ -1,4 +1,5 @@
 # 模板文件与主tex文件的映射
+# 只在第一次生成模板注册表（templates/registry.json，见 template_registry.py）时使用，之后新增的模板登记在注册表中
 target_template_main_tex_mapping = {
     "ACM Conference Proceedings Standard Template.zip": "sample-sigconf-xelatex.tex", 
     "ACM Journals Primary Article Template.zip": "sample-manuscript.tex",  
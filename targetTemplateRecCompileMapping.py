@@ -1,4 +1,5 @@
 # 模板文件与编译方式的映射
+# 只在第一次生成模板注册表（templates/registry.json，见 template_registry.py）时使用，之后新增的模板登记在注册表中
 target_template_rec_compile_mapping = {
     "ACM Conference Proceedings Standard Template.zip": "xelatex -> bibtex -> xelatex*2", 
     "ACM Journals Primary Article Template.zip": "xelatex -> bibtex -> xelatex*2",  
@@ -0,0 +1,56 @@
+# 这个文件用来放一个很小的任务依赖图
+# 一次转换中有几步互不依赖（源文件的准备、目标模板的准备、复制 sty/cls/bst 文件），
+# 把每一步登记成一个任务并写明它依赖哪些任务，依赖都完成的任务就可以同时运行
+
+# 导入包
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# 任务依赖图
+# add() 登记任务，任务函数的参数依次是它所依赖的任务的结果；run() 运行所有任务并返回 {任务名: 结果}
+class TaskGraph:
+    def __init__(self):
+        self.tasks = {}  # {任务名: (函数, 依赖的任务名)}，按登记顺序
+
+    def add(self, name, func, deps=()):
+        if name in self.tasks:
+            raise ValueError(f"任务 {name} 已经存在")
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"任务 {name} 依赖的任务 {dep} 还没有登记")
+        self.tasks[name] = (func, tuple(deps))
+        return name
+
+    # 运行所有任务；有任务出错时不再启动新的任务，等正在运行的任务结束后抛出第一个错误
+    def run(self, max_workers=None):
+        results = {}
+        running = {}  # {Future: 任务名}
+        waiting = dict(self.tasks)
+        error = None
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(self.tasks) or 1, thread_name_prefix='task') as executor:
+            while waiting or running:
+                if error is None:
+                    # 启动所有依赖都已完成的任务
+                    for name, (func, deps) in list(waiting.items()):
+                        if all(dep in results for dep in deps):
+                            del waiting[name]
+                            # 线程池中的线程不会继承 contextvars，每个任务在调用者上下文的副本中运行（例如当前任务的日志，见 joblog.py）
+                            future = executor.submit(contextvars.copy_context().run, func, *(results[dep] for dep in deps))
+                            running[future] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+
+        if error is not None:
+            raise error
+        return results
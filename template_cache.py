@@ -0,0 +1,329 @@
+# 这个文件用来放目标模板的预处理缓存
+# 同一个目标模板每次转换时做的准备工作（解压、找主 tex、删注释、移动 \begin{document}、移动 \title 等）结果都一样，
+# 所以按模板 zip 的内容哈希把准备好的结果缓存起来，转换时直接使用，不再解压和复制整个模板文件夹
+
+# 导入包
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from function import (
+    TexDocument,
+    file_sha256,
+    replace_file,
+    find_bibliographystyle,
+    remove_comments_before_maketitle,
+    move_begindocument_before_maketitle,
+    modify_commands_position,
+)
+from joblog import log
+from template_registry import TEMPLATE_FOLDER, get_template_registry
+from template_pack import TemplatePack, write_pack
+from template_reader import TemplateZip
+
+
+# 缓存最多保存多少个模板、最多占用多少字节，可以用环境变量修改
+TEMPLATE_CACHE_MAX_ENTRIES = int(os.environ.get('TEMPLATE_CACHE_MAX_ENTRIES', '32'))
+TEMPLATE_CACHE_MAX_BYTES = int(os.environ.get('TEMPLATE_CACHE_MAX_BYTES', str(128 * 1024 * 1024)))
+# 准备好的模板保存成模板包（见 template_pack.py）的文件夹，同一台机器上的所有 worker 共用
+TEMPLATE_PACK_DIR = os.environ.get('TEMPLATE_PACK_DIR', os.path.join(TEMPLATE_FOLDER, '.packs'))
+
+
+# 模板 zip 的哈希按 (路径, 大小, 修改时间) 记下来，文件没变时不用每次都重新读一遍
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def template_zip_sha256(template_zip):
+    stat = os.stat(template_zip)
+    # 注册表中已经记着模板 zip 的哈希，zip 没有被替换过时直接使用
+    entry = registered_entry(template_zip)
+    if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+        return entry['sha256']
+    signature = (os.path.abspath(template_zip), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if signature in _hash_cache:
+            return _hash_cache[signature]
+    digest = file_sha256(template_zip)
+    with _hash_lock:
+        _hash_cache[signature] = digest
+    return digest
+
+
+# 准备好的目标模板
+class PreparedTemplate:
+    def __init__(self, key, template_name, main_tex, lines, sty_files, cls_files, bst_files, pack=None):
+        self.key = key
+        self.template_name = template_name
+        self.main_tex = main_tex  # 主 tex 文件在模板中的相对路径
+        self.lines = tuple(lines)  # 处理好的主 tex 文件内容
+        self.sty_files = sty_files  # [(文件名, 内容 bytes)...]，模板最外层的 .sty 文件
+        self.cls_files = cls_files  # 模板最外层的 .cls 文件
+        self.bst_files = bst_files  # 模板中所有的 .bst 文件
+        self.pack = pack  # 从模板包加载时，文件内容是这个包的 mmap 切片
+        self.bibliography_style = find_bibliographystyle(self.document())
+
+    # 返回一个内存中的主 tex 文档副本，修改它不会影响缓存
+    def document(self):
+        return TexDocument(lines=self.lines)
+
+    # \begin{document} 之前的导言区
+    @property
+    def preamble(self):
+        begin_document_index = self.document().find_anchor('\\begin{document}')
+        if begin_document_index is None:
+            return []
+        return list(self.lines[:begin_document_index])
+
+    # 所有要复制到转换结果中的文件
+    @property
+    def assets(self):
+        return self.sty_files + self.cls_files + self.bst_files
+
+    # 估计占用的内存大小（模板包中的文件在共享的页缓存里，不算在内）
+    @property
+    def size(self):
+        size = sum(len(line) for line in self.lines)
+        if self.pack is None:
+            size += sum(len(data) for _, data in self.assets)
+        return size
+
+
+# 按 LRU 淘汰的模板缓存，同时限制个数和总字节数
+class TemplateCache:
+    def __init__(self, max_entries=TEMPLATE_CACHE_MAX_ENTRIES, max_bytes=TEMPLATE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.pending = {}  # 正在后台准备的模板 {键: Future}（见 warmup.py）
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        with self.lock:
+            prepared = self.entries.get(key)
+            if prepared is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return prepared
+
+    def put(self, prepared):
+        with self.lock:
+            if prepared.key in self.entries:
+                self.total_bytes -= self.entries.pop(prepared.key).size
+            self.entries[prepared.key] = prepared
+            self.total_bytes += prepared.size
+            # 超出限制时淘汰最久没有使用的模板（至少保留刚放进去的这一个）
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+
+    # 登记一个正在后台准备的模板，准备好之前来的转换等它完成，不重复准备
+    def add_pending(self, key, future):
+        with self.lock:
+            self.pending[key] = future
+
+    def remove_pending(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def get_pending(self, key):
+        with self.lock:
+            return self.pending.get(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+template_cache = TemplateCache()
+
+
+# 模板在注册表中的登记信息（模板 zip 所在文件夹的注册表），没有登记时返回 None
+def registered_entry(template_zip):
+    return get_template_registry(os.path.dirname(template_zip) or '.').get(os.path.basename(template_zip))
+
+# 模板注册表中登记的主 tex 文件名
+def registered_main_tex(template_zip):
+    entry = registered_entry(template_zip)
+    return entry['main_tex'] if entry else None
+
+# 在模板的 tex 文件中找主 tex 文件
+# 只有一个 tex 文件时直接使用；有多个时按模板注册表中登记的主 tex 文件名查找
+def find_target_main_tex(target_tex_files, template_name, target_main_tex=None):
+    # 检查目标模板是否有 .tex 文件
+    if not target_tex_files:
+        raise ValueError("目标模板文件夹中没有 .tex 文件！")
+
+    # 如果目标模板文件夹只有一个 .tex 文件
+    if len(target_tex_files) == 1:
+        log(f"目标模板文件夹中只有一个 .tex 文件，自动选择: {target_tex_files[0]}\n")
+        return target_tex_files[0]
+
+    # 如果目标模板文件夹中有多个 .tex 文件，使用注册表中登记的主 .tex 文件
+    log(f"目标模板文件夹中有 {len(target_tex_files)} 个 .tex 文件：")
+    if not target_main_tex:
+        raise ValueError(f"错误: 注册表中找不到与模板 {template_name} 对应的主 .tex 文件。")
+
+    # 检查目标模板文件夹中是否包含这个文件
+    matching_tex_files = [file for file in target_tex_files if os.path.basename(file) == target_main_tex]
+    if not matching_tex_files:
+        raise ValueError(f"错误: 注册表中指定的主文件 {target_main_tex} 未在目标模板文件夹中找到。")
+
+    log(f"自动选择的目标模板主文件: {matching_tex_files[0]}\n")
+    return matching_tex_files[0]
+
+# 读取文件夹中指定后缀的文件，recursive 为 False 时只看最外层
+def read_asset_files(folder, extension, recursive=False):
+    if recursive:
+        paths = [os.path.join(root, file) for root, _, files in os.walk(folder) for file in files if file.endswith(extension)]
+    else:
+        paths = [os.path.join(folder, file) for file in os.listdir(folder) if file.endswith(extension)]
+
+    assets = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            assets.append((os.path.basename(path), file.read()))
+    return assets
+
+# 对目标模板做一次完整的准备工作
+# 直接从 zip 中读取主 tex 文件和 sty、cls、bst 文件，模板中的其他文件（示例图片、pdf 等）不解压
+def prepare_template(template_zip, key=None):
+    template_name = os.path.basename(template_zip)  # 获取模板名称（去掉路径部分）
+    with TemplateZip(template_zip) as template:
+        target_main_tex = find_target_main_tex(template.tex_files(), template_name, registered_main_tex(template_zip))
+
+        # 为了分开\maketitle的部分和论文最开头定义排版格式的部分，对目标模板的主tex文件做和被修改文件一样的准备
+        target_doc = TexDocument(lines=template.read_lines(target_main_tex))
+        remove_comments_before_maketitle(target_doc)
+        move_begindocument_before_maketitle(target_doc)
+        modify_commands_position(target_doc, ['title', 'author', 'institute'])
+
+        return PreparedTemplate(
+            key=key,
+            template_name=template_name,
+            main_tex=target_main_tex,
+            lines=target_doc.lines,
+            sty_files=template.read_assets('.sty'),
+            cls_files=template.read_assets('.cls'),
+            bst_files=template.read_assets('.bst', recursive=True),
+        )
+
+# 模板包的路径，文件名由缓存的键决定
+def template_pack_path(key):
+    return os.path.join(TEMPLATE_PACK_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + '.pack')
+
+# 把准备好的模板保存成模板包
+def save_template_pack(prepared):
+    meta = {
+        'key': prepared.key,
+        'template_name': prepared.template_name,
+        'main_tex': prepared.main_tex,
+        'lines': list(prepared.lines),
+    }
+    members = ([(name, 'sty', data) for name, data in prepared.sty_files]
+               + [(name, 'cls', data) for name, data in prepared.cls_files]
+               + [(name, 'bst', data) for name, data in prepared.bst_files])
+    return write_pack(template_pack_path(prepared.key), meta, members)
+
+# 从模板包加载准备好的模板，没有包（或包已损坏）时返回 None
+def load_template_pack(key):
+    pack_path = template_pack_path(key)
+    if not os.path.exists(pack_path):
+        return None
+    try:
+        pack = TemplatePack(pack_path)
+    except (OSError, ValueError) as e:
+        log(f"模板包 {pack_path} 无法读取: {e}", 'warning')
+        return None
+    if pack.meta.get('key') != key:
+        return None
+    return PreparedTemplate(
+        key=key,
+        template_name=pack.meta['template_name'],
+        main_tex=pack.meta['main_tex'],
+        lines=pack.meta['lines'],
+        sty_files=pack.files('sty'),
+        cls_files=pack.files('cls'),
+        bst_files=pack.files('bst'),
+        pack=pack,
+    )
+
+# 准备模板并保存成模板包（已经有包时直接返回），返回包的路径
+# 在预热的进程池中运行（见 warmup.py），只返回路径，模板内容由各个进程 mmap 同一个包来共享
+def build_template_pack(template_zip, key):
+    if load_template_pack(key) is None:
+        save_template_pack(prepare_template(template_zip, key))
+    return template_pack_path(key)
+
+# 缓存的键：模板 zip 的内容哈希，加上注册表中登记的主 tex 文件名（登记的不同准备结果也不同）
+def template_cache_key(template_zip):
+    return f"{template_zip_sha256(template_zip)}:{registered_main_tex(template_zip) or ''}"
+
+# 获取准备好的目标模板，缓存中有就直接用
+def get_prepared_template(template_zip):
+    key = template_cache_key(template_zip)
+    prepared = template_cache.get(key)
+    if prepared is not None:
+        log(f"使用缓存中已准备好的目标模板: {prepared.template_name}")
+        return prepared
+
+    # 模板正在后台预热时等它准备好，预热失败就自己再准备一次
+    future = template_cache.get_pending(key)
+    if future is not None:
+        try:
+            future.result()
+        except BaseException:
+            pass
+
+    # 其他进程（或之前的预热）已经生成了模板包时直接 mmap 使用
+    prepared = load_template_pack(key)
+    if prepared is not None:
+        log(f"使用模板包中已准备好的目标模板: {prepared.template_name}")
+    else:
+        prepared = prepare_template(template_zip, key)
+        try:
+            save_template_pack(prepared)
+            prepared = load_template_pack(key) or prepared
+        except OSError as e:
+            log(f"无法保存模板包，只在内存中缓存: {e}", 'warning')
+    template_cache.put(prepared)
+    return prepared
+
+# 把准备好的模板中的 sty、cls、bst 文件放到被修改文件夹中
+# 和 manage_sty_files、copy_cls_files、copy_bst_files 的效果一样：先删除被修改文件夹中原有的 .sty 文件，再写入模板的文件
+# 写入时替换原文件，被修改文件夹是克隆出来的（硬链接）也不会改动原文件
+def install_template_assets(prepared, modified_folder):
+    # 删除被修改文件夹中的所有 .sty 文件
+    for root, dirs, files in os.walk(modified_folder):
+        for file in files:
+            if file.endswith('.sty'):
+                file_path = os.path.join(root, file)
+                os.remove(file_path)
+                log(f"已删除文件: {file_path}")
+
+    for file_name, data in prepared.assets:
+        with replace_file(os.path.join(modified_folder, file_name), 'wb') as file:
+            file.write(data)
+        log(f"已复制文件: {file_name}")
+
+    if not prepared.bst_files:
+        log("目标模板文件夹没有找到 .bst 文件", 'warning')
@@ -0,0 +1,229 @@
+# 这个文件用来放每个目标模板导言区的预编译格式（.fmt）
+# 转换结果的主 tex 文件以目标模板的导言区开头（copy_pre_document_to_first_line 复制过去的），
+# 每次编译都要花很多时间重新加载同样的文档类和宏包
+# 现在模板上传或预热时，用 mylatexformat 把准备好的模板导言区 dump 成一个格式文件，保存在 TEMPLATE_FORMAT_DIR 中；
+# 编译时如果主 tex 文件的开头正好是某个模板的导言区（后面可以有新增的行），就在导言区后面加上 \endofdump，
+# 用这个格式编译，LaTeX 直接跳过已经在格式中的导言区；格式不匹配、不存在或者格式本身不可用时按原来的方式编译
+
+# 导入包
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+from functools import lru_cache
+
+from joblog import log
+from tracing import traced
+from template_cache import load_template_pack
+from template_registry import TEMPLATE_FOLDER
+from workspace import Workspace
+
+
+# 保存格式文件的文件夹，同一台机器上的所有 worker 共用
+TEMPLATE_FORMAT_DIR = os.environ.get('TEMPLATE_FORMAT_DIR', os.path.join(TEMPLATE_FOLDER, '.formats'))
+# 设为 0 时不生成也不使用格式文件
+TEMPLATE_FORMATS = os.environ.get('TEMPLATE_FORMATS', '1') != '0'
+# 生成一个格式文件最多用多少秒
+FORMAT_BUILD_TIMEOUT = int(os.environ.get('FORMAT_BUILD_TIMEOUT', '300'))
+
+# mylatexformat 在编译时跳过这一行之前的导言区；没有加载格式时 \csname endofdump\endcsname 等于 \relax，没有影响
+ENDOFDUMP_LINE = '\\csname endofdump\\endcsname\n'
+FORMAT_JOBNAME = 'preamble'
+# 格式文件本身不能使用时 TeX 的输出：找不到格式、格式损坏、格式由别的版本生成
+FORMAT_ERROR_PATTERN = re.compile(r"I can't find the format file|Fatal format file error|"
+                                  r"can't open the format|---! .* was written by")
+
+
+# LaTeX 引擎的版本（--version 的第一行），格式文件只能被生成它的同一个版本使用；没有安装时返回 None
+@lru_cache(maxsize=None)
+def engine_version(engine):
+    if shutil.which(engine) is None:
+        return None
+    try:
+        result = subprocess.run([engine, '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True, errors='replace', timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.splitlines()[0].strip() if result.stdout else None
+
+def _lines_sha256(lines):
+    return hashlib.sha256(''.join(lines).encode('utf-8')).hexdigest()
+
+# 格式文件的键：引擎和版本、导言区、模板中的 sty/cls 文件
+def format_key(engine, version, preamble, assets):
+    sha256 = hashlib.sha256(f'{engine}\0{version}\0{_lines_sha256(preamble)}'.encode('utf-8'))
+    for name, data in sorted(assets, key=lambda asset: asset[0]):
+        sha256.update(f'\0{name}\0'.encode('utf-8'))
+        sha256.update(hashlib.sha256(data).digest())
+    return sha256.hexdigest()[:32]
+
+def format_paths(key):
+    return os.path.join(TEMPLATE_FORMAT_DIR, key + '.fmt'), os.path.join(TEMPLATE_FORMAT_DIR, key + '.json')
+
+def _write_json(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+# 为准备好的模板生成 engine 使用的格式文件，返回格式文件路径；不能生成时返回 None
+# 生成失败（例如 xelatex 不能 dump 系统字体）也记录下来，之后不再重复尝试
+@traced
+def build_format(prepared, engine):
+    version = engine_version(engine)
+    preamble = prepared.preamble
+    if not TEMPLATE_FORMATS or version is None or not preamble:
+        return None
+
+    key = format_key(engine, version, preamble, prepared.sty_files + prepared.cls_files)
+    fmt_path, meta_path = format_paths(key)
+    if os.path.exists(meta_path):
+        return fmt_path if os.path.exists(fmt_path) else None
+    os.makedirs(TEMPLATE_FORMAT_DIR, exist_ok=True)
+
+    start = time.time()
+    with Workspace(prefix='format-') as workspace:
+        for file_name, data in prepared.sty_files + prepared.cls_files:
+            with open(workspace.file(file_name), 'wb') as file:
+                file.write(data)
+        with open(workspace.file(FORMAT_JOBNAME + '.tex'), 'w', encoding='utf-8') as file:
+            file.writelines(preamble + ['\\begin{document}\n', '\\end{document}\n'])
+        command = [engine, '-ini', '-interaction=nonstopmode', f'-jobname={FORMAT_JOBNAME}', f'&{engine}',
+                   'mylatexformat.ltx', FORMAT_JOBNAME + '.tex']
+        try:
+            result = subprocess.run(command, cwd=workspace.path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    text=True, errors='replace', timeout=FORMAT_BUILD_TIMEOUT)
+            returncode, output = result.returncode, result.stdout
+        except subprocess.TimeoutExpired:
+            returncode, output = None, f'超过 {FORMAT_BUILD_TIMEOUT} 秒'
+
+        built = workspace.file(FORMAT_JOBNAME + '.fmt')
+        error = None
+        if returncode == 0 and os.path.exists(built):
+            # 先放到同一个文件夹中的临时文件，再整体替换，其他进程不会读到写了一半的格式文件
+            fd, temp_path = tempfile.mkstemp(dir=TEMPLATE_FORMAT_DIR, suffix='.tmp')
+            os.close(fd)
+            shutil.move(built, temp_path)
+            os.replace(temp_path, fmt_path)
+        else:
+            error = output[-2000:]
+
+    _write_json(meta_path, {
+        'key': key,
+        'template': prepared.template_name,
+        'engine': engine,
+        'version': version,
+        'preamble_sha256': _lines_sha256(preamble),
+        'preamble_lines': len(preamble),
+        'built_at': time.time(),
+        'seconds': round(time.time() - start, 3),
+        'error': error,
+    })
+    if error is not None:
+        log(f"模板 {prepared.template_name} 的导言区不能生成 {engine} 格式文件，编译时不使用格式", 'warning')
+        return None
+    log(f"已生成模板 {prepared.template_name} 的 {engine} 格式文件: {fmt_path}")
+    return fmt_path
+
+# 预热进程中运行：为模板包中准备好的模板生成格式文件
+def build_template_format(key, engine):
+    prepared = load_template_pack(key)
+    if prepared is None:
+        raise RuntimeError("template pack was not written")
+    return build_format(prepared, engine)
+
+
+# 已经生成的格式文件的索引，格式文件夹有变化时重新读取
+class FormatIndex:
+    def __init__(self, folder=TEMPLATE_FORMAT_DIR):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.mtime_ns = None
+        self.formats = []  # 可以使用的格式的 meta，导言区长的在前
+
+    def _reload(self):
+        try:
+            mtime_ns = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            self.mtime_ns, self.formats = None, []
+            return
+        if mtime_ns == self.mtime_ns:
+            return
+        formats = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.folder, name), 'r', encoding='utf-8') as file:
+                    meta = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if meta.get('error') is None and os.path.exists(os.path.join(self.folder, meta['key'] + '.fmt')):
+                formats.append(meta)
+        formats.sort(key=lambda meta: -meta['preamble_lines'])
+        self.mtime_ns, self.formats = mtime_ns, formats
+
+    # 开头是某个模板导言区的 tex 文件内容 lines 可以使用的格式，返回 (格式文件路径, 导言区行数)，没有时返回 None
+    def find(self, engine, lines):
+        with self.lock:
+            self._reload()
+            formats = list(self.formats)
+        version = None
+        for meta in formats:
+            count = meta['preamble_lines']
+            if meta['engine'] != engine or len(lines) <= count:
+                continue
+            if _lines_sha256(lines[:count]) != meta['preamble_sha256']:
+                continue
+            version = version or engine_version(engine)
+            if meta['version'] == version:
+                return os.path.join(self.folder, meta['key'] + '.fmt'), count
+        return None
+
+
+format_index = FormatIndex()
+
+
+# 用格式编译出错时，判断是不是格式本身的问题（不能加载，或者在读到 \endofdump 之前就出错了）
+# 只有这种情况值得按原来的方式再编译一遍；导言区之后的错误不用格式也一样会出现
+def format_failed(output, driver):
+    if FORMAT_ERROR_PATTERN.search(output):
+        return True
+    # TeX 打开主 tex 文件时输出 "(./文件名"，在这之前出错（或者根本没有打开）说明格式没有加载成功
+    opened = output.find(driver)
+    if opened < 0:
+        return True
+    error = re.search(r'^! ', output, re.MULTILINE)
+    return error is not None and error.start() < opened
+
+# 为 folder 中的 main_tex_file 准备用格式编译需要的文件：格式文件的链接和加上 \endofdump 的主 tex 文件
+# 返回 (格式名, 主 tex 文件, 创建的文件)，不能使用格式时返回 None
+def prepare_format_compile(engine, main_tex_file, folder, jobname):
+    if not TEMPLATE_FORMATS:
+        return None
+    with open(os.path.join(folder, main_tex_file), 'r', encoding='utf-8', errors='replace') as file:
+        lines = file.readlines()
+    found = format_index.find(engine, lines)
+    if found is None:
+        return None
+    fmt_path, count = found
+
+    format_name = f'.{jobname}.preamble'
+    driver = f'.{jobname}.preamble.tex'
+    link_path = os.path.join(folder, format_name + '.fmt')
+    if os.path.exists(link_path):
+        os.remove(link_path)
+    try:
+        os.link(fmt_path, link_path)
+    except OSError:  # 不在同一个文件系统上时复制
+        shutil.copyfile(fmt_path, link_path)
+    with open(os.path.join(folder, driver), 'w', encoding='utf-8') as file:
+        file.writelines(lines[:count] + [ENDOFDUMP_LINE] + lines[count:])
+    log(f"使用目标模板导言区的预编译格式 {os.path.basename(fmt_path)}")
+    return format_name, driver, [link_path, os.path.join(folder, driver)]
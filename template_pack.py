@@ -0,0 +1,80 @@
+# 这个文件用来放模板包（.pack）的读写
+# 模板包是一个不压缩、带成员表的文件：多个 uvicorn worker 都用只读的 mmap 打开同一个包，
+# 所有进程共用操作系统的页缓存，不用每个进程各自保存一份模板文件；复制文件到工作区时直接写 mmap 的切片，不需要解压
+#
+# 格式：
+#   8 字节魔数 b'LTXPACK1'
+#   4 字节（小端）头部长度 n
+#   n 字节 utf-8 JSON 头部：{'meta': {...}, 'members': [{'name':, 'kind':, 'offset':, 'size':}, ...]}
+#   成员数据（offset 从文件开头算起）
+
+# 导入包
+import os
+import json
+import mmap
+import struct
+
+from function import replace_file
+
+
+PACK_MAGIC = b'LTXPACK1'
+HEADER_LENGTH = struct.Struct('<I')
+
+
+# 写一个模板包，members 是 [(文件名, 类型, 内容 bytes)...]，meta 是任意可以转成 JSON 的信息
+# 写到临时文件后再替换，其他进程不会读到写了一半的包
+def write_pack(pack_path, meta, members):
+    os.makedirs(os.path.dirname(pack_path) or '.', exist_ok=True)
+
+    # 先算出头部的长度，才能知道每个成员的 offset；offset 的位数会影响头部长度，所以算到不再变化为止
+    table = [{'name': name, 'kind': kind, 'offset': 0, 'size': len(data)} for name, kind, data in members]
+    while True:
+        header = json.dumps({'meta': meta, 'members': table}, ensure_ascii=False).encode('utf-8')
+        offset = len(PACK_MAGIC) + HEADER_LENGTH.size + len(header)
+        changed = False
+        for entry in table:
+            if entry['offset'] != offset:
+                entry['offset'] = offset
+                changed = True
+            offset += entry['size']
+        if not changed:
+            break
+
+    with replace_file(pack_path, 'wb') as file:
+        file.write(PACK_MAGIC)
+        file.write(HEADER_LENGTH.pack(len(header)))
+        file.write(header)
+        for _, _, data in members:
+            file.write(data)
+    return pack_path
+
+
+# 只读打开的模板包
+# members 中的数据是 mmap 的 memoryview 切片，不会复制到进程自己的内存中
+class TemplatePack:
+    def __init__(self, pack_path):
+        self.path = pack_path
+        with open(pack_path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f"不是模板包文件: {pack_path}")
+        start = len(PACK_MAGIC) + HEADER_LENGTH.size
+        (header_length,) = HEADER_LENGTH.unpack(self.map[len(PACK_MAGIC):start])
+        header = json.loads(self.map[start:start + header_length].decode('utf-8'))
+
+        self.meta = header['meta']
+        view = memoryview(self.map)
+        self.members = [
+            (entry['name'], entry['kind'], view[entry['offset']:entry['offset'] + entry['size']])
+            for entry in header['members']
+        ]
+
+    # 某种类型的成员 [(文件名, 数据)...]
+    def files(self, kind):
+        return [(name, data) for name, member_kind, data in self.members if member_kind == kind]
+
+    # 包文件的大小
+    @property
+    def size(self):
+        return len(self.map)
@@ -0,0 +1,75 @@
+# 这个文件用来放直接从 zip 中读取目标模板的类
+# 准备目标模板只需要主 tex 文件和 .sty、.cls、.bst 文件，模板中的示例图片、pdf 等都用不到；
+# 所以只读一次 zip 的中央目录，按需读取需要的成员，不再把整个模板解压到临时文件夹
+
+# 导入包
+import io
+import os
+import shutil
+import zipfile
+
+from tracing import count_read
+
+
+# 目标模板 zip
+# 成员的路径和 extract_zip 解压后的相对路径一致：忽略 __MACOSX，最外层只有一个文件夹时去掉这一层
+class TemplateZip:
+    def __init__(self, template_zip):
+        self.template_zip = template_zip
+        self.zip_ref = zipfile.ZipFile(template_zip, 'r')
+        self.members = {}  # {相对路径: ZipInfo}，按 zip 中的顺序
+
+        entries = []
+        for info in self.zip_ref.infolist():
+            # 和 zipfile 解压时一样去掉路径中的 ''、'.'、'..'
+            parts = [part for part in info.filename.split('/') if part not in ('', '.', '..')]
+            if not parts or parts[0] == '__MACOSX':
+                continue
+            entries.append((parts, info))
+
+        # 如果最外层只有一个文件夹，去掉这一层（和 extract_zip 返回里面的文件夹效果一样）
+        top_level = {parts[0] for parts, _ in entries}
+        if len(top_level) == 1 and any(len(parts) > 1 or info.is_dir() for parts, info in entries):
+            entries = [(parts[1:], info) for parts, info in entries]
+
+        for parts, info in entries:
+            if parts and not info.is_dir():
+                self.members['/'.join(parts)] = info
+
+    # 所有 tex 文件的相对路径
+    def tex_files(self):
+        return [path for path in self.members if path.endswith('.tex')]
+
+    # 指定后缀的文件的相对路径，recursive 为 False 时只看最外层
+    def files_with_extension(self, extension, recursive=False):
+        return [path for path in self.members if path.endswith(extension) and (recursive or '/' not in path)]
+
+    # 读取成员的内容（bytes）
+    def read(self, path):
+        info = self.members[path]
+        count_read(info.compress_size)
+        return self.zip_ref.read(info)
+
+    # 按行读取文本成员，和 read_file 的结果一致（utf-8，统一换行符）
+    def read_lines(self, path):
+        with self.zip_ref.open(self.members[path]) as member:
+            return io.TextIOWrapper(member, encoding='utf-8').readlines()
+
+    # 读取指定后缀的文件，返回 [(文件名, 内容 bytes)...]，和 read_asset_files 一样
+    def read_assets(self, extension, recursive=False):
+        return [(os.path.basename(path), self.read(path)) for path in self.files_with_extension(extension, recursive)]
+
+    # 把一个成员直接写到 output_path，不经过临时文件夹
+    def extract_member(self, path, output_path):
+        with self.zip_ref.open(self.members[path]) as member, open(output_path, 'wb') as output:
+            shutil.copyfileobj(member, output)
+        return output_path
+
+    def close(self):
+        self.zip_ref.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
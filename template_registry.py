@@ -0,0 +1,195 @@
+# 这个文件用来放目标模板的注册表
+# 以前添加模板时要改写 targetTemplateMainTexMapping.py 和 targetTemplateRecCompileMapping.py 两个 Python 文件，
+# 正在运行的进程要重启才能看到新模板，同时上传两个模板还可能把文件写坏；列出模板时每次都要扫描 templates 文件夹
+# 现在所有模板信息（主 tex 文件、推荐编译方式、内容哈希、需要的文件清单）都放在 templates/registry.json 中：
+# 写入时加锁并整体替换文件，读取时使用内存中的副本，文件被其他进程修改后自动重新加载
+
+# 导入包
+import os
+import json
+import threading
+
+from function import file_sha256, replace_file
+from template_reader import TemplateZip
+from targetTemplateMainTexMapping import target_template_main_tex_mapping
+from targetTemplateRecCompileMapping import target_template_rec_compile_mapping
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只用进程内的锁
+    fcntl = None
+
+
+# 预设模板文件夹和注册表文件
+TEMPLATE_FOLDER = os.environ.get('TEMPLATE_FOLDER', './templates')
+REGISTRY_FILE_NAME = 'registry.json'
+
+
+# 生成一个模板的注册信息
+# main_tex 为 None 时表示模板只有一个 tex 文件，转换时自动选择
+def build_template_entry(zip_path, main_tex=None, compile_method='none'):
+    stat = os.stat(zip_path)
+    with TemplateZip(zip_path) as template:
+        assets = {
+            'tex': template.tex_files(),
+            'sty': template.files_with_extension('.sty'),
+            'cls': template.files_with_extension('.cls'),
+            'bst': template.files_with_extension('.bst', recursive=True),
+        }
+    return {
+        'zip': os.path.basename(zip_path),
+        'main_tex': main_tex,
+        'compile': compile_method,
+        'sha256': file_sha256(zip_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'assets': assets,
+    }
+
+
+# 模板注册表，键是模板 zip 的文件名（例如 "CVPR 2022.zip"），和以前两个映射文件中的键一样
+class TemplateRegistry:
+    def __init__(self, folder=TEMPLATE_FOLDER):
+        self.folder = folder
+        self.path = os.path.join(folder, REGISTRY_FILE_NAME)
+        self.entries = {}
+        self.signature = None  # 内存中的副本对应的注册表文件 (inode, 大小, 修改时间)
+        self.lock = threading.RLock()
+        self.loaded = False
+
+    # 注册表文件的签名，文件被替换或修改后会改变
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    # 跨进程的文件锁，保证同时只有一个进程在改写注册表
+    def _file_lock(self):
+        os.makedirs(self.folder, exist_ok=True)
+        lock_file = open(self.path + '.lock', 'a')
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _read(self):
+        with open(self.path, 'r', encoding='utf-8') as file:
+            return json.load(file)['templates']
+
+    def _write(self):
+        with replace_file(self.path, 'w', encoding='utf-8') as file:
+            json.dump({'version': 1, 'templates': self.entries}, file, ensure_ascii=False, indent=2, sort_keys=True)
+        self.signature = self._file_signature()
+
+    # 注册表文件有变化时重新加载；第一次使用时和 templates 文件夹对一遍（没有注册表文件时从两个映射文件生成）
+    def _ensure_loaded(self):
+        signature = self._file_signature()
+        if self.loaded and signature == self.signature:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+                self.loaded = True
+            elif signature != self.signature:
+                self.entries = self._read() if signature is not None else {}
+                self.signature = signature
+
+    # 和 templates 文件夹对一遍：添加手动放进去的 zip，删除已经不存在的，重新计算被替换过的 zip 的哈希和文件清单
+    # 新模板的主 tex 文件和推荐编译方式从两个映射文件中读取
+    def refresh(self):
+        with self.lock:
+            lock_file = self._file_lock()
+            try:
+                entries = self._read() if os.path.exists(self.path) else {}
+                zip_names = sorted(file for file in os.listdir(self.folder) if file.endswith('.zip'))
+                changed = set(entries) != set(zip_names)
+                refreshed = {}
+                for zip_name in zip_names:
+                    zip_path = os.path.join(self.folder, zip_name)
+                    entry = entries.get(zip_name)
+                    stat = os.stat(zip_path)
+                    if entry is None:
+                        entry = build_template_entry(
+                            zip_path,
+                            target_template_main_tex_mapping.get(zip_name),
+                            target_template_rec_compile_mapping.get(zip_name, 'none'),
+                        )
+                    elif (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+                        entry = build_template_entry(zip_path, entry['main_tex'], entry['compile'])
+                        changed = True
+                    refreshed[zip_name] = entry
+                self.entries = refreshed
+                if changed or not os.path.exists(self.path):
+                    self._write()
+                else:
+                    self.signature = self._file_signature()
+            finally:
+                lock_file.close()
+
+    # 登记一个已经放到 templates 文件夹中的模板
+    def register(self, zip_name, main_tex=None, compile_method='none'):
+        entry = build_template_entry(os.path.join(self.folder, zip_name), main_tex, compile_method)
+        with self.lock:
+            self._ensure_loaded()
+            lock_file = self._file_lock()
+            try:
+                # 加锁后重新读一次，避免覆盖其他进程刚写入的模板
+                if self._file_signature() != self.signature:
+                    self.entries = self._read()
+                self.entries = {**self.entries, zip_name: entry}
+                self._write()
+            finally:
+                lock_file.close()
+        return entry
+
+    # 模板的注册信息，没有时返回 None
+    # 如果 zip 是刚手动放进文件夹里的，先和文件夹对一遍再查
+    def get(self, zip_name):
+        self._ensure_loaded()
+        entry = self.entries.get(zip_name)
+        if entry is None and os.path.isfile(self.zip_path(zip_name)):
+            self.refresh()
+            entry = self.entries.get(zip_name)
+        return entry
+
+    def __contains__(self, zip_name):
+        return self.get(zip_name) is not None
+
+    # 所有模板 zip 的文件名
+    def zip_names(self):
+        self._ensure_loaded()
+        return sorted(self.entries)
+
+    # 所有模板的名称（不带 .zip 后缀）
+    def names(self):
+        return [os.path.splitext(zip_name)[0] for zip_name in self.zip_names()]
+
+    # 模板 zip 的路径
+    def zip_path(self, zip_name):
+        return os.path.join(self.folder, zip_name)
+
+    # 模板的主 tex 文件名，没有登记时返回 None
+    def main_tex(self, zip_name):
+        entry = self.get(zip_name)
+        return entry['main_tex'] if entry else None
+
+    # 模板的推荐编译方式，没有登记时返回 None
+    def compile_method(self, zip_name):
+        entry = self.get(zip_name)
+        return entry['compile'] if entry else None
+
+
+# 每个模板文件夹一个注册表
+_registries = {}
+_registries_lock = threading.Lock()
+
+def get_template_registry(folder=TEMPLATE_FOLDER):
+    key = os.path.abspath(folder)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = TemplateRegistry(folder)
+        return _registries[key]
+
+
+template_registry = get_template_registry()
@@ -0,0 +1,217 @@
+# 这个文件用来放扫描 tex 内容、建立索引的函数
+# 索引只需要扫描一遍内容就能建好，之后的查找、提取都直接查索引，不需要再重新扫描
+
+# 导入包
+import re
+import bisect
+
+
+# 这些环境里面的内容原样输出，里面的 {}、% 都不是 LaTeX 语法，扫描时要整体跳过
+VERBATIM_ENVIRONMENTS = ('verbatim', 'verbatim*', 'Verbatim', 'Verbatim*', 'lstlisting', 'minted', 'comment')
+
+# 扫描时关心的记号：控制序列（\name 或 \ 加一个字符）、{、}、%
+TOKEN_PATTERN = re.compile(r'\\(?:([A-Za-z@]+)|.)|([{}])|(%)', re.S)
+
+# \begin{verbatim} 之类的环境开头
+VERBATIM_BEGIN_PATTERN = re.compile(r'\{(' + '|'.join(re.escape(env) for env in VERBATIM_ENVIRONMENTS) + r')\}')
+
+
+# 花括号索引
+# 一遍扫描记录每个 { 对应的 } 的位置，以及每个控制序列（\title、\maketitle 等）出现的位置
+# 转义的括号（\{、\}）、注释里的内容、verbatim 环境和 \verb 里的内容都不会被当作括号或命令
+class BraceIndex:
+    def __init__(self, content):
+        self.content = content
+        self.pairs = {}  # 开括号位置 -> 对应闭括号的位置
+        self.commands = {}  # 命令名 -> 该命令每次出现时反斜杠的位置（按出现顺序）
+        self._scan()
+
+    def _scan(self):
+        content = self.content
+        length = len(content)
+        stack = []
+        pos = 0
+
+        while True:
+            match = TOKEN_PATTERN.search(content, pos)
+            if not match:
+                break
+            pos = match.end()
+            name, brace, comment = match.groups()
+
+            if name:
+                self.commands.setdefault(name, []).append(match.start())
+
+                if name == 'begin':
+                    # \begin{verbatim} ... \end{verbatim}：直接跳到环境结束
+                    verbatim_match = VERBATIM_BEGIN_PATTERN.match(content, pos)
+                    if verbatim_match:
+                        end_marker = '\\end{' + verbatim_match.group(1) + '}'
+                        end = content.find(end_marker, verbatim_match.end())
+                        pos = length if end == -1 else end + len(end_marker)
+                elif name == 'verb' and pos < length:
+                    # \verb|...| 或 \verb*|...|：跳到下一个分隔符
+                    if content[pos] == '*':
+                        pos += 1
+                    if pos < length:
+                        end = content.find(content[pos], pos + 1)
+                        pos = length if end == -1 else end + 1
+            elif brace == '{':
+                stack.append(match.start())
+            elif brace == '}':
+                if stack:
+                    self.pairs[stack.pop()] = match.start()
+            elif comment:
+                # 注释一直到行尾
+                end = content.find('\n', pos)
+                pos = length if end == -1 else end + 1
+
+    # 找命令第 occurrence 次出现的位置，没有找到返回 None
+    def find_command(self, command, occurrence=0):
+        positions = self.commands.get(command, [])
+        if occurrence < len(positions):
+            return positions[occurrence]
+        return None
+
+    # 找 \command{...} 整个命令的范围 (开始, 结束)
+    # 只认命令名后面紧跟 { 的写法；没有找到或者括号不配对时返回 None
+    def command_span(self, command):
+        for start in self.commands.get(command, []):
+            open_brace = start + len(command) + 1
+            if open_brace < len(self.content) and self.content[open_brace] == '{':
+                close_brace = self.pairs.get(open_brace)
+                if close_brace is None:
+                    return None
+                return start, close_brace + 1
+        return None
+
+    # 提取 \command{...} 的完整文本，没有找到返回 None
+    def extract_command(self, command):
+        span = self.command_span(command)
+        if span is None:
+            return None
+        return self.content[span[0]:span[1]]
+
+
+# 结构性标记：各个修改函数需要定位的行
+STRUCTURAL_MARKERS = (
+    '\\documentclass',
+    '\\usepackage',
+    '\\begin{document}',
+    '\\maketitle',
+    '\\bibliographystyle{',
+    '\\bibliography{',
+    '\\end{document}',
+)
+
+# 锚点索引
+# 用一个多模式匹配器一遍扫描整个文档，记录每个结构性标记出现的 (行号, 行内偏移)，行号从 0 开始
+# 多模式匹配用编译好的正则“或”表达式来做，匹配在 re 的 C 实现里一次完成，比纯 Python 写的 Aho-Corasick 自动机快
+# 插入行时只扫描新插入的行，并把后面的锚点整体后移，不需要重新扫描整个文档
+class AnchorIndex:
+    def __init__(self, lines, markers=STRUCTURAL_MARKERS):
+        self.markers = tuple(markers)
+        # 长的标记放在前面，保证同一位置优先匹配更长的标记
+        self.pattern = re.compile('|'.join(re.escape(marker) for marker in sorted(self.markers, key=len, reverse=True)))
+        self.anchors = {marker: [] for marker in self.markers}
+        for marker, position in self._scan(lines, 0):
+            self.anchors[marker].append(position)
+
+    # 扫描 lines，返回 [(标记, (行号, 行内偏移))...]，行号从 first_line 开始计
+    def _scan(self, lines, first_line):
+        line_starts = []
+        offset = 0
+        for line in lines:
+            line_starts.append(offset)
+            offset += len(line)
+
+        found = []
+        for match in self.pattern.finditer(''.join(lines)):
+            line = bisect.bisect_right(line_starts, match.start()) - 1
+            found.append((match.group(0), (first_line + line, match.start() - line_starts[line])))
+        return found
+
+    # 标记第一次出现的行号，没有找到返回 None
+    def find(self, marker):
+        positions = self.anchors.get(marker)
+        return positions[0][0] if positions else None
+
+    # 标记最后一次出现的行号，没有找到返回 None
+    def find_last(self, marker):
+        positions = self.anchors.get(marker)
+        return positions[-1][0] if positions else None
+
+    # 标记出现过的所有 (行号, 行内偏移)
+    def find_all(self, marker):
+        return list(self.anchors.get(marker, []))
+
+    # 在第 at 行之前插入了 new_lines：后面的锚点后移，再把新行里的锚点加进来
+    def insert_lines(self, at, new_lines):
+        count = len(new_lines)
+        if count:
+            for marker, positions in self.anchors.items():
+                self.anchors[marker] = [(line + count, column) if line >= at else (line, column)
+                                        for line, column in positions]
+        for marker, position in self._scan(new_lines, at):
+            bisect.insort(self.anchors[marker], position)
+
+
+# \usepackage[选项]{包1,包2,...}
+USEPACKAGE_PATTERN = re.compile(r'\\usepackage\s*(\[[^\]]*\])?\s*\{([^}]*)\}')
+
+# sty 文件中声明的包名 \ProvidesPackage{包名}
+PROVIDES_PACKAGE_PATTERN = re.compile(r'\\ProvidesPackage\s*\{\s*([^}\s]+)\s*\}')
+
+# 导言区包索引
+# 每个 \usepackage 语句只解析一次（包括逗号分隔的多个包），之后按集合成员关系删除包，不需要对每个包再扫描一遍
+class PackageIndex:
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.statements = {}  # 行号 -> [(开始, 结束, 选项, [包名...])...]
+        self.packages = {}  # 小写包名 -> [行号...]
+        for i, line in enumerate(self.lines):
+            if '\\usepackage' not in line:
+                continue
+            for match in USEPACKAGE_PATTERN.finditer(line):
+                names = [name.strip() for name in match.group(2).split(',') if name.strip()]
+                self.statements.setdefault(i, []).append((match.start(), match.end(), match.group(1) or '', names))
+                for name in names:
+                    self.packages.setdefault(name.lower(), []).append(i)
+
+    # 判断文档是否加载了某个包（不区分大小写）
+    def has_package(self, name):
+        return name.lower() in self.packages
+
+    # 删除 package_names 中的包（不区分大小写），返回 (新的行列表, [(被修改的原始行, [被删除的包名...])...])
+    # 一条语句里的包全部被删除时删掉这条语句，只删除了其中一部分时保留语句里剩下的包；行里只剩空白时删除整行
+    def remove_packages(self, package_names):
+        targets = {name.lower() for name in package_names}
+        affected = sorted({i for name in targets for i in self.packages.get(name, [])})
+        if not affected:
+            return list(self.lines), []
+
+        new_lines = list(self.lines)
+        removed = []
+        drop = set()
+        for i in affected:
+            line = self.lines[i]
+            removed_names = []
+            pieces = []
+            last = 0
+            for start, end, options, names in self.statements[i]:
+                kept = [name for name in names if name.lower() not in targets]
+                removed_names.extend(name for name in names if name.lower() in targets)
+                if len(kept) == len(names):
+                    continue
+                pieces.append(line[last:start])
+                if kept:
+                    pieces.append('\\usepackage' + options + '{' + ','.join(kept) + '}')
+                last = end
+            pieces.append(line[last:])
+            new_lines[i] = ''.join(pieces)
+            if not new_lines[i].strip():
+                drop.add(i)
+            removed.append((line, removed_names))
+
+        new_lines = [line for i, line in enumerate(new_lines) if i not in drop]
+        return new_lines, removed
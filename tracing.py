@@ -0,0 +1,233 @@
+# 这个文件用来放转换过程的分阶段计时（trace / span）
+# 一次转换慢的时候，以前看不出时间花在哪一步：解压、复制文件夹、各个正则修改、打包 zip 还是编译
+# 现在每个阶段都包在一个 span 中，记录墙钟时间、CPU 时间、读写的字节数和进程的内存峰值；
+# 同一次转换的所有 span 属于同一个 trace，trace id 可以从 HTTP 请求头传进来（traceparent、X-Trace-Id、X-Request-ID）
+# span 结束时可以写到本地的 JSON lines 文件（环境变量 LATEX_CONVERTER_TRACE_FILE），API 还会在响应头 X-Conversion-Timings 中给出各阶段的耗时
+# 当前的 trace 和 span 放在 contextvars 中；没有 trace 时 span 什么都不做，直接运行 main.py 不受影响
+
+# 导入包
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource，不记录内存峰值
+    resource = None
+
+
+# span 结束时追加写入的 JSON lines 文件，不设置时不导出
+TRACE_FILE = os.environ.get('LATEX_CONVERTER_TRACE_FILE')
+
+TRACEPARENT_PATTERN = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+TRACE_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+_export_lock = threading.Lock()
+# span 结束时调用的函数（例如 API 的 /metrics 统计各阶段的耗时），参数是结束的 Span
+_span_listeners = []
+
+
+# 登记一个 span 结束时调用的函数
+def add_span_listener(listener):
+    _span_listeners.append(listener)
+
+
+# 进程的内存峰值（KB）
+def peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# 一个阶段
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent', 'depth', 'attributes', 'start', 'wall', 'cpu',
+                 'bytes_read', 'bytes_written', 'peak_rss_kb', 'rss_growth_kb', 'error',
+                 '_wall_start', '_cpu_start', '_rss_start')
+
+    def __init__(self, trace, name, parent=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.wall = None  # 墙钟时间（秒）
+        self.cpu = None  # 这个线程在这个阶段中用掉的 CPU 时间（秒），在其他线程中运行的子阶段不算在内
+        self.bytes_read = 0  # 包括子阶段
+        self.bytes_written = 0
+        self.peak_rss_kb = None  # 阶段结束时进程的内存峰值
+        self.rss_growth_kb = None  # 这个阶段让进程的内存峰值增加了多少
+        self.error = None
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        self._rss_start = peak_rss_kb()
+
+    # cpu 不为 None 时使用调用者自己统计的 CPU 时间（例如流式输出时每一块在不同的线程中生成）
+    def finish(self, error=None, cpu=None):
+        self.wall = time.perf_counter() - self._wall_start
+        self.cpu = cpu if cpu is not None else time.thread_time() - self._cpu_start
+        self.peak_rss_kb = peak_rss_kb()
+        if self.peak_rss_kb is not None:
+            self.rss_growth_kb = self.peak_rss_kb - self._rss_start
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+        self.trace.add_finished(self)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent is not None else self.trace.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_rss_kb': self.peak_rss_kb,
+            'rss_growth_kb': self.rss_growth_kb,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+# 一次转换的所有阶段
+class Trace:
+    def __init__(self, trace_id=None, parent_id=None, export_path=TRACE_FILE):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.parent_id = parent_id  # 调用者（HTTP 请求）的 span id
+        self.export_path = export_path
+        self.spans = []  # 已经结束的 span，按结束顺序
+        self.lock = threading.Lock()
+
+    def add_finished(self, span):
+        with self.lock:
+            self.spans.append(span)
+            # 读写的字节数累加到上一级
+            if span.parent is not None:
+                span.parent.bytes_read += span.bytes_read
+                span.parent.bytes_written += span.bytes_written
+        if self.export_path:
+            self.export(span)
+        for listener in _span_listeners:
+            try:
+                listener(span)
+            except Exception:
+                pass  # 统计出错不影响转换
+
+    # 把一个 span 追加写到 JSON lines 文件
+    def export(self, span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n'
+        with _export_lock:
+            directory = os.path.dirname(self.export_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.export_path, 'a', encoding='utf-8') as file:
+                file.write(line)
+
+    # 深度不超过 max_depth 的阶段的耗时（毫秒），同名的阶段加在一起，按第一次开始的顺序
+    def timings(self, max_depth=1):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        totals = {}
+        for span in spans:
+            if span.depth <= max_depth:
+                totals[span.name] = totals.get(span.name, 0.0) + span.wall * 1000
+        return totals
+
+    # X-Conversion-Timings 响应头的内容，格式和 Server-Timing 一样：name;dur=毫秒, ...
+    def timings_header(self, max_depth=1):
+        return ', '.join(f'{name};dur={duration:.1f}' for name, duration in self.timings(max_depth).items())
+
+    def to_list(self):
+        with self.lock:
+            return [span.to_dict() for span in self.spans]
+
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('trace_span', default=None)
+
+
+# 当前的 trace，没有时返回 None
+def current_trace():
+    return _current_trace.get()
+
+# 在 with 中把 trace 设为当前的 trace
+@contextmanager
+def trace_context(trace):
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+# 在 with 中的代码是一个名为 name 的阶段；没有当前的 trace 时什么都不做
+@contextmanager
+def span(name, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = Span(trace, name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        _current_span.reset(token)
+        current.finish(e)
+        raise
+    _current_span.reset(token)
+    current.finish()
+
+# 把整个函数作为一个阶段的装饰器，阶段名默认是函数名
+def traced(func=None, *, name=None):
+    if func is None:
+        return functools.partial(traced, name=name)
+
+    span_name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current_trace.get() is None:
+            return func(*args, **kwargs)
+        with span(span_name):
+            return func(*args, **kwargs)
+    return wrapper
+
+# 记录当前阶段读取的字节数
+def count_read(size):
+    current = _current_span.get()
+    if current is not None:
+        with current.trace.lock:
+            current.bytes_read += size
+
+# 记录当前阶段写入的字节数
+def count_written(size):
+    current = _current_span.get()
+    if current is not None:
+        with current.trace.lock:
+            current.bytes_written += size
+
+# 从 HTTP 请求头中取出 (trace id, 调用者的 span id)，没有时返回 (None, None)
+# 支持 W3C traceparent，以及 X-Trace-Id、X-Request-ID
+def trace_ids_from_headers(headers):
+    traceparent = headers.get('traceparent')
+    if traceparent:
+        match = TRACEPARENT_PATTERN.match(traceparent.strip().lower())
+        if match:
+            return match.group(1), match.group(2)
+    for header in ('x-trace-id', 'x-request-id'):
+        value = headers.get(header)
+        if value and TRACE_ID_PATTERN.match(value.strip()):
+            return value.strip(), None
+    return None, None
@@ -0,0 +1,167 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Optional
+
+from compile_engine import COMPILE_METHODS
+from template_cache import build_template_pack, load_template_pack, template_cache, template_cache_key
+from template_format import TEMPLATE_FORMATS, build_template_format, engine_version
+from template_registry import get_template_registry
+
+# Processes used to prepare templates in the background.
+TEMPLATE_WARMUP_WORKERS = int(os.environ.get("TEMPLATE_WARMUP_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Engine used for templates without a recommended compile method.
+DEFAULT_FORMAT_ENGINE = "pdflatex"
+
+
+def template_engine(template_zip: str) -> str:
+    """LaTeX engine of the template's recommended compile method."""
+    registry = get_template_registry(os.path.dirname(template_zip) or ".")
+    method = registry.compile_method(os.path.basename(template_zip))
+    return COMPILE_METHODS[method][0] if method in COMPILE_METHODS else DEFAULT_FORMAT_ENGINE
+
+
+class TemplateWarmup:
+    """Prepares template zips in a process pool and puts the results into the template cache.
+
+    Workers write each prepared template to a template pack and return only its path; this process
+    then memory-maps the pack, so every API worker on the node shares one copy through the page cache.
+
+    Conversions that need a template whose preparation is still running wait for it
+    (see template_cache.get_prepared_template) instead of preparing it a second time.
+
+    Once a template is prepared, the same pool dumps its preamble into a format file for the
+    engine of its recommended compile method (see template_format.py). Formats are not awaited:
+    compiles simply run without one until it exists.
+    """
+
+    def __init__(self, max_workers: int = TEMPLATE_WARMUP_WORKERS, cache=template_cache):
+        self.max_workers = max_workers
+        self.cache = cache
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.pending: Dict[str, str] = {}  # cache key -> template name
+        self.prepared = 0
+        self.failed: Dict[str, str] = {}  # template name -> error
+        self.formats_pending: Dict[str, str] = {}  # cache key -> template name
+        self.formats_built = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # spawn: the API process runs threads, which fork does not copy safely.
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    @property
+    def ready(self) -> bool:
+        """True once warm() has run and nothing is left to prepare."""
+        with self.lock:
+            return self.started_at is not None and not self.pending
+
+    def warm(self, template_zips: Iterable[str]) -> int:
+        """Queues every template zip that is not cached yet; returns how many were queued."""
+        queued = 0
+        with self.lock:
+            if not self.pending:
+                self.started_at = time.time()
+                self.finished_at = None
+        for template_zip in template_zips:
+            name = os.path.basename(template_zip)
+            try:
+                key = template_cache_key(template_zip)
+            except Exception as e:
+                logging.warning(f"Skipping warm-up of template {name}: {e}")
+                with self.lock:
+                    self.failed[name] = str(e)
+                continue
+            with self.lock:
+                if key in self.pending or key in self.cache:
+                    continue
+                self.pending[key] = name
+                future = self._executor().submit(build_template_pack, template_zip, key)
+                self.cache.add_pending(key, future)
+            future.add_done_callback(lambda f, key=key, name=name, template_zip=template_zip:
+                                     self._done(key, name, template_zip, f))
+            queued += 1
+        with self.lock:
+            if not self.pending and self.finished_at is None:
+                self.finished_at = time.time()
+        if queued:
+            logging.info(f"Warming up {queued} template(s) with {self.max_workers} worker process(es).")
+        return queued
+
+    def _done(self, key: str, name: str, template_zip: str, future: Future):
+        try:
+            future.result()
+            prepared = load_template_pack(key)
+            if prepared is None:
+                raise RuntimeError("template pack was not written")
+            self.cache.put(prepared)
+            error = None
+        except BaseException as e:  # includes CancelledError when the pool shuts down
+            error = str(e)
+            logging.warning(f"Warm-up of template {name} failed: {e}")
+        finally:
+            self.cache.remove_pending(key)
+        with self.lock:
+            self.pending.pop(key, None)
+            if error is None:
+                self.prepared += 1
+                self.failed.pop(name, None)
+            else:
+                self.failed[name] = error
+            if not self.pending:
+                self.finished_at = time.time()
+                logging.info(f"Template warm-up finished in {self.finished_at - self.started_at:.2f}s.")
+        if error is None:
+            self._build_format(key, name, template_zip)
+
+    def _build_format(self, key: str, name: str, template_zip: str):
+        """Queues the preamble format of a prepared template when its engine is installed."""
+        engine = template_engine(template_zip)
+        if not TEMPLATE_FORMATS or engine_version(engine) is None:
+            return
+        with self.lock:
+            if key in self.formats_pending:
+                return
+            self.formats_pending[key] = name
+            try:
+                future = self._executor().submit(build_template_format, key, engine)
+            except RuntimeError:  # the pool is shutting down
+                self.formats_pending.pop(key, None)
+                return
+        future.add_done_callback(lambda f: self._format_done(key, name, f))
+
+    def _format_done(self, key: str, name: str, future: Future):
+        try:
+            built = future.result() is not None
+        except BaseException as e:
+            built = False
+            logging.warning(f"Building the preamble format of template {name} failed: {e}")
+        with self.lock:
+            self.formats_pending.pop(key, None)
+            if built:
+                self.formats_built += 1
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "ready": self.started_at is not None and not self.pending,
+                "pending": sorted(self.pending.values()),
+                "prepared": self.prepared,
+                "failed": dict(self.failed),
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "formats_pending": sorted(self.formats_pending.values()),
+                "formats_built": self.formats_built,
+            }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,69 @@
+# 这个文件用来放每次转换/编译使用的独立工作区
+# 以前所有转换都写到固定的 ./converted_result、./target_template_copy 和 ./xxx result.zip，
+# 两个请求同时运行时会互相覆盖；现在每个任务在 WORKSPACE_ROOT 下有自己的目录，用完后整体删除
+
+# 导入包
+import os
+import time
+import shutil
+import tempfile
+
+
+# 工作区根目录，可以用环境变量 LATEX_CONVERTER_WORKSPACE_ROOT 修改
+WORKSPACE_ROOT = os.environ.get(
+    'LATEX_CONVERTER_WORKSPACE_ROOT',
+    os.path.join(tempfile.gettempdir(), 'latex-converter-workspaces'),
+)
+
+
+# 一个任务的工作区
+# 可以当作上下文管理器使用，离开 with 时自动删除；也可以手动调用 cleanup()
+class Workspace:
+    def __init__(self, root=None, prefix='job-'):
+        self.root = os.path.abspath(root or WORKSPACE_ROOT)
+        os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=self.root)
+        self.id = os.path.basename(self.path)
+
+    # 工作区中的子文件夹（不存在时创建）
+    def subdir(self, name):
+        path = os.path.join(self.path, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # 工作区中的文件路径
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    # 删除整个工作区，可以重复调用
+    def cleanup(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def __repr__(self):
+        return f"Workspace({self.path!r})"
+
+
+# 删除超过 max_age 秒没有修改过的工作区（进程异常退出时留下的目录）
+def cleanup_stale_workspaces(max_age=24 * 3600, root=None):
+    root = os.path.abspath(root or WORKSPACE_ROOT)
+    if not os.path.isdir(root):
+        return []
+
+    removed = []
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.isdir(path) and now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+        except OSError:
+            continue
+    return removed
@@ -0,0 +1,244 @@
+# 这个文件用来放流式写 zip 的函数
+# 和 zipfile.ZipFile 不同，这里的写法边生成边输出（可以直接作为 HTTP 响应体），不需要先把整个 zip 写到磁盘上；
+# 已经压缩过的文件（pdf、png、jpg 等）直接存储不再压缩；转换过程中没有改动过的文件，直接从源 zip 中原样复制压缩后的数据
+
+# 导入包
+import os
+import time
+import zlib
+import struct
+import zipfile
+
+from tracing import count_read, count_written
+
+
+# 这些类型的文件本身已经压缩过，再用 deflate 压缩只会浪费时间
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.heic', '.avif', '.jp2',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+    '.mp3', '.mp4', '.mov', '.avi', '.mkv', '.woff', '.woff2',
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+# zip 格式中的各种记录（和 zipfile 模块中的定义一样）
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_OF_CENTRAL_DIRECTORY = struct.Struct('<4s4H2LH')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+ZIP_LIMIT = 0xFFFFFFFF
+
+
+# 判断一个文件是否应该直接存储（不压缩）
+def is_incompressible(file_name):
+    return os.path.splitext(file_name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+# 把时间戳转换成 zip 中使用的 DOS 日期和时间
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+
+# 流式 zip 写入器
+# add_file、add_raw、finish 都返回一个按块产生 bytes 的迭代器，调用者把这些块依次写到文件或 HTTP 响应中
+class ZipStreamWriter:
+    def __init__(self):
+        self.offset = 0
+        self.entries = []  # 中央目录中的记录
+
+    def _emit(self, data):
+        self.offset += len(data)
+        count_written(len(data))
+        return data
+
+    def _check_limits(self, *values):
+        if len(self.entries) >= 0xFFFF or any(value > ZIP_LIMIT for value in values):
+            raise ValueError("输出的 zip 超过了 4GB 或 65535 个文件，不支持 zip64 格式")
+
+    def _local_header(self, arcname, flag, method, date_time, crc, compress_size, file_size):
+        encoded_name = arcname.encode('utf-8')
+        if not arcname.isascii():
+            flag |= FLAG_UTF8
+        date, time_ = dos_date_time(date_time)
+        header = LOCAL_HEADER.pack(b'PK\x03\x04', 20, 0, flag, method, time_, date, crc, compress_size, file_size,
+                                   len(encoded_name), 0)
+        return header + encoded_name, flag, date, time_
+
+    def _add_entry(self, arcname, flag, method, date, time_, crc, compress_size, file_size, header_offset,
+                   external_attr, create_system=3):
+        self._check_limits(compress_size, file_size, header_offset)
+        self.entries.append((arcname.encode('utf-8'), flag, method, date, time_, crc, compress_size, file_size,
+                             header_offset, external_attr, create_system))
+
+    # 写入磁盘上的一个文件，compress 为 None 时按文件类型自动选择是否压缩
+    def add_file(self, arcname, file_path, compress=None):
+        stat = os.stat(file_path)
+        if compress is None:
+            compress = not is_incompressible(arcname)
+        date_time = time.localtime(stat.st_mtime)[:6]
+        external_attr = (stat.st_mode & 0xFFFF) << 16
+        header_offset = self.offset
+
+        if not compress:
+            # 直接存储：先算出 CRC，这样本地文件头里就能写上准确的大小，不需要数据描述符
+            crc = 0
+            with open(file_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    crc = zlib.crc32(chunk, crc)
+            header, flag, date, time_ = self._local_header(arcname, 0, zipfile.ZIP_STORED, date_time, crc,
+                                                           stat.st_size, stat.st_size)
+            yield self._emit(header)
+            size = 0
+            with open(file_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    size += len(chunk)
+                    yield self._emit(chunk)
+            count_read(2 * size)
+            self._add_entry(arcname, flag, zipfile.ZIP_STORED, date, time_, crc, size, size, header_offset,
+                            external_attr)
+            return
+
+        # deflate 压缩：边读边压缩，大小和 CRC 写在数据后面的数据描述符里
+        header, flag, date, time_ = self._local_header(arcname, FLAG_DATA_DESCRIPTOR, zipfile.ZIP_DEFLATED,
+                                                       date_time, 0, 0, 0)
+        yield self._emit(header)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    compress_size += len(compressed)
+                    yield self._emit(compressed)
+        compressed = compressor.flush()
+        compress_size += len(compressed)
+        yield self._emit(compressed)
+        count_read(file_size)
+        self._check_limits(compress_size, file_size)
+        yield self._emit(DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compress_size, file_size))
+        self._add_entry(arcname, flag, zipfile.ZIP_DEFLATED, date, time_, crc, compress_size, file_size,
+                        header_offset, external_attr)
+
+    # 写入内存中的一段数据（例如生成的 summary.json）
+    def add_bytes(self, arcname, data, compress=None):
+        if compress is None:
+            compress = not is_incompressible(arcname)
+        method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        crc = zlib.crc32(data)
+        if compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+        else:
+            compressed = data
+        header_offset = self.offset
+        header, flag, date, time_ = self._local_header(arcname, 0, method, time.localtime()[:6], crc,
+                                                       len(compressed), len(data))
+        yield self._emit(header)
+        yield self._emit(compressed)
+        self._add_entry(arcname, flag, method, date, time_, crc, len(compressed), len(data), header_offset,
+                        0o100644 << 16)
+
+    # 从源 zip 中原样复制一个成员的压缩数据（不解压、不重新压缩）
+    # source_file 是以二进制方式打开的源 zip 文件，info 是该成员的 ZipInfo
+    def add_raw(self, arcname, source_file, info):
+        source_file.seek(info.header_offset)
+        fields = LOCAL_HEADER.unpack(source_file.read(LOCAL_HEADER.size))
+        name_length, extra_length = fields[-2], fields[-1]
+        source_file.seek(info.header_offset + LOCAL_HEADER.size + name_length + extra_length)
+
+        header_offset = self.offset
+        header, flag, date, time_ = self._local_header(arcname, 0, info.compress_type, info.date_time, info.CRC,
+                                                       info.compress_size, info.file_size)
+        yield self._emit(header)
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = source_file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError(f"源 zip 中的 {info.filename} 数据不完整")
+            remaining -= len(chunk)
+            yield self._emit(chunk)
+        count_read(info.compress_size)
+        self._add_entry(arcname, flag, info.compress_type, date, time_, info.CRC, info.compress_size,
+                        info.file_size, header_offset, info.external_attr, info.create_system)
+
+    # 写入中央目录和结束记录
+    def finish(self):
+        central_directory_offset = self.offset
+        for (encoded_name, flag, method, date, time_, crc, compress_size, file_size, header_offset,
+             external_attr, create_system) in self.entries:
+            record = CENTRAL_HEADER.pack(b'PK\x01\x02', 20, create_system, 20, 0, flag, method, time_, date, crc,
+                                         compress_size, file_size, len(encoded_name), 0, 0, 0, 0, external_attr,
+                                         header_offset)
+            yield self._emit(record + encoded_name)
+        central_directory_size = self.offset - central_directory_offset
+        self._check_limits(central_directory_offset, central_directory_size)
+        yield self._emit(END_OF_CENTRAL_DIRECTORY.pack(b'PK\x05\x06', 0, 0, len(self.entries), len(self.entries),
+                                                       central_directory_size, central_directory_offset, 0))
+
+
+# 判断工作区中的文件在解压后是否被修改过
+# manifest 是解压时记录的 {相对路径: {'member': 源zip中的成员名, 'ino':, 'size':, 'mtime_ns':}}
+def is_untouched(file_path, record):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return False
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns) == (record['ino'], record['size'], record['mtime_ns'])
+
+# 把文件夹按块生成 zip 数据
+# 提供 source_zip 和 manifest 时，没有被修改过的文件直接从源 zip 复制压缩后的数据
+# source_zip 是文件对象时，调用者负责关闭它
+def iter_zip_folder(folder_path, source_zip=None, manifest=None):
+    return iter_zip_folders([('', folder_path)], source_zip, manifest)
+
+# 把多个文件夹打包到同一个 zip 中，folders 是 [(zip 中的文件夹名, 文件夹路径)...]，文件夹名为 '' 时放在最外层
+# 这些文件夹都是从同一个源 zip 解压（或克隆）出来的，共用一个 manifest；extra_files 是 [(zip 中的路径, bytes)...]
+def iter_zip_folders(folders, source_zip=None, manifest=None, extra_files=()):
+    writer = ZipStreamWriter()
+    source_file = None
+    reader = None
+    source_members = {}
+    try:
+        if source_zip is not None and manifest:
+            # source_zip 可以是路径，也可以是已经打开的文件对象（例如 streamlit 上传的文件）
+            with zipfile.ZipFile(source_zip) as zip_ref:
+                source_members = {info.filename: info for info in zip_ref.infolist()}
+            if hasattr(source_zip, 'read'):
+                reader = source_zip
+            else:
+                reader = source_file = open(source_zip, 'rb')
+
+        for prefix, folder_path in folders:
+            for root, _, files in os.walk(folder_path):  # 不需要 dirs，所以用 `_` 占位
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    relpath = os.path.relpath(file_path, folder_path).replace(os.sep, '/')
+                    arcname = f'{prefix}/{relpath}' if prefix else relpath
+                    record = manifest.get(relpath) if manifest else None
+                    info = source_members.get(record['member']) if record else None
+                    if info is not None and not info.flag_bits & 0x1 and is_untouched(file_path, record):
+                        yield from writer.add_raw(arcname, reader, info)
+                    else:
+                        yield from writer.add_file(arcname, file_path)
+        for arcname, data in extra_files:
+            yield from writer.add_bytes(arcname, data)
+        yield from writer.finish()
+    finally:
+        if source_file is not None:
+            source_file.close()
+
+# 把文件夹写成 zip 文件
+def write_zip_folder(folder_path, output_zip_path, source_zip=None, manifest=None):
+    with open(output_zip_path, 'wb') as output:
+        for chunk in iter_zip_folder(folder_path, source_zip, manifest):
+            output.write(chunk)
+    return output_zip_path